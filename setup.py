@@ -15,6 +15,9 @@ EXTRAS = {
     'kafka': [
         'kafka-python',
     ],
+    'asyncio': [
+        'trollius; python_version < "3.4"',
+    ],
     'dev': [
         'coverage',
         'pyflakes',
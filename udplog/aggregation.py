@@ -0,0 +1,346 @@
+# -*- test-case-name: udplog.test.test_aggregation -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+In-process aggregation of counters and timings.
+
+Metric-style events, like per-request timings and cache hits and misses, are
+often logged thousands of times a second. An L{Aggregator} instead sums
+counters and collects timings in a L{QuantileSketch}, and periodically
+summarizes them in a single event per category. See
+L{UDPLogger.count<udplog.udplog.UDPLogger.count>} and
+L{UDPLogger.timing<udplog.udplog.UDPLogger.timing>}.
+
+The sketches are included in the summaries, so that consumers can merge
+them across processes and intervals, and still compute percentiles.
+"""
+
+from __future__ import division, absolute_import
+
+from collections import defaultdict
+import math
+import threading
+import time
+
+DEFAULT_INTERVAL = 10
+DEFAULT_CATEGORY = 'metrics'
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+DEFAULT_MAX_BINS = 2048
+
+# The percentiles in summaries of timings.
+PERCENTILES = ((u'p50', 0.5), (u'p90', 0.9), (u'p99', 0.99), (u'p999', 0.999))
+
+# Values below this are counted as zero.
+MIN_VALUE = 1e-9
+
+class QuantileSketch(object):
+    """
+    Mergeable sketch for estimating quantiles.
+
+    Values are counted in logarithmically sized bins, such that every
+    quantile estimate is within C{relativeAccuracy} of the actual value (as
+    in DDSketch). Sketches with the same relative accuracy can be merged by
+    adding up their bins, so the estimates of a merged sketch are as
+    accurate as if all values were added to a single sketch.
+
+    If there are more than C{maxBins} bins, the lowest ones are collapsed,
+    trading accuracy for the lowest quantiles for bounded memory.
+
+    @ivar relativeAccuracy: The relative accuracy of quantile estimates.
+    @type relativeAccuracy: L{float}
+
+    @ivar count: The number of values.
+    @ivar sum: The sum of all values.
+    @ivar min: The smallest value, or C{None} if there are no values.
+    @ivar max: The largest value, or C{None} if there are no values.
+    """
+
+    def __init__(self, relativeAccuracy=DEFAULT_RELATIVE_ACCURACY,
+                       maxBins=DEFAULT_MAX_BINS):
+        self.relativeAccuracy = relativeAccuracy
+        self.maxBins = maxBins
+
+        self._gamma = (1 + relativeAccuracy) / (1 - relativeAccuracy)
+        self._logGamma = math.log(self._gamma)
+
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self._zeros = 0
+        self._bins = defaultdict(int)
+
+
+    def add(self, value):
+        """
+        Add a value.
+
+        Negative values are counted as zero.
+
+        @type value: L{float}
+        """
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        if value < MIN_VALUE:
+            self._zeros += 1
+        else:
+            self._addToBin(int(math.ceil(math.log(value) / self._logGamma)),
+                           1)
+
+
+    def _addToBin(self, index, count):
+        bins = self._bins
+        if index not in bins and len(bins) >= self.maxBins:
+            lowest = sorted(bins)[:2]
+            if index < lowest[0]:
+                index = lowest[0]
+            else:
+                bins[lowest[1]] += bins.pop(lowest[0])
+        bins[index] += count
+
+
+    def merge(self, other):
+        """
+        Add all values of another sketch.
+
+        @type other: L{QuantileSketch}
+
+        @raise ValueError: If the other sketch has a different relative
+            accuracy.
+        """
+        if other.relativeAccuracy != self.relativeAccuracy:
+            raise ValueError("Cannot merge sketches with relative accuracies "
+                             "%r and %r" % (self.relativeAccuracy,
+                                            other.relativeAccuracy))
+
+        if not other.count:
+            return
+
+        self.count += other.count
+        self.sum += other.sum
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+
+        self._zeros += other._zeros
+        for index, count in other._bins.iteritems():
+            self._addToBin(index, count)
+
+
+    def quantile(self, q):
+        """
+        Estimate a quantile.
+
+        @param q: The quantile, between 0 and 1.
+        @type q: L{float}
+
+        @return: The estimate, or C{None} if there are no values.
+        @rtype: L{float}
+        """
+        if not self.count:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = self._zeros
+        if rank < seen:
+            return max(self.min, 0)
+
+        for index in sorted(self._bins):
+            seen += self._bins[index]
+            if rank < seen:
+                value = 2 * self._gamma ** index / (self._gamma + 1)
+                return min(max(value, self.min), self.max)
+
+        return self.max
+
+
+    def toDict(self):
+        """
+        Represent the sketch as a dictionary, for serializing to JSON.
+
+        @rtype: L{dict}
+        """
+        return {
+            u'relativeAccuracy': self.relativeAccuracy,
+            u'count': self.count,
+            u'sum': self.sum,
+            u'min': self.min,
+            u'max': self.max,
+            u'zeros': self._zeros,
+            u'bins': {unicode(index): count
+                      for index, count in self._bins.iteritems()},
+            }
+
+
+    @classmethod
+    def fromDict(cls, data, maxBins=DEFAULT_MAX_BINS):
+        """
+        Recreate a sketch from its dictionary representation.
+
+        @param data: The result of L{toDict}, possibly after a round trip
+            through JSON.
+        @type data: L{dict}
+
+        @rtype: L{QuantileSketch}
+        """
+        sketch = cls(data['relativeAccuracy'], maxBins)
+        sketch.count = data['count']
+        sketch.sum = data['sum']
+        sketch.min = data['min']
+        sketch.max = data['max']
+        sketch._zeros = data['zeros']
+        for index, count in data['bins'].iteritems():
+            sketch._addToBin(int(index), count)
+        return sketch
+
+
+
+class Aggregator(object):
+    """
+    Aggregator of counters and timings.
+
+    Counters and timings are kept per category and name. Every C{interval}
+    seconds, they are summarized in one event per category, and reset. The
+    event has a C{'counts'} field mapping names to counts, and a
+    C{'timings'} field mapping names to summaries of their timings (see
+    L{summarize}).
+
+    @ivar interval: Minimum number of seconds between summaries.
+    @type interval: L{float}
+
+    @ivar relativeAccuracy: The relative accuracy of the sketches.
+    @type relativeAccuracy: L{float}
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL,
+                       relativeAccuracy=DEFAULT_RELATIVE_ACCURACY):
+        self.interval = interval
+        self.relativeAccuracy = relativeAccuracy
+
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._counts = {}
+        self._timings = {}
+
+
+    def count(self, category, name, value=1):
+        """
+        Add to a counter.
+        """
+        key = (category, name)
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + value
+
+
+    def timing(self, category, name, value):
+        """
+        Add a timing.
+        """
+        key = (category, name)
+        with self._lock:
+            try:
+                sketch = self._timings[key]
+            except KeyError:
+                sketch = self._timings[key] = QuantileSketch(
+                    self.relativeAccuracy)
+            sketch.add(value)
+
+
+    def due(self):
+        """
+        Get the time the next summary is due.
+
+        @rtype: L{float}
+        """
+        return self._started + self.interval
+
+
+    def isEmpty(self):
+        """
+        Check whether nothing was aggregated since the last summary.
+
+        @rtype: L{bool}
+        """
+        return not (self._counts or self._timings)
+
+
+    def report(self, now, force=False):
+        """
+        Summarize and reset the counters and timings, if due.
+
+        @param now: The current time.
+        @type now: L{float}
+
+        @param force: If set, summarize regardless of the interval.
+        @type force: L{bool}
+
+        @return: Tuples of category and summary event. Empty if not due or
+            nothing was aggregated.
+        @rtype: L{list}
+        """
+        if not force and now - self._started < self.interval:
+            return []
+
+        with self._lock:
+            if not force and now - self._started < self.interval:
+                return []
+            started = self._started
+            counts, self._counts = self._counts, {}
+            timings, self._timings = self._timings, {}
+            self._started = now
+
+        events = {}
+
+        def event(category):
+            try:
+                return events[category]
+            except KeyError:
+                eventDict = events[category] = {
+                    'message': "Aggregated metrics",
+                    'logLevel': 'INFO',
+                    'interval': now - started,
+                    'counts': {},
+                    'timings': {},
+                    }
+                return eventDict
+
+        for (category, name), count in counts.iteritems():
+            event(category)['counts'][name] = count
+        for (category, name), sketch in timings.iteritems():
+            event(category)['timings'][name] = summarize(sketch)
+
+        return events.items()
+
+
+
+def summarize(sketch):
+    """
+    Summarize the values in a sketch.
+
+    @type sketch: L{QuantileSketch}
+
+    @return: The count, sum, minimum, maximum and mean of the values,
+        estimates of their C{PERCENTILES} and the sketch itself, as a
+        dictionary (see L{QuantileSketch.toDict}).
+    @rtype: L{dict}
+    """
+    summary = {
+        u'count': sketch.count,
+        u'sum': sketch.sum,
+        u'min': sketch.min,
+        u'max': sketch.max,
+        u'mean': sketch.sum / sketch.count if sketch.count else None,
+        u'sketch': sketch.toDict(),
+        }
+    for name, q in PERCENTILES:
+        summary[name] = sketch.quantile(q)
+    return summary
@@ -0,0 +1,228 @@
+# -*- test-case-name: udplog.test.test_asyncio -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+asyncio support for UDP logging.
+
+L{AsyncUDPLogger} sends events through a datagram transport set up with
+C{loop.create_datagram_endpoint}. Logging an event only serializes it and
+puts it in a queue. The queue is flushed from a callback on the event loop,
+packing all events logged since the previous flush into as few datagrams as
+possible. The loop never blocks on sending, and there is one system call per
+datagram instead of one per event.
+
+On Python 2, this requires the C{trollius} backport of asyncio.
+"""
+
+from __future__ import division, absolute_import
+
+from collections import deque
+import time
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from udplog import udplog
+
+# Maximum size of a datagram with batched events. The UDPLog server receives
+# datagrams of up to 64 KiB, but a datagram that is dropped, for example when
+# the receive buffer of the server is full, takes all of its events with it.
+DEFAULT_BATCH_SIZE = 8192
+
+class AsyncUDPLogger(udplog.UDPLogger):
+    """
+    Dispatcher of structured log events over UDP, for asyncio.
+
+    Call L{connect} from the event loop to set up the transport. Events
+    logged before that are queued. L{log} may be called from any thread.
+
+    If the queue holds C{queueSize} events, new events are dropped and
+    counted in C{metrics}.
+
+    @ivar loop: The event loop.
+
+    @ivar transport: The datagram transport, or C{None} if not connected.
+
+    @ivar batchSize: Maximum size of a datagram with batched events, in bytes,
+        or C{None} to send every event in its own datagram.
+    @type batchSize: L{int}
+
+    @ivar queueSize: Maximum number of events in the queue.
+    @type queueSize: L{int}
+    """
+
+    def __init__(self, host=udplog.DEFAULT_HOST, port=udplog.DEFAULT_PORT,
+                       defaultFields=None, batchSize=DEFAULT_BATCH_SIZE,
+                       encoder=None, chunkSize=None, compress=False,
+                       sampler=None, metricsInterval=None,
+                       queueSize=udplog.DEFAULT_QUEUE_SIZE, loop=None,
+                       sequenceNumbers=False):
+        udplog.UDPLogger.__init__(self, host, port,
+                                  defaultFields=defaultFields,
+                                  encoder=encoder, chunkSize=chunkSize,
+                                  compress=compress, sampler=sampler,
+                                  metricsInterval=metricsInterval,
+                                  sequenceNumbers=sequenceNumbers)
+        self.batchSize = batchSize
+        self.queueSize = queueSize
+        self.loop = loop or asyncio.get_event_loop()
+        self.transport = None
+
+        # Appending to and popping from a deque are atomic operations, so the
+        # queue itself needs no lock.
+        self._queue = deque()
+        self._flushScheduled = False
+
+
+    def _connect(self, destinations):
+        """
+        Defer setting up the transport to L{connect}.
+        """
+        self.sockets = []
+        self.socket = None
+
+
+    def connect(self):
+        """
+        Set up the datagram transport.
+
+        @return: A coroutine to run on the event loop.
+        """
+        return self.loop.create_datagram_endpoint(
+            lambda: _LoggerProtocol(self),
+            remote_addr=self.destinations[0])
+
+
+    def close(self):
+        """
+        Send out the summaries of aggregates and all queued events, and close
+        the transport.
+        """
+        self.flush()
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+
+    def _addToBatch(self, category, eventDict, data):
+        """
+        Queue a serialized event, to be sent out from the event loop.
+        """
+        if len(self._queue) >= self.queueSize:
+            self.metrics.eventsDropped('queue')
+            return
+
+        self._queue.append(data)
+
+        if not self._flushScheduled:
+            self._flushScheduled = True
+            self.loop.call_soon_threadsafe(self._flushQueue)
+
+
+    # Without batching, events are still queued, to be sent from the loop.
+    _send = _addToBatch
+
+
+    def flush(self):
+        """
+        Send out the summaries of aggregates and all queued events.
+
+        This must be called from the event loop, and is called at exit if
+        anything was aggregated. If the transport is not set up yet, the
+        events stay queued.
+        """
+        self._reportAggregates(time.time(), force=True)
+        self._flushQueue()
+
+
+    def _flushQueue(self):
+        """
+        Send out all queued events.
+        """
+        # Reset the flag before taking events from the queue, so that events
+        # queued from other threads during this flush cause another one.
+        self._flushScheduled = False
+        if self.transport is None:
+            return
+
+        queue = self._queue
+        batch = []
+        length = 0
+        while queue:
+            data = queue.popleft()
+            if batch and (not self.batchSize or
+                          length + len(udplog.EVENT_SEPARATOR) + len(data) >
+                          self.batchSize):
+                self._sendDatagram(udplog.EVENT_SEPARATOR.join(batch),
+                                   len(batch))
+                batch = []
+
+            if batch:
+                length += len(udplog.EVENT_SEPARATOR) + len(data)
+            else:
+                length = len(data)
+            batch.append(data)
+
+        if batch:
+            self._sendDatagram(udplog.EVENT_SEPARATOR.join(batch), len(batch))
+
+
+    def _sendDatagram(self, datagram, events=1, key=''):
+        """
+        Send a datagram through the transport.
+
+        Send errors are reported asynchronously, to the protocol.
+        """
+        size = 0
+        for data in self._prepareDatagram(datagram):
+            self.transport.sendto(data)
+            size += len(data)
+        self.metrics.datagramSent(events, size)
+
+
+
+class _LoggerProtocol(asyncio.DatagramProtocol):
+    """
+    Datagram protocol for L{AsyncUDPLogger}.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+
+
+    def connection_made(self, transport):
+        self.logger.transport = transport
+        self.logger._flushQueue()
+
+
+    def error_received(self, exc):
+        self.logger.metrics.sendFailed(getattr(exc, 'errno', None))
+
+
+    def connection_lost(self, exc):
+        self.logger.transport = None
+
+
+
+class AsyncUDPLogHandler(udplog.UDPLogHandler):
+    """
+    Python Logging handler that emits to an L{AsyncUDPLogger}.
+
+    The handler takes an L{AsyncUDPLogger} as its C{logger}. Records are
+    rendered on the thread that logs them, and queued to be sent out from the
+    event loop, so emitting never blocks on the network.
+    """
+
+    def flush(self):
+        """
+        Emit pending repeats and have the queued events sent out.
+        """
+        udplog.UDPLogHandler.flush(self)
+
+        loop = self.logger.loop
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(self.logger._flushQueue)
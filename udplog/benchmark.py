@@ -0,0 +1,381 @@
+# -*- test-case-name: udplog.test.test_benchmark -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Microbenchmarks for the emission path.
+
+This measures the throughput and per-event latency of the various ways of
+emitting events, sending to a local sink socket that is never read from.
+Run it with::
+
+    python -m udplog.benchmark --output results.json
+
+The results are written to the given file as JSON, to compare performance
+across changes. Latencies are in microseconds.
+"""
+
+from __future__ import division, absolute_import
+
+import logging
+import platform
+import socket
+import sys
+import threading
+import time
+
+import simplejson
+
+from twisted.python import usage
+
+from udplog import encoding, udplog
+from udplog.twisted import UDPLogObserver
+
+DEFAULT_EVENTS = 20000
+DEFAULT_THREADS = 4
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+# A typical event, as logged through UDPLogger.log.
+EVENT = {
+    'message': 'Request handled',
+    'logLevel': 'INFO',
+    'logName': 'example.web',
+    'filename': '/srv/example/web.py',
+    'lineno': 123,
+    'funcName': 'render',
+    'method': 'GET',
+    'path': '/index.html',
+    'status': 200,
+    'duration': 0.0123,
+    }
+
+class Sink(object):
+    """
+    Local datagram socket to send benchmark events to.
+
+    The socket is never read from, so that the kernel drops datagrams once
+    its buffer is full, like with a busy UDPLog server.
+    """
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.host, self.port = self.socket.getsockname()
+
+
+    def close(self):
+        self.socket.close()
+
+
+
+def measure(func, argsList):
+    """
+    Call a function for each of a list of arguments, and time the calls.
+
+    @return: Tuple of the total number of seconds and the list of seconds
+        per call.
+    """
+    clock = time.time
+    latencies = []
+    append = latencies.append
+
+    started = clock()
+    for args in argsList:
+        before = clock()
+        func(*args)
+        append(clock() - before)
+    return clock() - started, latencies
+
+
+
+def summarize(elapsed, latencies):
+    """
+    Summarize the timings of a benchmark.
+
+    @param elapsed: Total number of seconds.
+
+    @param latencies: Number of seconds per event.
+
+    @return: The number of events, events per second and latency statistics
+        in microseconds.
+    @rtype: L{dict}
+    """
+    latencies = sorted(latency * 1e6 for latency in latencies)
+    count = len(latencies)
+
+    latency = {'mean': sum(latencies) / count,
+               'max': latencies[-1]}
+    for percentile in PERCENTILES:
+        index = min(count - 1, int(count * percentile / 100))
+        latency['p%s' % (percentile,)] = latencies[index]
+
+    return {
+        'events': count,
+        'seconds': elapsed,
+        'eventsPerSecond': count / elapsed if elapsed else None,
+        'latency': latency,
+        }
+
+
+
+def _makeRecords(events, exc_info=None, extra=None):
+    """
+    Create log records to emit, like L{logging.Logger.info} would.
+    """
+    records = []
+    for _ in xrange(events):
+        record = logging.LogRecord('example.web', logging.INFO,
+                                   '/srv/example/web.py', 123,
+                                   "Request for %(path)s handled",
+                                   ({'path': '/index.html'},),
+                                   exc_info, 'render')
+        if extra:
+            record.__dict__.update(extra)
+        records.append((record,))
+    return records
+
+
+
+def _excInfo():
+    try:
+        {}['something']
+    except KeyError:
+        return sys.exc_info()
+
+
+
+def benchSerialize(sink, events, threads):
+    """
+    L{udplog.UDPLogger.serialize}.
+    """
+    logger = udplog.UDPLogger(sink.host, sink.port)
+    return measure(logger.serialize, [('test', EVENT)] * events)
+
+
+
+def benchLog(sink, events, threads):
+    """
+    L{udplog.UDPLogger.log}.
+    """
+    logger = udplog.UDPLogger(sink.host, sink.port)
+    return measure(logger.log,
+                   [('test', EVENT.copy()) for _ in xrange(events)])
+
+
+
+def benchLogBatched(sink, events, threads):
+    """
+    L{udplog.UDPLogger.log} with batching.
+    """
+    logger = udplog.UDPLogger(sink.host, sink.port, batchSize=8192)
+    return measure(logger.log,
+                   [('test', EVENT.copy()) for _ in xrange(events)])
+
+
+
+def benchLogBound(sink, events, threads):
+    """
+    L{udplog.BoundLogger.log} with context fields.
+    """
+    logger = udplog.UDPLogger(sink.host, sink.port)
+    bound = logger.bind(requestId='0123456789abcdef', userId=12345,
+                        route='/index.html')
+    return measure(bound.log,
+                   [('test', {'message': 'Request handled', 'status': 200})
+                    for _ in xrange(events)])
+
+
+
+def benchHandler(sink, events, threads):
+    """
+    L{udplog.UDPLogHandler.emit}.
+    """
+    handler = udplog.UDPLogHandler(udplog.UDPLogger(sink.host, sink.port))
+    return measure(handler.emit, _makeRecords(events))
+
+
+
+def benchHandlerExtra(sink, events, threads):
+    """
+    L{udplog.UDPLogHandler.emit} with extra fields.
+    """
+    handler = udplog.UDPLogHandler(udplog.UDPLogger(sink.host, sink.port))
+    extra = {'method': 'GET', 'status': 200, 'duration': 0.0123}
+    return measure(handler.emit, _makeRecords(events, extra=extra))
+
+
+
+def benchHandlerException(sink, events, threads):
+    """
+    L{udplog.UDPLogHandler.emit} with an exception.
+    """
+    handler = udplog.UDPLogHandler(udplog.UDPLogger(sink.host, sink.port))
+    return measure(handler.emit, _makeRecords(events, exc_info=_excInfo()))
+
+
+
+def benchObserver(sink, events, threads):
+    """
+    L{udplog.twisted.UDPLogObserver.emit}.
+    """
+    observer = UDPLogObserver(udplog.UDPLogger(sink.host, sink.port),
+                              'twisted_logging')
+    eventDict = {'message': ('Request handled',),
+                 'isError': 0,
+                 'system': '-',
+                 'time': time.time()}
+    return measure(observer.emit, [(eventDict,)] * events)
+
+
+
+def benchContention(sink, events, threads):
+    """
+    L{udplog.ConfigurableUDPLogHandler} from multiple threads.
+
+    Records go through L{logging.Handler.handle}, like when logged through a
+    logger, so that the threads contend for the handler's lock.
+    """
+    handler = udplog.ConfigurableUDPLogHandler(host=sink.host,
+                                               port=sink.port)
+    start = threading.Event()
+    results = []
+
+    def run(records):
+        start.wait()
+        results.append(measure(handler.handle, records))
+
+    workers = [threading.Thread(target=run,
+                                args=(_makeRecords(events // threads),))
+               for _ in xrange(threads)]
+    for worker in workers:
+        worker.start()
+
+    started = time.time()
+    start.set()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - started
+
+    return elapsed, [latency
+                     for _, latencies in results
+                     for latency in latencies]
+
+
+
+BENCHMARKS = [
+    ('serialize', benchSerialize),
+    ('log', benchLog),
+    ('log.batched', benchLogBatched),
+    ('log.bound', benchLogBound),
+    ('handler.emit', benchHandler),
+    ('handler.emit.extra', benchHandlerExtra),
+    ('handler.emit.exception', benchHandlerException),
+    ('observer.emit', benchObserver),
+    ('handler.contention', benchContention),
+    ]
+
+
+
+def run(events=DEFAULT_EVENTS, threads=DEFAULT_THREADS, names=None):
+    """
+    Run the benchmarks.
+
+    Every benchmark first runs with a tenth of the number of events to warm
+    up, and then with the given number of events.
+
+    @param events: Number of events per benchmark.
+    @type events: L{int}
+
+    @param threads: Number of threads for the contention benchmark.
+    @type threads: L{int}
+
+    @param names: Names of the benchmarks to run, from C{BENCHMARKS}. If
+        C{None}, all are run.
+    @type names: L{list} of L{str}
+
+    @return: The results, with information on the environment.
+    @rtype: L{dict}
+    """
+    results = {}
+    sink = Sink()
+    try:
+        for name, benchmark in BENCHMARKS:
+            if names is not None and name not in names:
+                continue
+
+            benchmark(sink, max(threads, events // 10), threads)
+            results[name] = summarize(*benchmark(sink, events, threads))
+    finally:
+        sink.close()
+
+    return {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'encoder': encoding.defaultEncoder.name,
+        'events': events,
+        'threads': threads,
+        'benchmarks': results,
+        }
+
+
+
+class Options(usage.Options):
+    optParameters = [
+        ('output', 'o', None, 'Write the results as JSON to this file'),
+        ('events', 'n', DEFAULT_EVENTS, 'Number of events per benchmark',
+         int),
+        ('threads', 't', DEFAULT_THREADS,
+         'Number of threads for the contention benchmark', int),
+        ('benchmarks', 'b', None,
+         'Comma-separated names of the benchmarks to run'),
+        ]
+
+
+    def postOptions(self):
+        if self['benchmarks'] is not None:
+            self['benchmarks'] = self['benchmarks'].split(',')
+            known = [name for name, _ in BENCHMARKS]
+            for name in self['benchmarks']:
+                if name not in known:
+                    raise usage.UsageError("Unknown benchmark %r" % (name,))
+
+
+
+def main(argv=None, stdout=sys.stdout):
+    """
+    Run the benchmarks from the command line.
+    """
+    config = Options()
+    try:
+        config.parseOptions(argv)
+    except usage.UsageError as e:
+        print >> sys.stderr, "%s: %s" % (sys.argv[0], e)
+        print >> sys.stderr, config
+        sys.exit(1)
+
+    results = run(config['events'], config['threads'], config['benchmarks'])
+
+    print >> stdout, "%-24s %12s %9s %9s %9s" % ('benchmark', 'events/s',
+                                                 'p50 us', 'p99 us',
+                                                 'max us')
+    for name, _ in BENCHMARKS:
+        if name not in results['benchmarks']:
+            continue
+        result = results['benchmarks'][name]
+        latency = result['latency']
+        print >> stdout, "%-24s %12.0f %9.1f %9.1f %9.1f" % (
+            name, result['eventsPerSecond'] or 0,
+            latency['p50'], latency['p99'], latency['max'])
+
+    if config['output']:
+        with open(config['output'], 'w') as f:
+            simplejson.dump(results, f, indent=2, sort_keys=True)
+
+
+
+if __name__ == '__main__':
+    main()
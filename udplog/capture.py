@@ -0,0 +1,453 @@
+# -*- test-case-name: udplog.test.test_capture -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Capture of log events for ad-hoc inspection.
+
+This receives log events like the UDPLog server does, and writes them to
+standard output or a rotating file, optionally filtered by category and
+sampled. Run it with::
+
+    python -m udplog.capture --category 'web_*' --output events.log
+
+Received events are written in large buffered writes. Every second, the
+numbers of received, written and dropped events are reported on standard
+error, including the datagrams the kernel dropped because the socket buffer
+was full.
+
+Events are not validated. In the C{ndjson} format, every line is the JSON
+object of an event with its category added as C{'category'}, as passed to
+consumers by the UDPLog server. In the C{raw} format, lines are events as
+sent.
+"""
+
+from __future__ import division, absolute_import
+
+import fnmatch
+import os
+import random
+import socket
+import sys
+import time
+
+import simplejson
+
+from twisted.python import logfile, usage
+
+from udplog import compression, udplog
+from udplog.twisted import ChunkReassembler
+
+FORMAT_RAW = 'raw'
+FORMAT_NDJSON = 'ndjson'
+
+DEFAULT_RCVBUF = 16 * 1024 * 1024
+DEFAULT_BUFFER_SIZE = 64 * 1024
+DEFAULT_ROTATE_LENGTH = 100 * 1024 * 1024
+DEFAULT_INTERVAL = 1
+
+MAX_DATAGRAM_SIZE = 65535
+
+# Maximum number of categories to cache filter results and renderings for.
+_MAX_CACHED_CATEGORIES = 1000
+
+class Capture(object):
+    """
+    Filter, sample and write out received log events.
+
+    @ivar output: File-like object to write the events to.
+
+    @ivar format: The output format, C{FORMAT_RAW} or C{FORMAT_NDJSON}.
+
+    @ivar categories: If set, only events with these categories are written
+        out. These may be L{fnmatch} patterns.
+    @type categories: L{list} of L{bytes}
+
+    @ivar sampleRate: The probability that a matching event is written out.
+    @type sampleRate: L{float}
+
+    @ivar bufferSize: Number of bytes to buffer before writing them out.
+    @type bufferSize: L{int}
+
+    @ivar datagrams: Number of datagrams received, including chunks.
+    @ivar received: Number of events received.
+    @ivar written: Number of events written out.
+    @ivar filtered: Number of events not matching C{categories}.
+    @ivar sampledOut: Number of events dropped by sampling.
+    @ivar malformed: Number of datagrams and events that could not be
+        processed.
+    """
+
+    def __init__(self, output, format=FORMAT_RAW, categories=None,
+                       sampleRate=1, bufferSize=DEFAULT_BUFFER_SIZE,
+                       reassembler=None):
+        if format not in (FORMAT_RAW, FORMAT_NDJSON):
+            raise ValueError("Unknown format %r" % (format,))
+
+        self.output = output
+        self.format = format
+        self.categories = categories
+        self.sampleRate = sampleRate
+        self.bufferSize = bufferSize
+        self.reassembler = reassembler or ChunkReassembler()
+
+        self.datagrams = 0
+        self.received = 0
+        self.written = 0
+        self.filtered = 0
+        self.sampledOut = 0
+        self.malformed = 0
+
+        self._buffer = []
+        self._buffered = 0
+        self._matches = {}
+        self._categoryFields = {}
+
+
+    def datagramReceived(self, datagram, addr):
+        """
+        Process a received datagram.
+        """
+        self.datagrams += 1
+
+        try:
+            if datagram.startswith(udplog.CHUNK_MAGIC):
+                datagram = self.reassembler.chunkReceived(datagram, addr)
+                if datagram is None:
+                    return
+
+            if compression.isCompressed(datagram):
+                datagram = compression.decompress(datagram)
+        except ValueError:
+            self.malformed += 1
+            return
+
+        for data in udplog.splitDatagram(datagram):
+            self.eventReceived(data)
+
+
+    def eventReceived(self, data):
+        """
+        Process a received serialized event.
+        """
+        self.received += 1
+
+        category, separator, event = data.partition(b':')
+        if not separator:
+            self.malformed += 1
+            return
+
+        if self.categories is not None and not self._match(category):
+            self.filtered += 1
+            return
+
+        if self.sampleRate < 1 and random.random() >= self.sampleRate:
+            self.sampledOut += 1
+            return
+
+        if self.format == FORMAT_NDJSON:
+            line = self._renderJSON(category, event)
+            if line is None:
+                self.malformed += 1
+                return
+        else:
+            line = data.rstrip() + b'\n'
+
+        self._buffer.append(line)
+        self._buffered += len(line)
+        self.written += 1
+
+        if self._buffered >= self.bufferSize:
+            self.flush()
+
+
+    def _match(self, category):
+        """
+        Check if a category matches the C{categories} filter.
+        """
+        try:
+            return self._matches[category]
+        except KeyError:
+            pass
+
+        match = any(fnmatch.fnmatchcase(category, pattern)
+                    for pattern in self.categories)
+        if len(self._matches) < _MAX_CACHED_CATEGORIES:
+            self._matches[category] = match
+        return match
+
+
+    def _renderJSON(self, category, event):
+        """
+        Render an event as a JSON object including its category.
+
+        Instead of decoding and encoding the event, its category is spliced
+        into the serialized event. As JSON parsers take the last of duplicate
+        keys, the category is put last, so that it overrides any
+        C{'category'} field in the event, as on the UDPLog server.
+
+        @return: The line to write out, or C{None} if the event is not a JSON
+            object.
+        """
+        event = event.strip()
+        if len(event) < 2 or event[0] != b'{' or event[-1] != b'}':
+            return None
+
+        try:
+            field = self._categoryFields[category]
+        except KeyError:
+            try:
+                field = b'"category": ' + simplejson.dumps(category)
+            except UnicodeDecodeError:
+                return None
+            if len(self._categoryFields) < _MAX_CACHED_CATEGORIES:
+                self._categoryFields[category] = field
+
+        if event[1:-1].strip():
+            return event[:-1] + b', ' + field + b'}\n'
+        else:
+            return b'{' + field + b'}\n'
+
+
+    def flush(self):
+        """
+        Write out the buffered events.
+        """
+        if self._buffer:
+            self.output.write(b''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+        self.output.flush()
+
+
+
+def kernelDrops(sock, tables=('/proc/net/udp', '/proc/net/udp6')):
+    """
+    Get the number of datagrams the kernel dropped for a UDP socket.
+
+    This looks up the socket in the kernel's UDP socket tables by its inode.
+
+    @return: The number of dropped datagrams, or C{None} if not available.
+    @rtype: L{int}
+    """
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    for table in tables:
+        try:
+            f = open(table)
+        except IOError:
+            continue
+
+        with f:
+            header = next(f).split()
+            # The header has 'tx_queue rx_queue' and 'tr tm->when' for what
+            # are single columns in the rows.
+            try:
+                inodeIndex = header.index('inode') - 2
+                dropsIndex = header.index('drops') - 2
+            except ValueError:
+                continue
+
+            for line in f:
+                fields = line.split()
+                if len(fields) > dropsIndex and fields[inodeIndex] == inode:
+                    return int(fields[dropsIndex])
+
+    return None
+
+
+
+def formatStatus(capture, interval, received, drops):
+    """
+    Render a status line.
+
+    @param interval: Number of seconds since the previous status.
+
+    @param received: Number of events received at the previous status.
+
+    @param drops: Number of datagrams dropped by the kernel, or C{None}.
+    """
+    rate = (capture.received - received) / interval if interval else 0
+    return ("received %d events (%.0f/s), wrote %d, filtered %d, "
+            "sampled out %d, malformed %d, kernel drops %s" % (
+                capture.received, rate, capture.written, capture.filtered,
+                capture.sampledOut, capture.malformed,
+                'n/a' if drops is None else drops))
+
+
+
+def run(sock, capture, interval=DEFAULT_INTERVAL, limit=None, status=None):
+    """
+    Receive and capture events until interrupted.
+
+    @param sock: The bound datagram socket.
+
+    @param capture: The L{Capture} to pass datagrams to.
+
+    @param interval: Number of seconds between flushing the output and
+        reporting the status.
+
+    @param limit: If set, stop after writing out this many events.
+
+    @param status: If set, called with a status line every C{interval}.
+    """
+    initialDrops = kernelDrops(sock)
+
+    def report(now, previous, received):
+        capture.flush()
+        if status is not None:
+            drops = kernelDrops(sock)
+            if drops is not None and initialDrops is not None:
+                drops -= initialDrops
+            status(formatStatus(capture, now - previous, received, drops))
+
+    sock.settimeout(interval)
+    recvfrom = sock.recvfrom
+    previous = time.time()
+    received = 0
+
+    try:
+        while limit is None or capture.written < limit:
+            try:
+                datagram, addr = recvfrom(MAX_DATAGRAM_SIZE)
+            except socket.timeout:
+                pass
+            else:
+                capture.datagramReceived(datagram, addr)
+
+            now = time.time()
+            if now - previous >= interval:
+                report(now, previous, received)
+                previous = now
+                received = capture.received
+    except KeyboardInterrupt:
+        pass
+
+    report(time.time(), previous, received)
+
+
+
+def openSocket(interface, port, socketPath=None, rcvbuf=DEFAULT_RCVBUF):
+    """
+    Open a datagram socket to capture from.
+
+    @param rcvbuf: Requested size of the socket receive buffer. The kernel
+        may cap this, see C{net.core.rmem_max}.
+
+    @return: The bound socket.
+    """
+    if socketPath is not None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        address = socketPath
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        address = (interface, port)
+
+    if rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.bind(address)
+    return sock
+
+
+
+class Options(usage.Options):
+    optParameters = [
+        ('interface', 'i', udplog.DEFAULT_HOST, 'Interface to bind to'),
+        ('port', 'p', udplog.DEFAULT_PORT, 'Port to bind to', int),
+        ('unix-socket', None, None,
+         'UNIX datagram socket to bind to, instead of a UDP port'),
+        ('rcvbuf', None, DEFAULT_RCVBUF, 'Socket receive buffer size', int),
+        ('sample', 's', 1.0,
+         'Probability of writing out a matching event', float),
+        ('format', 'f', FORMAT_RAW,
+         'Output format: %s or %s' % (FORMAT_RAW, FORMAT_NDJSON)),
+        ('output', 'o', None, 'File to write to, instead of standard output'),
+        ('rotate-length', None, DEFAULT_ROTATE_LENGTH,
+         'Size in bytes at which the output file is rotated', int),
+        ('max-rotated-files', None, None,
+         'Maximum number of rotated output files to keep', int),
+        ('buffer-size', None, DEFAULT_BUFFER_SIZE,
+         'Number of bytes to buffer before writing', int),
+        ('interval', None, DEFAULT_INTERVAL,
+         'Seconds between status reports and flushes', float),
+        ('limit', 'n', None, 'Stop after writing this many events', int),
+        ]
+
+    optFlags = [
+        ('quiet', 'q', 'Do not report the status'),
+        ]
+
+
+    def __init__(self):
+        usage.Options.__init__(self)
+        self['categories'] = None
+
+
+    def opt_category(self, category):
+        """
+        Only write out events of this category, may be a pattern like
+        'web_*'. Can be given multiple times.
+        """
+        if self['categories'] is None:
+            self['categories'] = []
+        self['categories'].append(category)
+
+    opt_c = opt_category
+
+
+    def postOptions(self):
+        if self['format'] not in (FORMAT_RAW, FORMAT_NDJSON):
+            raise usage.UsageError("Unknown format %r" % (self['format'],))
+        if not 0 <= self['sample'] <= 1:
+            raise usage.UsageError("Sample rate must be between 0 and 1")
+
+
+
+def main(argv=None, stdout=sys.stdout, stderr=sys.stderr):
+    """
+    Capture events from the command line.
+    """
+    config = Options()
+    try:
+        config.parseOptions(argv)
+    except usage.UsageError as e:
+        print >> stderr, "%s: %s" % (sys.argv[0], e)
+        print >> stderr, config
+        sys.exit(1)
+
+    sock = openSocket(config['interface'], config['port'],
+                      config['unix-socket'], config['rcvbuf'])
+
+    actual = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    if config['rcvbuf'] and actual < config['rcvbuf']:
+        # Linux reports double the size it was set to, for its bookkeeping.
+        print >> stderr, ("Socket receive buffer is %d bytes, less than the "
+                          "requested %d. Raise net.core.rmem_max to allow "
+                          "more." % (actual, config['rcvbuf']))
+
+    if config['output']:
+        output = logfile.LogFile.fromFullPath(
+            config['output'],
+            rotateLength=config['rotate-length'],
+            maxRotatedFiles=config['max-rotated-files'])
+    else:
+        output = stdout
+
+    capture = Capture(output, config['format'], config['categories'],
+                      config['sample'], config['buffer-size'])
+
+    def status(line):
+        print >> stderr, line
+
+    try:
+        run(sock, capture, config['interval'], config['limit'],
+            None if config['quiet'] else status)
+    finally:
+        sock.close()
+        if output is not stdout:
+            output.close()
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+# -*- test-case-name: udplog.test.test_compression -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Compression of datagrams with a preset dictionary.
+
+Log events are small JSON objects that share most of their keys and many of
+their values. On their own, they compress poorly, as the compressor has
+little to work with. With a preset dictionary of typical event fragments,
+even a single event compresses to a fraction of its size.
+
+A compressed datagram starts with C{MAGIC}, which cannot start a category,
+followed by a byte with the version of the dictionary. The rest is a raw
+deflate stream (RFC 1951), compressed with the window preset to that
+dictionary, like with C{zlib}'s C{zdict}.
+
+Python 2's L{zlib} does not support preset dictionaries directly. Instead, a
+compressor and decompressor are primed by passing them the dictionary once,
+and then copied for every datagram.
+"""
+
+from __future__ import division, absolute_import
+
+import zlib
+
+MAGIC = b'\x1f'
+
+# Preset dictionaries by version. Never change a published dictionary: add a
+# new version instead and update DEFAULT_VERSION. Deflate favors nearby
+# matches, so the most common fragments go last.
+DICTIONARIES = {
+    1: (b'"excText": "Traceback (most recent call last):\\n  File \\"'
+        b'", line "excType": "exceptions.Exception", "excValue": "'
+        b'"isError": false, "isError": true, "system": "-", '
+        b'"warningCategory": "exceptions.UserWarning", '
+        b'"original": {"category": "original_size": '
+        b'"appname": "hostname": "localhost", '
+        b'"logLevel": "DEBUG", "logLevel": "WARNING", "logLevel": "ERROR", '
+        b'twisted_logging:\t{"udplog:\t{"python_logging:\t{'
+        b'"filename": "/usr/lib/python2.7/site-packages/'
+        b'.py", "funcName": "__init__", "lineno": '
+        b'"logName": "__main__", "logLevel": "INFO", '
+        b'"message": "", "timestamp": 14'),
+    }
+
+DEFAULT_VERSION = 1
+
+# Upper bound on the size of a decompressed datagram.
+MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024
+
+_WBITS = -zlib.MAX_WBITS
+
+
+# Primed compressors and decompressors by dictionary version. They are
+# never used directly, only copied, which is thread-safe.
+_compressors = {}
+_decompressors = {}
+
+def _primedCompressor(version):
+    try:
+        return _compressors[version]
+    except KeyError:
+        pass
+
+    compressor = zlib.compressobj(zlib.Z_BEST_COMPRESSION, zlib.DEFLATED,
+                                  _WBITS)
+    compressor.compress(DICTIONARIES[version])
+    compressor.flush(zlib.Z_SYNC_FLUSH)
+    _compressors[version] = compressor
+    return compressor
+
+
+
+def _primedDecompressor(version):
+    try:
+        return _decompressors[version]
+    except KeyError:
+        pass
+
+    compressor = zlib.compressobj(zlib.Z_BEST_COMPRESSION, zlib.DEFLATED,
+                                  _WBITS)
+    prefix = (compressor.compress(DICTIONARIES[version]) +
+              compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    decompressor = zlib.decompressobj(_WBITS)
+    decompressor.decompress(prefix)
+    _decompressors[version] = decompressor
+    return decompressor
+
+
+
+def compress(datagram, version=DEFAULT_VERSION):
+    """
+    Compress a datagram with the preset dictionary of the given version.
+
+    @type datagram: L{bytes}
+    @rtype: L{bytes}
+    """
+    compressor = _primedCompressor(version).copy()
+    return (MAGIC + chr(version) +
+            compressor.compress(datagram) + compressor.flush())
+
+
+
+def isCompressed(datagram):
+    """
+    Check if a datagram was compressed by L{compress}.
+    """
+    return datagram.startswith(MAGIC)
+
+
+
+def decompress(datagram):
+    """
+    Decompress a datagram created by L{compress}.
+
+    @type datagram: L{bytes}
+    @rtype: L{bytes}
+
+    @raise ValueError: If the datagram is not a valid compressed datagram, if
+        its dictionary version is unknown or if it decompresses to more than
+        C{MAX_DECOMPRESSED_SIZE} bytes.
+    """
+    if len(datagram) < 2 or not isCompressed(datagram):
+        raise ValueError("Not a compressed datagram")
+
+    version = ord(datagram[1])
+    if version not in DICTIONARIES:
+        raise ValueError("Unknown compression dictionary version %d" %
+                         (version,))
+
+    decompressor = _primedDecompressor(version).copy()
+    try:
+        result = decompressor.decompress(datagram[2:], MAX_DECOMPRESSED_SIZE)
+    except zlib.error as e:
+        raise ValueError("Invalid compressed datagram: %s" % (e,))
+
+    if decompressor.unconsumed_tail:
+        raise ValueError("Decompressed datagram exceeds %d bytes" %
+                         (MAX_DECOMPRESSED_SIZE,))
+
+    return result
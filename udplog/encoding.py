@@ -0,0 +1,322 @@
+# -*- test-case-name: udplog.test.test_encoding -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+JSON encoders for serializing log events.
+
+L{UDPLogger<udplog.udplog.UDPLogger>} serializes event dictionaries with an
+encoder: an object with a C{name} attribute and an C{encode} method that
+takes a dictionary and returns the JSON rendering as L{bytes}. Encoders must
+fall back to the L{repr} of objects that cannot be encoded natively, and
+skip keys that are not strings.
+
+At import time, L{findEncoder} selects the fastest available encoder from
+C{DEFAULT_ENCODERS}, and makes it available as C{defaultEncoder}. Its
+C{name} tells which one was selected. Faster third party encoders that
+render events differently from the reference encoder can be selected by
+name.
+"""
+
+from __future__ import division, absolute_import
+
+import json
+
+import simplejson
+
+def reprFallback(obj):
+    """
+    Render objects that cannot be encoded natively as their L{repr}.
+    """
+    return str(repr(obj))
+
+
+
+class SimplejsonEncoder(object):
+    """
+    Encoder using L{simplejson}.
+
+    This is the reference encoder: its output and errors define the
+    serialization semantics for log events. Without the C speedups of
+    L{simplejson}, it is named C{'simplejson-python'}.
+    """
+
+    def __init__(self):
+        # simplejson.dumps creates a new encoder for every call when passed
+        # arguments. Create one up front instead.
+        self._encode = simplejson.JSONEncoder(default=reprFallback,
+                                              skipkeys=True).encode
+        if simplejson._speedups is not None:
+            self.name = 'simplejson'
+            self.speedups = True
+        else:
+            self.name = 'simplejson-python'
+            self.speedups = False
+
+
+    def encode(self, obj):
+        return self._encode(obj)
+
+
+
+class StdlibJSONEncoder(object):
+    """
+    Encoder using the standard library's L{json}.
+
+    Unlike the reference encoder, this renders L{decimal.Decimal} values as
+    their repr, and named tuples as lists.
+    """
+
+    name = 'json'
+
+    def __init__(self):
+        # Render out of range floats like the reference encoder does, which
+        # depends on the version of simplejson.
+        allowNaN = simplejson.JSONEncoder().allow_nan
+        self._encode = json.JSONEncoder(default=reprFallback,
+                                        skipkeys=True,
+                                        allow_nan=allowNaN).encode
+
+
+    def encode(self, obj):
+        return self._encode(obj)
+
+
+
+class _FallbackEncoder(object):
+    """
+    Base class for third party encoders that differ in edge cases.
+
+    If the backend fails to encode an object, the reference encoder is tried
+    instead. This provides for the same results for objects that the backend
+    cannot handle, like dictionaries with non-string keys, and the same
+    exceptions for objects that cannot be encoded at all.
+    """
+
+    def __init__(self):
+        self._fallback = SimplejsonEncoder()
+
+
+    def encode(self, obj):
+        try:
+            return self._dumps(obj)
+        except Exception:
+            return self._fallback.encode(obj)
+
+
+
+class UjsonEncoder(_FallbackEncoder):
+    """
+    Encoder using L{ujson}.
+
+    Unlike the reference encoder, this renders JSON without spaces after
+    separators, and keys that are not strings as their L{str} instead of
+    skipping them. Only versions of ujson that support the C{default} argument
+    are used, as older versions render arbitrary objects by their
+    attributes.
+    """
+
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        _FallbackEncoder.__init__(self)
+        dumps = ujson.dumps
+
+        try:
+            dumps({}, default=reprFallback)
+        except TypeError:
+            raise ImportError("ujson does not support the default argument")
+
+        self._dumps = lambda obj: dumps(obj, default=reprFallback,
+                                        ensure_ascii=True,
+                                        escape_forward_slashes=False)
+
+
+
+class OrjsonEncoder(_FallbackEncoder):
+    """
+    Encoder using L{orjson}.
+
+    Unlike the reference encoder, this renders JSON without spaces after
+    separators, non-ASCII characters as UTF-8 instead of escapes, UUIDs as
+    plain strings, and out of range floats as C{null}. Dates are still
+    rendered as their repr.
+    """
+
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        _FallbackEncoder.__init__(self)
+        dumps = orjson.dumps
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+
+        self._dumps = lambda obj: dumps(obj, default=reprFallback,
+                                        option=option)
+
+
+
+def _simplejsonSpeedups():
+    """
+    Set up the simplejson encoder if its C speedups are available.
+    """
+    encoder = SimplejsonEncoder()
+    if not encoder.speedups:
+        raise ImportError("simplejson C speedups are not available")
+    return encoder
+
+
+
+# Encoder factories in order of preference. A factory raises ImportError if
+# its backend is not available.
+ENCODERS = [
+    ('orjson', OrjsonEncoder),
+    ('ujson', UjsonEncoder),
+    ('simplejson', _simplejsonSpeedups),
+    ('json', StdlibJSONEncoder),
+    ('simplejson-python', SimplejsonEncoder),
+    ]
+
+# Names of the encoders that are considered by default. The other encoders
+# render events differently from the reference encoder, see their
+# docstrings, so they are only used when asked for by name.
+DEFAULT_ENCODERS = ['simplejson', 'simplejson-python']
+
+
+
+def findEncoder(names=None):
+    """
+    Set up the first available encoder.
+
+    @param names: Names of the encoders to consider, from C{ENCODERS}. If
+        C{None}, those in C{DEFAULT_ENCODERS} are considered. Either way,
+        they are tried in order of preference.
+    @type names: L{list} of L{str}
+
+    @raise ValueError: If none of the encoders is available.
+    """
+    if names is None:
+        names = DEFAULT_ENCODERS
+
+    for name, factory in ENCODERS:
+        if name not in names:
+            continue
+
+        try:
+            return factory()
+        except ImportError:
+            continue
+
+    raise ValueError("No JSON encoder available from %r" % (names,))
+
+
+
+defaultEncoder = findEncoder()
+
+
+
+class ReadOnlyDict(dict):
+    """
+    Dictionary that raises L{TypeError} upon modification.
+
+    This guards fields that are encoded once against being modified
+    afterwards, which would otherwise go unnoticed.
+    """
+
+    def _readOnly(self, *args, **kwargs):
+        raise TypeError("%s is read-only" % (self.__class__.__name__,))
+
+    __setitem__ = __delitem__ = _readOnly
+    clear = pop = popitem = setdefault = update = _readOnly
+
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+
+
+class JSONFragment(object):
+    """
+    Pre-encoded members of a JSON object, to splice into other objects.
+
+    This is used for fields that are added to many objects, like default
+    fields: they are encoded once, instead of for every object. Fields
+    present in the object take precedence over those in the fragment.
+
+    @ivar fields: A copy of the fields in the fragment, that cannot be
+        modified.
+    @type fields: L{ReadOnlyDict}
+
+    @ivar encoded: The encoded members, without the enclosing braces.
+    @type encoded: L{bytes}
+    """
+
+    # Maximum number of cached partial fragments, for objects that override
+    # some of the fields.
+    maxPartial = 64
+
+    def __init__(self, fields, encoder=None):
+        """
+        @param encoder: The encoder for the fields. Defaults to
+            C{defaultEncoder}.
+        """
+        self.encoder = encoder or defaultEncoder
+        self.fields = ReadOnlyDict(fields)
+        self.keys = frozenset(fields)
+        self.encoded = self._encodeMembers(fields)
+        self._partial = {}
+
+
+    def _encodeMembers(self, fields):
+        if not fields:
+            return b''
+        return self.encoder.encode(fields)[1:-1]
+
+
+    def _members(self, obj):
+        """
+        Get the encoded members for the fields not present in C{obj}, when
+        it overrides some of them.
+        """
+        overridden = self.keys.intersection(obj)
+        try:
+            return self._partial[overridden]
+        except KeyError:
+            pass
+
+        members = self._encodeMembers({key: value
+                                       for key, value
+                                       in self.fields.iteritems()
+                                       if key not in overridden})
+        if len(self._partial) < self.maxPartial:
+            self._partial[overridden] = members
+        return members
+
+
+    def splice(self, encoded, obj):
+        """
+        Splice the fragment into an encoded object.
+
+        @param encoded: The JSON encoding of C{obj}.
+        @type encoded: L{bytes}
+
+        @param obj: The encoded object, to determine which fields in the
+            fragment are overridden.
+        @type obj: L{dict}
+
+        @return: The encoding of C{obj} with the fields of the fragment that
+            are not present in C{obj}.
+        @rtype: L{bytes}
+        """
+        if self.keys.isdisjoint(obj):
+            members = self.encoded
+        else:
+            members = self._members(obj)
+        if not members:
+            return encoded
+        elif len(encoded) == 2:
+            return b'{' + members + b'}'
+        else:
+            return encoded[:-1] + b', ' + members + b'}'
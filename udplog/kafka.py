@@ -11,9 +11,11 @@ from __future__ import division, absolute_import
 import socket
 
 from kafka import KafkaClient, SimpleProducer
-import simplejson
 from twisted.application import service
 from twisted.internet import defer, threads
+from twisted.python import log
+
+from udplog.twisted import encodeEvent
 
 
 class KafkaPublisher(service.Service):
@@ -33,18 +35,26 @@ class KafkaPublisher(service.Service):
         self._producer = yield threads.deferToThread(_make_producer,
                                                      self._config)
         service.Service.startService(self)
-        self._dispatcher.register(self._sendEvent)
+        self._dispatcher.registerBatch(self._sendEvents)
 
 
     def stopService(self):
-        self._dispatcher.unregister(self._sendEvent)
+        self._dispatcher.flush()
+        self._dispatcher.unregisterBatch(self._sendEvents)
         self._producer.stop()
         service.Service.stopService(self)
 
 
-    def _sendEvent(self, event):
-        encoded = simplejson.dumps(event).encode('utf-8')
-        self._producer.send_messages(self._topic, encoded)
+    def _sendEvents(self, events):
+        messages = []
+        for event in events:
+            try:
+                messages.append(encodeEvent(event))
+            except (TypeError, ValueError):
+                log.err(None, "Could not encode event to JSON")
+
+        if messages:
+            self._producer.send_messages(self._topic, *messages)
 
 
 def makeService(config, dispatcher):
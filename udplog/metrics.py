@@ -0,0 +1,204 @@
+# -*- test-case-name: udplog.test.test_metrics -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Metrics on the emission of log events.
+
+An L{EmissionMetrics} keeps counters on what a
+L{UDPLogger<udplog.udplog.UDPLogger>} sends out and drops, and how long it
+takes to serialize events. Every logger has one, available as its
+C{metrics} attribute. Use L{EmissionMetrics.snapshot} to inspect the
+counters, or have the logger periodically send them out as an event.
+"""
+
+from __future__ import division, absolute_import
+
+import bisect
+from collections import defaultdict, deque
+import threading
+import time
+
+DEFAULT_REPORT_INTERVAL = 60
+
+# Upper bounds, in seconds, of the buckets of the serialization time
+# histogram. Times beyond the last bound go in an extra bucket.
+SERIALIZE_TIME_BOUNDS = (0.00001, 0.00002, 0.00005,
+                         0.0001, 0.0002, 0.0005,
+                         0.001, 0.002, 0.005,
+                         0.01, 0.02, 0.05)
+
+# Maximum number of sent datagrams that are queued before adding them to the
+# counters. See EmissionMetrics.datagramSent.
+MAX_UNCOUNTED = 1000
+
+class EmissionMetrics(object):
+    """
+    Counters on the emission of log events.
+
+    All counters are cumulative since the creation of the metrics object.
+
+    @ivar reportInterval: Minimum number of seconds between reports, or
+        C{None} to disable reporting.
+    @type reportInterval: L{float}
+
+    @ivar timeSerialization: Whether the logger should time the
+        serialization of events, passing the times to L{eventSerialized}.
+        As this reads the clock twice for every event, it is off by default.
+    @type timeSerialization: L{bool}
+    """
+
+    def __init__(self, reportInterval=None, timeSerialization=False):
+        self.reportInterval = reportInterval
+        self.timeSerialization = timeSerialization
+
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._reported = self._started
+
+        self._eventsSent = 0
+        self._datagramsSent = 0
+        self._bytesSent = 0
+        self._uncounted = deque()
+        self._sendErrors = defaultdict(int)
+        self._failureFallbacks = 0
+        self._dropped = defaultdict(int)
+        self._serializeCounts = [0] * (len(SERIALIZE_TIME_BOUNDS) + 1)
+        self._serializeTime = 0.0
+
+
+    def eventSerialized(self, duration):
+        """
+        Record the time it took to serialize an event.
+
+        @param duration: Number of seconds.
+        @type duration: L{float}
+        """
+        index = bisect.bisect_left(SERIALIZE_TIME_BOUNDS, duration)
+        with self._lock:
+            self._serializeCounts[index] += 1
+            self._serializeTime += duration
+
+
+    def datagramSent(self, events, size):
+        """
+        Record a datagram that was sent out.
+
+        @param events: Number of events in the datagram.
+        @type events: L{int}
+
+        @param size: Number of bytes sent, including any chunk headers.
+        @type size: L{int}
+
+        As this is called for every datagram sent, it does not take the
+        lock, but queues the numbers, to be added to the counters in
+        batches.
+        """
+        uncounted = self._uncounted
+        uncounted.append((events, size))
+        if len(uncounted) > MAX_UNCOUNTED:
+            with self._lock:
+                self._countSent()
+
+
+    def _countSent(self):
+        """
+        Add the queued numbers of sent datagrams to the counters.
+
+        The lock must be held.
+        """
+        uncounted = self._uncounted
+        for _ in xrange(len(uncounted)):
+            events, size = uncounted.popleft()
+            self._eventsSent += events
+            self._datagramsSent += 1
+            self._bytesSent += size
+
+
+    def sendFailed(self, errno):
+        """
+        Record a failure to send a datagram.
+
+        @param errno: The error number of the failure, or C{None} if the
+            failure was not an operating system error.
+        @type errno: L{int}
+        """
+        with self._lock:
+            self._sendErrors[errno] += 1
+
+
+    def failureSerialized(self):
+        """
+        Record that an event was replaced by a report of its failure.
+        """
+        with self._lock:
+            self._failureFallbacks += 1
+
+
+    def eventsDropped(self, reason, count=1):
+        """
+        Record events that were dropped before they were sent out.
+
+        @param reason: Why the events were dropped, like C{'sampling'} or
+            C{'queue'}.
+        @type reason: L{str}
+        """
+        with self._lock:
+            self._dropped[reason] += count
+
+
+    def snapshot(self):
+        """
+        Get the current values of all counters.
+
+        @return: A dictionary with the numbers of events, datagrams and bytes
+            sent, send errors by error number, failure fallbacks, dropped
+            events by reason and the serialization time histogram. The
+            latter has the upper C{bounds} of its buckets, the C{counts} per
+            bucket, with an extra one for longer times, and the C{total}
+            time.
+        @rtype: L{dict}
+        """
+        with self._lock:
+            self._countSent()
+            return {
+                'eventsSent': self._eventsSent,
+                'datagramsSent': self._datagramsSent,
+                'bytesSent': self._bytesSent,
+                'sendErrors': dict(self._sendErrors),
+                'failureFallbacks': self._failureFallbacks,
+                'dropped': dict(self._dropped),
+                'serializeTime': {
+                    'bounds': list(SERIALIZE_TIME_BOUNDS),
+                    'counts': list(self._serializeCounts),
+                    'total': self._serializeTime,
+                    },
+                'uptime': time.time() - self._started,
+                }
+
+
+    def report(self, now):
+        """
+        Report the counters, if due.
+
+        @param now: The current time.
+        @type now: L{float}
+
+        @return: An event dictionary with a L{snapshot} of the counters, or
+            C{None} if reporting is disabled or not due yet.
+        @rtype: L{dict}
+        """
+        if (self.reportInterval is None or
+            now - self._reported < self.reportInterval):
+            return None
+
+        with self._lock:
+            if now - self._reported < self.reportInterval:
+                return None
+            self._reported = now
+
+        eventDict = self.snapshot()
+        eventDict['message'] = "Emission metrics"
+        eventDict['logLevel'] = 'INFO'
+        return eventDict
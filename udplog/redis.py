@@ -12,14 +12,14 @@ from __future__ import division, absolute_import
 
 import random
 
-import simplejson
-
 from twisted.application import internet, service
 from twisted.python import log
 from twisted.internet import defer
 
 from txredis.client import RedisClientFactory
 
+from udplog.twisted import encodeEvent
+
 class NoClientError(Exception):
     """
     Raised when there are no connected clients.
@@ -30,6 +30,10 @@ class NoClientError(Exception):
 class RedisPublisher(service.Service):
     """
     Publisher that pushes events to a Redis list.
+
+    Events are received from the dispatcher in batches, and every batch is
+    pushed with a single C{LPUSH}. Events are pushed as JSON, reusing the
+    encoding of L{udplog.twisted.Event}s.
     """
 
     def __init__(self, dispatcher, client, key):
@@ -40,25 +44,35 @@ class RedisPublisher(service.Service):
 
     def startService(self):
         service.Service.startService(self)
-        self.dispatcher.register(self.sendEvent)
+        self.dispatcher.registerBatch(self.sendEvents)
 
 
     def stopService(self):
-        self.dispatcher.unregister(self.sendEvent)
+        self.dispatcher.flush()
+        self.dispatcher.unregisterBatch(self.sendEvents)
         service.Service.stopService(self)
 
 
     def sendEvent(self, event):
-        try:
-            value = simplejson.dumps(event)
-        except (TypeError, ValueError):
-            log.err(None, "Could not encode event to JSON")
+        self.sendEvents([event])
+
+
+    def sendEvents(self, events):
+        values = []
+        for event in events:
+            try:
+                values.append(encodeEvent(event))
+            except (TypeError, ValueError):
+                log.err(None, "Could not encode event to JSON")
+
+        if not values:
             return
 
         try:
-            d = self.client.lpush(self.key, value)
+            d = self.client.lpush(self.key, *values)
         except:
             log.err()
+            return
         d.addErrback(lambda failure: failure.trap(NoClientError))
         d.addErrback(log.err)
 
@@ -0,0 +1,190 @@
+# -*- test-case-name: udplog.test.test_sampling -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Sampling and rate limiting of log events.
+
+An L{EventSampler} decides, per category and optionally per log level,
+whether an event is sent out at all. This happens before the event is
+serialized, so rejected events cost very little.
+"""
+
+from __future__ import division, absolute_import
+
+from collections import defaultdict
+import random
+import threading
+import time
+
+DEFAULT_REPORT_INTERVAL = 60
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter.
+
+    The bucket holds at most C{burst} tokens, and is refilled at C{rate}
+    tokens per second. Every accepted event takes one token.
+
+    @ivar rate: Number of tokens added per second.
+    @type rate: L{float}
+
+    @ivar burst: Maximum number of tokens in the bucket.
+    @type burst: L{float}
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self.tokens = self.burst
+        self.updated = time.time()
+
+
+    def consume(self, now):
+        """
+        Take a token from the bucket, if available.
+
+        @param now: The current time.
+        @type now: L{float}
+
+        @return: Whether a token was available.
+        @rtype: L{bool}
+        """
+        if self.tokens < self.burst:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        else:
+            return False
+
+
+
+class EventSampler(object):
+    """
+    Sampler and rate limiter of log events.
+
+    Rules are keyed by category, or by a tuple of category and log level.
+    For an event, a rule for its category and C{'logLevel'} takes precedence
+    over a rule for just its category. Events without a matching rule are
+    always accepted.
+
+    Events are first sampled, and then rate limited. Events that were
+    sampled with a rate below 1 get a C{'sampleRate'} field with that rate,
+    so that consumers can scale counts accordingly.
+
+    Rejected events are counted per category, and periodically reported
+    through L{report}.
+
+    @ivar sampleRates: Mapping from rule keys to the probability that an
+        event is accepted.
+    @type sampleRates: L{dict}
+
+    @ivar rateLimits: Mapping from rule keys to a tuple of the maximum
+        sustained number of events per second and the maximum burst size.
+        Every rule key has its own token bucket.
+    @type rateLimits: L{dict}
+
+    @ivar reportInterval: Minimum number of seconds between reports of
+        rejected events.
+    @type reportInterval: L{float}
+    """
+
+    def __init__(self, sampleRates=None, rateLimits=None,
+                       reportInterval=DEFAULT_REPORT_INTERVAL):
+        self.sampleRates = sampleRates or {}
+        self.rateLimits = rateLimits or {}
+        self.reportInterval = reportInterval
+
+        self._buckets = {key: TokenBucket(rate, burst)
+                         for key, (rate, burst) in self.rateLimits.iteritems()}
+        self._byLevel = any(isinstance(key, tuple)
+                            for key in self.sampleRates.keys() +
+                                       self.rateLimits.keys())
+
+        self._lock = threading.Lock()
+        self._sampledOut = defaultdict(int)
+        self._rateLimited = defaultdict(int)
+        self._reported = time.time()
+
+
+    def _lookup(self, rules, category, logLevel):
+        """
+        Find the rule for a category and log level.
+        """
+        if self._byLevel:
+            try:
+                return rules[category, logLevel]
+            except KeyError:
+                pass
+        return rules.get(category)
+
+
+    def accept(self, category, eventDict):
+        """
+        Decide whether to accept an event.
+
+        If the event is accepted with a sample rate below 1, the rate is added
+        to the event as C{'sampleRate'}.
+
+        @return: Whether the event is accepted.
+        @rtype: L{bool}
+        """
+        logLevel = eventDict.get('logLevel')
+
+        rate = self._lookup(self.sampleRates, category, logLevel)
+        if rate is not None and rate < 1:
+            if random.random() >= rate:
+                with self._lock:
+                    self._sampledOut[category] += 1
+                return False
+            eventDict['sampleRate'] = rate
+
+        bucket = self._lookup(self._buckets, category, logLevel)
+        if bucket is not None:
+            with self._lock:
+                if not bucket.consume(time.time()):
+                    self._rateLimited[category] += 1
+                    return False
+
+        return True
+
+
+    def report(self, now):
+        """
+        Report the number of rejected events, if due.
+
+        @param now: The current time.
+        @type now: L{float}
+
+        @return: An event dictionary with the numbers of rejected events per
+            category since the previous report, or C{None} if the report is
+            not due yet or no events were rejected.
+        @rtype: L{dict}
+        """
+        if now - self._reported < self.reportInterval:
+            return None
+
+        with self._lock:
+            sampledOut, self._sampledOut = self._sampledOut, defaultdict(int)
+            rateLimited, self._rateLimited = (self._rateLimited,
+                                              defaultdict(int))
+            interval = now - self._reported
+            self._reported = now
+
+        if not sampledOut and not rateLimited:
+            return None
+
+        total = sum(sampledOut.itervalues()) + sum(rateLimited.itervalues())
+        return {
+            'message': "Dropped %d events by sampling and rate limiting" %
+                       (total,),
+            'logLevel': 'WARNING',
+            'sampledOut': dict(sampledOut),
+            'rateLimited': dict(rateLimited),
+            'interval': interval,
+            }
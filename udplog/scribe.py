@@ -11,11 +11,8 @@ sending logs and a consumer for L{udplog.twisted.DispatcherFromUDPLogProtocol}.
 
 from __future__ import division, absolute_import
 
-import copy
 import logging
 
-import simplejson
-
 from twisted.internet import defer
 from twisted.internet import protocol
 from twisted.python import log
@@ -25,6 +22,8 @@ from thrift.Thrift import TApplicationException, TMessageType
 from thrift.protocol import TBinaryProtocol
 from thrift.transport import TTwisted
 
+from udplog.twisted import encodeEvent
+
 class AsyncScribeClient(scribe.Client):
     """
     Asynchronous Scribe client.
@@ -126,14 +125,14 @@ class ScribeProtocol(TTwisted.ThriftClientProtocol):
         Add this protocol as a consumer of log events.
         """
         TTwisted.ThriftClientProtocol.connectionMade(self)
-        self.dispatcher.register(self.sendEvent)
+        self.dispatcher.registerBatch(self.sendEvents)
 
 
     def connectionLost(self, reason=protocol.connectionDone):
         """
         Remove this protocol as a consumer of log events.
         """
-        self.dispatcher.unregister(self.sendEvent)
+        self.dispatcher.unregisterBatch(self.sendEvents)
         TTwisted.ThriftClientProtocol.connectionLost(self, reason)
 
 
@@ -141,22 +140,33 @@ class ScribeProtocol(TTwisted.ThriftClientProtocol):
         """
         Write an event to Scribe.
         """
-        event = copy.copy(event)
-
-        # Drop events with a log level lower than the configured minimum.
-        logLevel = logging.getLevelName(event.get('logLevel', 'INFO'))
-        if logLevel < self.minLogLevel:
-            return
+        self.sendEvents([event])
 
-        category = event['category']
-        del event['category']
 
-        try:
-            message = simplejson.dumps(event)
-        except ValueError, e:
-            log.err(e, "Could not encode event to JSON")
+    def sendEvents(self, events):
+        """
+        Write events to Scribe, in a single C{Log} call.
+        """
+        entries = []
+        for event in events:
+            try:
+                # Drop events with a log level lower than the configured
+                # minimum.
+                logLevel = logging.getLevelName(event.get('logLevel', 'INFO'))
+                if logLevel < self.minLogLevel:
+                    continue
+
+                category = event['category']
+                message = encodeEvent(event, withCategory=False)
+            except (TypeError, ValueError):
+                log.err(None, "Could not encode event to JSON")
+                continue
+
+            entries.append(scribe.LogEntry(category=category,
+                                           message=message))
+
+        if not entries:
             return
 
-        entry = scribe.LogEntry(category=category, message=message)
-        d = self.client.Log(messages=[entry])
+        d = self.client.Log(messages=entries)
         d.addErrback(log.err)
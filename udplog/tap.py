@@ -8,21 +8,75 @@ Twisted Application set up for UDPLog.
 
 from __future__ import division, absolute_import
 
+import errno
+import os
 import socket
+import stat
+import time
 
 from twisted.application import service
 from twisted.application import internet
 from twisted.python import usage
 
-from udplog.twisted import Dispatcher, UDPLogProtocol
+from udplog.twisted import Dispatcher, SequenceTracker, TracebackCache
+from udplog.twisted import UDPLogProtocol
 from udplog.twisted import UDPLogClientFactory
 from udplog.twisted import UDPLogToTwistedLog
 from udplog import syslog, udplog
 
+class UNIXDatagramServer(internet.UNIXDatagramServer):
+    """
+    UNIX datagram server that replaces a stale socket.
+
+    Twisted leaves the socket file behind when it stops listening, so that
+    listening on the same path again fails with C{EADDRINUSE}. Before
+    listening, a socket at the path that nothing listens on anymore is
+    removed. A socket that is still in use is left alone.
+    """
+
+    def _getPort(self):
+        _removeStaleSocket(self.kwargs['address'])
+        return internet.UNIXDatagramServer._getPort(self)
+
+
+
+def _removeStaleSocket(path):
+    """
+    Remove a UNIX datagram socket that nothing listens on anymore.
+
+    Connecting to anything but a socket, like a regular file, is refused as
+    well, so only sockets are considered.
+    """
+    try:
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            return
+    except OSError:
+        return
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        if e.errno == errno.ECONNREFUSED:
+            os.unlink(path)
+    finally:
+        sock.close()
+
+
+
 class Options(usage.Options):
     optParameters = [
         ('udplog-interface', None, udplog.DEFAULT_HOST, 'UDPLog interface'),
         ('udplog-port', None, udplog.DEFAULT_PORT, 'UDPLog port', int),
+        ('udplog-unix-socket', None, None, 'UDPLog UNIX datagram socket'),
+        ('udplog-loss-interval', None, None,
+         'Report lost events of senders with sequence numbers every this '
+         'many seconds', float),
+        ('udplog-traceback-cache-size', None, 1000,
+         'Maximum number of tracebacks to keep for restoring', int),
+        ('udplog-batch-delay', None, 0,
+         'Number of seconds to gather events for backends that send them '
+         'in batches', float),
 
         ('scribe-host', None, None, 'Scribe Thrift host'),
         ('scribe-port', None, 1463, 'Scribe Thrift port', int),
@@ -48,10 +102,21 @@ class Options(usage.Options):
         ('syslog-interface', None, '', 'syslog interface'),
         ('syslog-port', None, None, 'syslog port', int),
         ('syslog-unix-socket', None, None, 'syslog UNIX socket'),
+
+        ('workers', None, 0,
+         'Number of worker processes sharing the UDP ports, or 0 to handle '
+         'all events in this process', int),
+        ('worker-stats-interval', None, 60,
+         'Log the combined statistics of the workers every this many '
+         'seconds', float),
         ]
 
     optFlags = [
-        ('verbose', 'v', 'Log all incoming messages')
+        ('verbose', 'v', 'Log all incoming messages'),
+        ('udplog-restore-tracebacks', None,
+         'Restore tracebacks left out of repeated exception events'),
+        ('udplog-lazy', None,
+         'Only decode events when a backend accesses their fields'),
         ]
 
 
@@ -79,21 +144,99 @@ class Options(usage.Options):
 
 
 def makeService(config):
+    """
+    Set up the UDPLog server.
+
+    With C{workers} set, this sets up a supervisor of that many worker
+    processes instead (see L{udplog.workers}).
+    """
+    if config['workers']:
+        from udplog import workers
+        return workers.Supervisor(config, config['workers'],
+                                  config['worker-stats-interval'])
+    else:
+        return makeServerService(config)
+
+
+
+def makeServerService(config, reusePort=False, primary=True):
+    """
+    Set up the servers, dispatcher and backends of the UDPLog server.
+
+    @param reusePort: If set, bind the UDP ports with C{SO_REUSEPORT}, so
+        that other processes can bind them too.
+    @type reusePort: L{bool}
+
+    @param primary: Whether to set up the servers on UNIX sockets, which
+        cannot be shared between processes.
+    @type primary: L{bool}
+
+    @return: The service. Its C{stats} attribute is a callable that returns
+        the numbers of events received, lost and malformed, and of
+        datagrams and tracebacks that could not be restored.
+    @rtype: L{service.MultiService}
+    """
+    if reusePort:
+        from udplog.workers import ReusePortUDPServer as UDPServer
+    else:
+        UDPServer = internet.UDPServer
 
     s = service.MultiService()
 
     # Set up event dispatcher
 
-    dispatcher = Dispatcher()
+    dispatcher = Dispatcher(batchDelay=config['udplog-batch-delay'])
 
-    # Set up UDPLog server.
-    udplogProtocol = UDPLogProtocol(dispatcher.eventReceived)
+    # Account for lost events across all UDPLog servers.
+    tracker = SequenceTracker()
 
-    udplogServer = internet.UDPServer(port=config['udplog-port'],
-                                      protocol=udplogProtocol,
-                                      interface=config['udplog-interface'],
-                                      maxPacketSize=65536)
+    # Restore left out tracebacks, across all UDPLog servers.
+    if config.get('udplog-restore-tracebacks'):
+        tracebacks = TracebackCache(config['udplog-traceback-cache-size'])
+    else:
+        tracebacks = None
+
+    # Set up UDPLog server.
+    lazy = bool(config.get('udplog-lazy'))
+    udplogProtocol = UDPLogProtocol(dispatcher.eventReceived,
+                                    tracker=tracker, tracebacks=tracebacks,
+                                    lazy=lazy)
+
+    udplogServer = UDPServer(port=config['udplog-port'],
+                             protocol=udplogProtocol,
+                             interface=config['udplog-interface'],
+                             maxPacketSize=65536)
     udplogServer.setServiceParent(s)
+    udplogProtocols = [udplogProtocol]
+
+    # Set up UDPLog server on a UNIX datagram socket. A datagram protocol
+    # instance can only be attached to a single port.
+    if primary and config.get('udplog-unix-socket') is not None:
+        udplogUNIXProtocol = UDPLogProtocol(dispatcher.eventReceived,
+                                            tracker=tracker,
+                                            tracebacks=tracebacks,
+                                            lazy=lazy)
+        udplogProtocols.append(udplogUNIXProtocol)
+        udplogUNIXServer = UNIXDatagramServer(
+            address=config['udplog-unix-socket'],
+            protocol=udplogUNIXProtocol,
+            maxPacketSize=65536)
+        udplogUNIXServer.setServiceParent(s)
+
+    if config.get('udplog-loss-interval') is not None:
+        def reportLoss():
+            event = tracker.snapshot()
+            event.update({
+                'category': 'udplog',
+                'message': 'Event loss',
+                'logLevel': 'INFO',
+                'timestamp': time.time(),
+                })
+            dispatcher.eventReceived(event)
+
+        lossReporter = internet.TimerService(config['udplog-loss-interval'],
+                                             reportLoss)
+        lossReporter.setServiceParent(s)
 
     # Set up syslog server
     if (config.get('syslog-port') is not None or
@@ -106,14 +249,14 @@ def makeService(config):
         syslogProtocol = syslog.SyslogDatagramProtocol(
             dispatcher.eventReceived, hostnames=hostnames)
 
-        if config.get('syslog-unix-socket') is not None:
-            syslogServer = internet.UNIXDatagramServer(
+        if primary and config.get('syslog-unix-socket') is not None:
+            syslogServer = UNIXDatagramServer(
                 address=config['syslog-unix-socket'],
                 protocol=syslogProtocol,
                 maxPacketSize=65536)
             syslogServer.setServiceParent(s)
         if config.get('syslog-port') is not None:
-            syslogServer = internet.UDPServer(
+            syslogServer = UDPServer(
                 port=config['syslog-port'],
                 protocol=syslogProtocol,
                 interface=config.get('syslog-interface', ''),
@@ -159,4 +302,26 @@ def makeService(config):
     if config['verbose']:
         UDPLogToTwistedLog(dispatcher)
 
+    def stats():
+        reassemblers = [protocol.reassembler for protocol in udplogProtocols]
+        result = {
+            'events': dispatcher.received,
+            'batches': dispatcher.batches,
+            'loss': tracker.snapshot(),
+            'chunksExpired': sum(reassembler.expired
+                                 for reassembler in reassemblers),
+            'chunksEvicted': sum(reassembler.evicted
+                                 for reassembler in reassemblers),
+            'chunksRejected': sum(reassembler.rejected
+                                  for reassembler in reassemblers),
+            'malformed': sum(protocol.malformed
+                             for protocol in udplogProtocols),
+            }
+        if tracebacks is not None:
+            result['tracebacksRestored'] = tracebacks.restored
+            result['tracebacksMissed'] = tracebacks.missed
+        return result
+
+    s.stats = stats
+
     return s
@@ -0,0 +1,244 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{udplog.aggregation}.
+"""
+
+from __future__ import division, absolute_import
+
+import random
+
+import simplejson
+
+from twisted.trial import unittest
+
+from udplog import aggregation
+
+class QuantileSketchTest(unittest.TestCase):
+    """
+    Tests for L{aggregation.QuantileSketch}.
+    """
+
+    def assertAccurate(self, expected, estimate, accuracy=0.01):
+        self.assertTrue(abs(estimate - expected) <= accuracy * expected,
+                        "%r not within %r of %r" % (estimate, accuracy,
+                                                    expected))
+
+
+    def test_empty(self):
+        """
+        An empty sketch has no quantiles.
+        """
+        sketch = aggregation.QuantileSketch()
+        self.assertIdentical(None, sketch.quantile(0.5))
+        self.assertEqual(0, sketch.count)
+
+
+    def test_quantiles(self):
+        """
+        Quantile estimates are within the relative accuracy.
+        """
+        sketch = aggregation.QuantileSketch()
+        for value in xrange(1, 1001):
+            sketch.add(value)
+
+        self.assertAccurate(500, sketch.quantile(0.5))
+        self.assertAccurate(900, sketch.quantile(0.9))
+        self.assertAccurate(990, sketch.quantile(0.99))
+        self.assertEqual(1, sketch.quantile(0))
+        self.assertEqual(1000, sketch.quantile(1))
+
+
+    def test_statistics(self):
+        """
+        The count, sum, minimum and maximum are exact.
+        """
+        sketch = aggregation.QuantileSketch()
+        for value in (3.5, 1.25, 7):
+            sketch.add(value)
+
+        self.assertEqual(3, sketch.count)
+        self.assertEqual(11.75, sketch.sum)
+        self.assertEqual(1.25, sketch.min)
+        self.assertEqual(7, sketch.max)
+
+
+    def test_zero(self):
+        """
+        Zero and negative values are counted as zero.
+        """
+        sketch = aggregation.QuantileSketch()
+        for value in (0, -1, 0, 5):
+            sketch.add(value)
+
+        self.assertEqual(0, sketch.quantile(0.5))
+        self.assertAccurate(5, sketch.quantile(1))
+
+
+    def test_merge(self):
+        """
+        A merged sketch has the same estimates as a single sketch with all
+        values.
+        """
+        values = [random.expovariate(0.1) for _ in xrange(1000)]
+        single = aggregation.QuantileSketch()
+        first = aggregation.QuantileSketch()
+        second = aggregation.QuantileSketch()
+        for index, value in enumerate(values):
+            single.add(value)
+            (first if index % 2 else second).add(value)
+
+        first.merge(second)
+
+        self.assertEqual(single.count, first.count)
+        self.assertEqual(single.min, first.min)
+        self.assertEqual(single.max, first.max)
+        for q in (0.1, 0.5, 0.9, 0.99):
+            self.assertEqual(single.quantile(q), first.quantile(q))
+
+
+    def test_mergeEmpty(self):
+        """
+        Merging into an empty sketch takes over its values.
+        """
+        sketch = aggregation.QuantileSketch()
+        other = aggregation.QuantileSketch()
+        other.add(10)
+
+        sketch.merge(other)
+        sketch.merge(aggregation.QuantileSketch())
+
+        self.assertEqual(1, sketch.count)
+        self.assertEqual(10, sketch.min)
+
+
+    def test_mergeAccuracy(self):
+        """
+        Sketches with different relative accuracies cannot be merged.
+        """
+        sketch = aggregation.QuantileSketch(0.01)
+        self.assertRaises(ValueError, sketch.merge,
+                          aggregation.QuantileSketch(0.02))
+
+
+    def test_maxBins(self):
+        """
+        The number of bins is bounded by collapsing the lowest ones.
+        """
+        sketch = aggregation.QuantileSketch(maxBins=10)
+        for value in xrange(1, 1001):
+            sketch.add(value)
+
+        self.assertEqual(10, len(sketch.toDict()['bins']))
+        self.assertEqual(1000, sketch.count)
+        self.assertAccurate(990, sketch.quantile(0.99))
+
+
+    def test_roundTrip(self):
+        """
+        A sketch can be recreated from its representation in JSON.
+        """
+        sketch = aggregation.QuantileSketch()
+        for value in xrange(1, 101):
+            sketch.add(value)
+
+        data = simplejson.loads(simplejson.dumps(sketch.toDict()))
+        other = aggregation.QuantileSketch.fromDict(data)
+
+        self.assertEqual(sketch.count, other.count)
+        self.assertEqual(sketch.sum, other.sum)
+        for q in (0, 0.5, 0.9, 1):
+            self.assertEqual(sketch.quantile(q), other.quantile(q))
+
+
+
+class AggregatorTest(unittest.TestCase):
+    """
+    Tests for L{aggregation.Aggregator}.
+    """
+
+    def setUp(self):
+        self.patch(aggregation.time, 'time', lambda: 1000.0)
+        self.aggregator = aggregation.Aggregator(interval=10)
+
+
+    def test_notDue(self):
+        """
+        Nothing is reported before the interval has passed.
+        """
+        self.aggregator.count('metrics', u'hits')
+        self.assertEqual([], self.aggregator.report(1005.0))
+
+
+    def test_due(self):
+        """
+        The next summary is due an interval after the last one.
+        """
+        self.assertEqual(1010.0, self.aggregator.due())
+        self.aggregator.report(1012.0)
+        self.assertEqual(1022.0, self.aggregator.due())
+
+
+    def test_isEmpty(self):
+        """
+        The aggregator is empty until something is aggregated, and again
+        after reporting.
+        """
+        self.assertTrue(self.aggregator.isEmpty())
+        self.aggregator.timing('metrics', u'request', 12.5)
+        self.assertFalse(self.aggregator.isEmpty())
+        self.aggregator.report(1010.0)
+        self.assertTrue(self.aggregator.isEmpty())
+
+
+    def test_report(self):
+        """
+        Counters and timings are summarized per category.
+        """
+        self.aggregator.count('metrics', u'hits')
+        self.aggregator.count('metrics', u'hits', 2)
+        self.aggregator.count('cache', u'misses')
+        self.aggregator.timing('metrics', u'request', 12.5)
+
+        events = dict(self.aggregator.report(1010.0))
+
+        self.assertEqual(['cache', 'metrics'], sorted(events))
+        eventDict = events['metrics']
+        self.assertEqual({u'hits': 3}, eventDict['counts'])
+        self.assertEqual(10, eventDict['interval'])
+        timing = eventDict['timings'][u'request']
+        self.assertEqual(1, timing[u'count'])
+        self.assertEqual(12.5, timing[u'max'])
+        self.assertEqual(12.5, timing[u'p50'])
+        self.assertEqual({u'misses': 1}, events['cache']['counts'])
+        self.assertEqual({}, events['cache']['timings'])
+
+
+    def test_reset(self):
+        """
+        After a report, the aggregates start over.
+        """
+        self.aggregator.count('metrics', u'hits')
+        self.aggregator.report(1010.0)
+        self.aggregator.count('metrics', u'hits')
+
+        self.assertEqual([], self.aggregator.report(1015.0))
+        events = dict(self.aggregator.report(1020.0))
+        self.assertEqual({u'hits': 1}, events['metrics']['counts'])
+
+
+    def test_force(self):
+        """
+        Reports can be forced before the interval has passed.
+        """
+        self.aggregator.count('metrics', u'hits')
+        events = dict(self.aggregator.report(1001.0, force=True))
+        self.assertEqual({u'hits': 1}, events['metrics']['counts'])
+
+
+    def test_empty(self):
+        """
+        Without aggregates, there are no summary events.
+        """
+        self.assertEqual([], self.aggregator.report(1010.0))
@@ -0,0 +1,306 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{udplog.asyncio}.
+"""
+
+from __future__ import division, absolute_import
+
+import errno
+import logging
+import socket
+import threading
+
+from twisted.trial import unittest
+
+from udplog import udplog
+
+try:
+    from udplog import asyncio as udplog_asyncio
+except ImportError:
+    udplog_asyncio = None
+    skip = "asyncio is not available"
+else:
+    skip = None
+    asyncio = udplog_asyncio.asyncio
+
+class AsyncUDPLoggerTest(unittest.TestCase):
+    """
+    Tests for L{udplog_asyncio.AsyncUDPLogger}.
+    """
+
+    skip = skip
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(self.server.close)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(5)
+        self.address = self.server.getsockname()
+
+
+    def _makeLogger(self, connect=True, **kwargs):
+        logger = udplog_asyncio.AsyncUDPLogger(*self.address, loop=self.loop,
+                                               **kwargs)
+        if connect:
+            self._connect(logger)
+        self.addCleanup(logger.close)
+        return logger
+
+
+    def _connect(self, logger):
+        self.loop.run_until_complete(logger.connect())
+
+
+    def _runOnce(self):
+        """
+        Run all callbacks scheduled on the loop.
+        """
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+
+
+    def _receive(self):
+        return list(udplog.splitDatagram(self.server.recv(65536)))
+
+
+    def test_log(self):
+        """
+        A logged event is sent out from the loop.
+        """
+        logger = self._makeLogger()
+        logger.log('test', {u'message': u'test'})
+        self._runOnce()
+
+        events = self._receive()
+        self.assertEqual(1, len(events))
+        category, eventDict = udplog.unserialize(events[0])
+        self.assertEqual(u'test', category)
+        self.assertEqual(u'test', eventDict[u'message'])
+        self.assertIn(u'timestamp', eventDict)
+
+
+    def test_logQueued(self):
+        """
+        Logging an event does not send it out right away.
+        """
+        logger = self._makeLogger()
+        logger.log('test', {u'message': u'test'})
+
+        self.assertEqual(1, len(logger._queue))
+        self.assertEqual(0, logger.metrics.snapshot()['datagramsSent'])
+
+
+    def test_batch(self):
+        """
+        Events logged in one loop iteration are sent out in one datagram.
+        """
+        logger = self._makeLogger()
+        for i in range(3):
+            logger.log('test', {u'message': u'test %d' % i})
+        self._runOnce()
+
+        events = self._receive()
+        self.assertEqual([u'test 0', u'test 1', u'test 2'],
+                         [udplog.unserialize(event)[1][u'message']
+                          for event in events])
+        snapshot = logger.metrics.snapshot()
+        self.assertEqual(1, snapshot['datagramsSent'])
+        self.assertEqual(3, snapshot['eventsSent'])
+
+
+    def test_batchSize(self):
+        """
+        Datagrams do not exceed the batch size.
+        """
+        logger = self._makeLogger(batchSize=200)
+        for i in range(3):
+            logger.log('test', {u'message': u'x' * 100})
+        self._runOnce()
+
+        for _ in range(3):
+            self.assertEqual(1, len(self._receive()))
+
+
+    def test_noBatching(self):
+        """
+        Without a batch size, every event is sent in its own datagram.
+        """
+        logger = self._makeLogger(batchSize=None)
+        logger.log('test', {u'message': u'test 1'})
+        logger.log('test', {u'message': u'test 2'})
+        self._runOnce()
+
+        self.assertEqual(1, len(self._receive()))
+        self.assertEqual(1, len(self._receive()))
+
+
+    def test_logBeforeConnect(self):
+        """
+        Events logged before the transport is set up are sent once it is.
+        """
+        logger = self._makeLogger(connect=False)
+        logger.log('test', {u'message': u'test'})
+        self._runOnce()
+        self._connect(logger)
+
+        self.assertEqual(1, len(self._receive()))
+
+
+    def test_logFromThread(self):
+        """
+        Events can be logged from other threads.
+        """
+        logger = self._makeLogger()
+        thread = threading.Thread(target=logger.log,
+                                  args=('test', {u'message': u'test'}))
+        thread.start()
+        thread.join()
+        self._runOnce()
+
+        self.assertEqual(1, len(self._receive()))
+
+
+    def test_queueFull(self):
+        """
+        If the queue is full, new events are dropped and counted.
+        """
+        logger = self._makeLogger(queueSize=2)
+        for i in range(3):
+            logger.log('test', {u'message': u'test %d' % i})
+        self._runOnce()
+
+        self.assertEqual([u'test 0', u'test 1'],
+                         [udplog.unserialize(event)[1][u'message']
+                          for event in self._receive()])
+        self.assertEqual({'queue': 1}, logger.metrics.snapshot()['dropped'])
+
+
+    def test_compressed(self):
+        """
+        Datagrams are compressed as configured.
+        """
+        logger = self._makeLogger(compress=True)
+        logger.log('test', {u'message': u'test'})
+        self._runOnce()
+
+        category, eventDict = udplog.unserialize(self.server.recv(65536))
+        self.assertEqual(u'test', eventDict[u'message'])
+
+
+    def test_errorReceived(self):
+        """
+        Send errors reported by the transport are counted.
+        """
+        logger = self._makeLogger(connect=False)
+        protocol = udplog_asyncio._LoggerProtocol(logger)
+        protocol.error_received(socket.error(errno.ECONNREFUSED,
+                                             "Connection refused"))
+
+        self.assertEqual({errno.ECONNREFUSED: 1},
+                         logger.metrics.snapshot()['sendErrors'])
+
+
+    def test_close(self):
+        """
+        Closing the logger sends out queued events.
+        """
+        logger = self._makeLogger()
+        logger.log('test', {u'message': u'test'})
+        logger.close()
+
+        self.assertEqual(1, len(self._receive()))
+        self.assertIdentical(None, logger.transport)
+
+
+
+    def test_flushAggregates(self):
+        """
+        Flushing the logger, as done at exit, sends out the summaries of
+        aggregates. Flushing the queue from the loop does not.
+        """
+        logger = self._makeLogger()
+        logger.count(u'hits')
+        logger.log('test', {u'message': u'test'})
+        self._runOnce()
+        self.assertEqual(1, len(self._receive()))
+
+        logger.flush()
+        events = self._receive()
+        self.assertEqual(1, len(events))
+        category, eventDict = udplog.unserialize(events[0])
+        self.assertEqual(u'metrics', category)
+        self.assertEqual({u'hits': 1}, eventDict[u'counts'])
+
+
+class AsyncUDPLogHandlerTest(unittest.TestCase):
+    """
+    Tests for L{udplog_asyncio.AsyncUDPLogHandler}.
+    """
+
+    skip = skip
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(self.server.close)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(5)
+
+        host, port = self.server.getsockname()
+        self.udplogger = udplog_asyncio.AsyncUDPLogger(host, port,
+                                                       loop=self.loop)
+        self.loop.run_until_complete(self.udplogger.connect())
+        self.addCleanup(self.udplogger.close)
+
+        self.handler = udplog_asyncio.AsyncUDPLogHandler(self.udplogger,
+                                                         category='test')
+        self.logger = logging.Logger('test_logger')
+        self.logger.addHandler(self.handler)
+
+
+    def _runOnce(self):
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+
+
+    def test_emit(self):
+        """
+        Records are queued and sent out from the loop.
+        """
+        self.logger.info("Hello, %(object)s!", {'object': "world"})
+        self.logger.info("Bye")
+        self._runOnce()
+
+        events = list(udplog.splitDatagram(self.server.recv(65536)))
+        self.assertEqual([u'Hello, world!', u'Bye'],
+                         [udplog.unserialize(event)[1][u'message']
+                          for event in events])
+
+
+    def test_flush(self):
+        """
+        Flushing the handler has the queued events sent out.
+        """
+        self.handler.flush()
+        self.logger.info("Hello")
+        self.handler.flush()
+        self._runOnce()
+
+        self.assertEqual(1, len(list(udplog.splitDatagram(
+            self.server.recv(65536)))))
+
+
+    def test_flushClosed(self):
+        """
+        Flushing the handler after the loop was closed does not fail.
+        """
+        self.udplogger.close()
+        self.loop.close()
+        self.handler.flush()
@@ -0,0 +1,95 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{udplog.benchmark}.
+"""
+
+from __future__ import division, absolute_import
+
+import StringIO
+
+import simplejson
+
+from twisted.python import usage
+from twisted.trial import unittest
+
+from udplog import benchmark
+
+class SummarizeTest(unittest.TestCase):
+    """
+    Tests for L{benchmark.summarize}.
+    """
+
+    def test_summarize(self):
+        """
+        Throughput and latency percentiles are calculated in microseconds.
+        """
+        latencies = [i / 1e6 for i in range(1, 101)]
+        result = benchmark.summarize(0.5, latencies)
+
+        self.assertEqual(100, result['events'])
+        self.assertEqual(200, result['eventsPerSecond'])
+        self.assertAlmostEqual(51, result['latency']['p50'])
+        self.assertAlmostEqual(100, result['latency']['p99'])
+        self.assertAlmostEqual(100, result['latency']['p99.9'])
+        self.assertAlmostEqual(100, result['latency']['max'])
+        self.assertAlmostEqual(50.5, result['latency']['mean'])
+
+
+
+class RunTest(unittest.TestCase):
+    """
+    Tests for L{benchmark.run}.
+    """
+
+    def test_run(self):
+        """
+        All benchmarks are run.
+        """
+        results = benchmark.run(events=20, threads=2)
+
+        self.assertEqual(set(name for name, _ in benchmark.BENCHMARKS),
+                         set(results['benchmarks']))
+        for result in results['benchmarks'].itervalues():
+            self.assertEqual(20, result['events'])
+        self.assertIn('encoder', results)
+
+
+    def test_runNames(self):
+        """
+        Only the named benchmarks are run.
+        """
+        results = benchmark.run(events=10, names=['serialize'])
+        self.assertEqual(['serialize'], results['benchmarks'].keys())
+
+
+
+class MainTest(unittest.TestCase):
+    """
+    Tests for L{benchmark.main}.
+    """
+
+    def test_output(self):
+        """
+        The results are printed and written as JSON to the output file.
+        """
+        path = self.mktemp()
+        stdout = StringIO.StringIO()
+        benchmark.main(['-n', '10', '-b', 'serialize,log', '-o', path],
+                       stdout)
+
+        with open(path) as f:
+            results = simplejson.load(f)
+        self.assertEqual(set([u'serialize', u'log']),
+                         set(results[u'benchmarks']))
+        self.assertIn('serialize', stdout.getvalue())
+
+
+    def test_unknownBenchmark(self):
+        """
+        Unknown benchmark names are rejected.
+        """
+        self.assertRaises(usage.UsageError,
+                          benchmark.Options().parseOptions,
+                          ['-b', 'nonexistent'])
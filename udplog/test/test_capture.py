@@ -0,0 +1,340 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{udplog.capture}.
+"""
+
+from __future__ import division, absolute_import
+
+import os
+import random
+import socket
+import StringIO
+
+import simplejson
+
+from twisted.internet import task
+from twisted.python import usage
+from twisted.trial import unittest
+
+from udplog import capture, compression, udplog
+from udplog.twisted import ChunkReassembler
+
+class CaptureTest(unittest.TestCase):
+    """
+    Tests for L{capture.Capture}.
+    """
+
+    def setUp(self):
+        self.output = StringIO.StringIO()
+
+
+    def _makeCapture(self, **kwargs):
+        return capture.Capture(self.output,
+                               reassembler=ChunkReassembler(clock=task.Clock()),
+                               **kwargs)
+
+
+    def _lines(self, capture):
+        capture.flush()
+        return self.output.getvalue().splitlines()
+
+
+    def test_raw(self):
+        """
+        In the raw format, events are written out as received.
+        """
+        c = self._makeCapture()
+        c.datagramReceived(b'test:\t{"message": "a"}\n', None)
+
+        self.assertEqual([b'test:\t{"message": "a"}'], self._lines(c))
+        self.assertEqual(1, c.received)
+        self.assertEqual(1, c.written)
+
+
+    def test_ndjson(self):
+        """
+        In the ndjson format, the category is added to the event.
+        """
+        c = self._makeCapture(format=capture.FORMAT_NDJSON)
+        c.datagramReceived(b'test:\t{"message": "a"}', None)
+
+        self.assertEqual([{u'message': u'a', u'category': u'test'}],
+                         [simplejson.loads(line) for line in self._lines(c)])
+
+
+    def test_ndjsonEmpty(self):
+        """
+        The category is added to empty events.
+        """
+        c = self._makeCapture(format=capture.FORMAT_NDJSON)
+        c.datagramReceived(b'test:\t{ }', None)
+
+        self.assertEqual([{u'category': u'test'}],
+                         [simplejson.loads(line) for line in self._lines(c)])
+
+
+    def test_ndjsonCategoryOverride(self):
+        """
+        The category overrides a category field in the event.
+        """
+        c = self._makeCapture(format=capture.FORMAT_NDJSON)
+        c.datagramReceived(b'test:\t{"category": "other"}', None)
+
+        self.assertEqual([{u'category': u'test'}],
+                         [simplejson.loads(line) for line in self._lines(c)])
+
+
+    def test_ndjsonMalformed(self):
+        """
+        Events that are not JSON objects are counted as malformed.
+        """
+        c = self._makeCapture(format=capture.FORMAT_NDJSON)
+        c.datagramReceived(b'test:\t[1, 2]', None)
+        c.datagramReceived(b'no category', None)
+
+        self.assertEqual([], self._lines(c))
+        self.assertEqual(2, c.malformed)
+
+
+    def test_unknownFormat(self):
+        """
+        Unknown formats are rejected.
+        """
+        self.assertRaises(ValueError, capture.Capture, self.output, 'xml')
+
+
+    def test_batched(self):
+        """
+        All events in a datagram are written out.
+        """
+        c = self._makeCapture()
+        c.datagramReceived(b'test:\t{"a": 1}\ntest:\t{"a": 2}', None)
+
+        self.assertEqual(2, len(self._lines(c)))
+        self.assertEqual(1, c.datagrams)
+
+
+    def test_compressed(self):
+        """
+        Compressed datagrams are decompressed.
+        """
+        c = self._makeCapture()
+        c.datagramReceived(compression.compress(b'test:\t{"a": 1}'), None)
+
+        self.assertEqual([b'test:\t{"a": 1}'], self._lines(c))
+
+
+    def test_chunked(self):
+        """
+        Chunked datagrams are reassembled.
+        """
+        c = self._makeCapture()
+        data = b'test:\t{"message": "%s"}' % (b'x' * 200,)
+        for chunk in udplog.chunkDatagram(data, 1, 100):
+            c.datagramReceived(chunk, ('127.0.0.1', 1234))
+
+        self.assertEqual([data], self._lines(c))
+
+
+    def test_invalidChunk(self):
+        """
+        Invalid chunks are counted as malformed.
+        """
+        c = self._makeCapture()
+        c.datagramReceived(udplog.CHUNK_MAGIC + b'x', None)
+
+        self.assertEqual(1, c.malformed)
+
+
+    def test_categories(self):
+        """
+        Only events matching one of the categories are written out.
+        """
+        c = self._makeCapture(categories=['web_*', 'db'])
+        for category in ('web_request', 'db', 'dbx', 'other'):
+            c.datagramReceived(category + b':\t{}', None)
+
+        self.assertEqual([b'web_request:\t{}', b'db:\t{}'], self._lines(c))
+        self.assertEqual(2, c.filtered)
+
+
+    def test_sample(self):
+        """
+        Events are sampled.
+        """
+        values = iter([0.1, 0.9])
+        self.patch(random, 'random', lambda: next(values))
+
+        c = self._makeCapture(sampleRate=0.5)
+        c.datagramReceived(b'test:\t{"a": 1}', None)
+        c.datagramReceived(b'test:\t{"a": 2}', None)
+
+        self.assertEqual([b'test:\t{"a": 1}'], self._lines(c))
+        self.assertEqual(1, c.sampledOut)
+
+
+    def test_buffered(self):
+        """
+        Events are written out once the buffer is full.
+        """
+        c = self._makeCapture(bufferSize=30)
+        c.datagramReceived(b'test:\t{"a": 1}', None)
+        self.assertEqual(b'', self.output.getvalue())
+
+        c.datagramReceived(b'test:\t{"a": 2}', None)
+        self.assertEqual(2, len(self.output.getvalue().splitlines()))
+
+
+
+class KernelDropsTest(unittest.TestCase):
+    """
+    Tests for L{capture.kernelDrops}.
+    """
+
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(self.sock.close)
+        self.sock.bind(('127.0.0.1', 0))
+
+
+    def _writeTable(self, inode, drops):
+        path = self.mktemp()
+        with open(path, 'w') as f:
+            f.write("  sl  local_address rem_address   st tx_queue rx_queue "
+                    "tr tm->when retrnsmt   uid  timeout inode ref pointer "
+                    "drops\n")
+            f.write(" 1: 0100007F:D431 00000000:0000 07 00000000:00000000 "
+                    "00:00000000 00000000  1000        0 %s 2 "
+                    "ffff000000000000 %d\n" % (inode, drops))
+        return path
+
+
+    def test_found(self):
+        """
+        The drops of the socket are looked up by its inode.
+        """
+        inode = os.fstat(self.sock.fileno()).st_ino
+        path = self._writeTable(inode, 42)
+        self.assertEqual(42, capture.kernelDrops(self.sock, (path,)))
+
+
+    def test_notFound(self):
+        """
+        If the socket is not in the tables, the drops are not available.
+        """
+        path = self._writeTable(1, 42)
+        self.assertIdentical(None,
+                             capture.kernelDrops(self.sock,
+                                                 (path, self.mktemp())))
+
+
+    def test_live(self):
+        """
+        On Linux, the drops of the socket are found in the kernel's table.
+        """
+        if not os.path.exists('/proc/net/udp'):
+            raise unittest.SkipTest("No /proc/net/udp")
+        self.assertEqual(0, capture.kernelDrops(self.sock))
+
+
+
+class RunTest(unittest.TestCase):
+    """
+    Tests for L{capture.run}.
+    """
+
+    def test_run(self):
+        """
+        Datagrams are captured until the limit, with status reports.
+        """
+        sock = capture.openSocket('127.0.0.1', 0)
+        self.addCleanup(sock.close)
+
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sender.close)
+        for i in range(3):
+            sender.sendto(b'test:\t{"a": %d}' % (i,), sock.getsockname())
+
+        output = StringIO.StringIO()
+        statuses = []
+        capture.run(sock, capture.Capture(output), interval=0.1, limit=3,
+                    status=statuses.append)
+
+        self.assertEqual(3, len(output.getvalue().splitlines()))
+        self.assertTrue(statuses[-1].startswith('received 3 events'))
+
+
+
+class OptionsTest(unittest.TestCase):
+    """
+    Tests for L{capture.Options}.
+    """
+
+    def test_categories(self):
+        """
+        Categories can be given multiple times.
+        """
+        config = capture.Options()
+        config.parseOptions(['-c', 'a', '--category', 'b*'])
+        self.assertEqual(['a', 'b*'], config['categories'])
+
+
+    def test_noCategories(self):
+        """
+        By default, all categories are captured.
+        """
+        config = capture.Options()
+        config.parseOptions([])
+        self.assertIdentical(None, config['categories'])
+
+
+    def test_unknownFormat(self):
+        """
+        Unknown formats are rejected.
+        """
+        config = capture.Options()
+        self.assertRaises(usage.UsageError, config.parseOptions,
+                          ['--format', 'xml'])
+
+
+    def test_sampleRange(self):
+        """
+        Sample rates must be probabilities.
+        """
+        config = capture.Options()
+        self.assertRaises(usage.UsageError, config.parseOptions,
+                          ['--sample', '2'])
+
+
+
+class MainTest(unittest.TestCase):
+    """
+    Tests for L{capture.main}.
+    """
+
+    def test_output(self):
+        """
+        Events are written to the rotating output file.
+        """
+        path = self.mktemp()
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sender.close)
+
+        openSocket = capture.openSocket
+        def openAndSend(*args, **kwargs):
+            sock = openSocket(*args, **kwargs)
+            sender.sendto(b'test:\t{"a": 1}', sock.getsockname())
+            return sock
+        self.patch(capture, 'openSocket', openAndSend)
+
+        stderr = StringIO.StringIO()
+        capture.main(['-p', '0', '-n', '1', '-f', 'ndjson', '-o', path,
+                      '--interval', '0.1'],
+                     stderr=stderr)
+
+        with open(path) as f:
+            self.assertEqual([{u'a': 1, u'category': u'test'}],
+                             [simplejson.loads(line) for line in f])
+        self.assertIn('received 1 events', stderr.getvalue())
@@ -0,0 +1,116 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{udplog.compression}.
+"""
+
+from __future__ import division, absolute_import
+
+import zlib
+
+from twisted.trial import unittest
+
+from udplog import compression
+
+class CompressionTest(unittest.TestCase):
+    """
+    Tests for L{compression.compress} and L{compression.decompress}.
+    """
+
+    datagram = (b'python_logging:\t{"logLevel": "INFO", "logName": "__main__", '
+                b'"message": "Hello, world!", "timestamp": 1379508311.437895, '
+                b'"filename": "example.py", "lineno": 42, '
+                b'"funcName": "main", "hostname": "localhost"}')
+
+    def test_roundTrip(self):
+        """
+        A compressed datagram decompresses to the original.
+        """
+        compressed = compression.compress(self.datagram)
+        self.assertEqual(self.datagram, compression.decompress(compressed))
+
+
+    def test_roundTripRepeated(self):
+        """
+        Compressors and decompressors can be reused for every datagram.
+        """
+        for i in range(3):
+            datagram = self.datagram + b' ' * i
+            compressed = compression.compress(datagram)
+            self.assertEqual(datagram, compression.decompress(compressed))
+
+
+    def test_header(self):
+        """
+        Compressed datagrams start with the magic byte and the version.
+        """
+        compressed = compression.compress(self.datagram)
+        self.assertTrue(compression.isCompressed(compressed))
+        self.assertEqual(compression.MAGIC + chr(compression.DEFAULT_VERSION),
+                         compressed[:2])
+
+
+    def test_smaller(self):
+        """
+        The preset dictionary makes a single event compress well.
+        """
+        compressed = compression.compress(self.datagram)
+        self.assertLess(len(compressed), len(self.datagram) // 2)
+        self.assertLess(len(compressed), len(zlib.compress(self.datagram, 9)))
+
+
+    def test_presetDictionary(self):
+        """
+        The compressed data is a raw deflate stream with a preset dictionary.
+        """
+        compressed = compression.compress(self.datagram)
+        dictionary = compression.DICTIONARIES[compression.DEFAULT_VERSION]
+
+        # Prime a decompressor independently from the module.
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        compressor = zlib.compressobj(1, zlib.DEFLATED, -zlib.MAX_WBITS)
+        decompressor.decompress(compressor.compress(dictionary) +
+                                compressor.flush(zlib.Z_SYNC_FLUSH))
+
+        self.assertEqual(self.datagram, decompressor.decompress(compressed[2:]))
+
+
+    def test_isCompressedNot(self):
+        """
+        Regular datagrams are not compressed.
+        """
+        self.assertFalse(compression.isCompressed(self.datagram))
+
+
+    def test_decompressNotCompressed(self):
+        """
+        Decompressing a regular datagram raises ValueError.
+        """
+        self.assertRaises(ValueError, compression.decompress, self.datagram)
+
+
+    def test_decompressUnknownVersion(self):
+        """
+        Decompressing with an unknown dictionary version raises ValueError.
+        """
+        compressed = compression.compress(self.datagram)
+        compressed = compression.MAGIC + chr(255) + compressed[2:]
+        self.assertRaises(ValueError, compression.decompress, compressed)
+
+
+    def test_decompressInvalid(self):
+        """
+        Decompressing invalid data raises ValueError.
+        """
+        compressed = compression.MAGIC + chr(1) + b'\xff' * 16
+        self.assertRaises(ValueError, compression.decompress, compressed)
+
+
+    def test_decompressTooLarge(self):
+        """
+        Decompressing to more than the maximum size raises ValueError.
+        """
+        self.patch(compression, 'MAX_DECOMPRESSED_SIZE', 100)
+        compressed = compression.compress(b'a' * 1000)
+        self.assertRaises(ValueError, compression.decompress, compressed)
@@ -0,0 +1,421 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{udplog.encoding}.
+"""
+
+from __future__ import division, absolute_import
+
+import collections
+import copy
+import datetime
+import decimal
+import uuid
+
+import simplejson
+
+from twisted.trial import unittest
+
+from udplog import encoding
+
+class Something(object):
+    pass
+
+
+
+class EncoderTestsMixin(object):
+    """
+    Tests for encoders.
+    """
+
+    def test_encode(self):
+        """
+        A dictionary is encoded to JSON.
+        """
+        result = self.encoder.encode({u'message': u'test', u'lineno': 4})
+        self.assertEqual({u'message': u'test', u'lineno': 4},
+                         simplejson.loads(result))
+
+
+    def test_encodeRepr(self):
+        """
+        Objects that cannot be encoded are rendered as their repr.
+        """
+        something = Something()
+        result = self.encoder.encode({u'something': something})
+        self.assertEqual({u'something': repr(something)},
+                         simplejson.loads(result))
+
+
+    def test_encodeDatetime(self):
+        """
+        Dates and UUIDs are rendered as their repr.
+        """
+        values = [datetime.datetime(2015, 1, 1), datetime.date(2015, 1, 1),
+                  uuid.UUID(int=1)]
+        for value in values:
+            result = self.encoder.encode({u'value': value})
+            self.assertEqual({u'value': repr(value)}, simplejson.loads(result))
+
+
+    def test_encodeNaN(self):
+        """
+        Out of range floats are rendered, or rejected with ValueError, like
+        the reference encoder does.
+        """
+        reference = encoding.SimplejsonEncoder()
+        for value in (float('nan'), float('inf')):
+            obj = {u'value': value}
+            try:
+                expected = reference.encode(obj)
+            except ValueError:
+                self.assertRaises(ValueError, self.encoder.encode, obj)
+            else:
+                self.assertEqual(expected, self.encoder.encode(obj))
+
+
+    def test_encodeSkipKeys(self):
+        """
+        Keys that are not strings or numbers are skipped.
+        """
+        result = self.encoder.encode({u'message': u'test', (1, 2): u'tuple'})
+        self.assertEqual({u'message': u'test'}, simplejson.loads(result))
+
+
+    def test_encodeNonUnicode(self):
+        """
+        Non-utf8-encodable strings raise a UnicodeDecodeError.
+        """
+        self.assertRaises(UnicodeDecodeError, self.encoder.encode,
+                          {u'bad': b'\x80abc'})
+
+
+    def test_name(self):
+        """
+        Encoders have a name.
+        """
+        self.assertTrue(self.encoder.name)
+
+
+
+class SimplejsonEncoderTest(EncoderTestsMixin, unittest.TestCase):
+    """
+    Tests for L{encoding.SimplejsonEncoder}.
+    """
+
+    def setUp(self):
+        self.encoder = encoding.SimplejsonEncoder()
+
+
+    def test_sameAsDumps(self):
+        """
+        The output is the same as that of L{simplejson.dumps}.
+        """
+        eventDict = {u'message': u'test', u'lineno': 4, u'list': [1, 2]}
+        self.assertEqual(simplejson.dumps(eventDict),
+                         self.encoder.encode(eventDict))
+
+
+
+class StdlibJSONEncoderTest(EncoderTestsMixin, unittest.TestCase):
+    """
+    Tests for L{encoding.StdlibJSONEncoder}.
+    """
+
+    def setUp(self):
+        self.encoder = encoding.StdlibJSONEncoder()
+
+
+
+class UjsonEncoderTest(EncoderTestsMixin, unittest.TestCase):
+    """
+    Tests for L{encoding.UjsonEncoder}.
+    """
+
+    def setUp(self):
+        try:
+            self.encoder = encoding.UjsonEncoder()
+        except ImportError as e:
+            raise unittest.SkipTest(str(e))
+
+
+    def test_encodeSkipKeys(self):
+        """
+        Keys that are not strings are rendered as their str.
+        """
+        result = self.encoder.encode({u'message': u'test', (1, 2): u'tuple'})
+        self.assertEqual({u'message': u'test', u'(1, 2)': u'tuple'},
+                         simplejson.loads(result))
+
+
+    def test_compact(self):
+        """
+        There are no spaces after separators.
+        """
+        self.assertEqual('{"a":1}', self.encoder.encode({u'a': 1}))
+
+
+
+class OrjsonEncoderTest(EncoderTestsMixin, unittest.TestCase):
+    """
+    Tests for L{encoding.OrjsonEncoder}.
+    """
+
+    def setUp(self):
+        try:
+            self.encoder = encoding.OrjsonEncoder()
+        except ImportError as e:
+            raise unittest.SkipTest(str(e))
+
+
+    def test_encodeDatetime(self):
+        """
+        Dates are rendered as their repr, UUIDs as plain strings.
+        """
+        for value in (datetime.datetime(2015, 1, 1),
+                      datetime.date(2015, 1, 1)):
+            result = self.encoder.encode({u'value': value})
+            self.assertEqual({u'value': repr(value)}, simplejson.loads(result))
+
+        result = self.encoder.encode({u'value': uuid.UUID(int=1)})
+        self.assertEqual({u'value': str(uuid.UUID(int=1))},
+                         simplejson.loads(result))
+
+
+    def test_encodeNaN(self):
+        """
+        Out of range floats are rendered as null.
+        """
+        for value in (float('nan'), float('inf')):
+            result = self.encoder.encode({u'value': value})
+            self.assertEqual({u'value': None}, simplejson.loads(result))
+
+
+    def test_compact(self):
+        """
+        There are no spaces after separators.
+        """
+        self.assertEqual(b'{"a":1}', self.encoder.encode({u'a': 1}))
+
+
+
+class FallbackEncoderTest(unittest.TestCase):
+    """
+    Tests for L{encoding._FallbackEncoder}.
+    """
+
+    def test_fallback(self):
+        """
+        Objects the backend fails to encode are encoded by the reference
+        encoder.
+        """
+        def dumps(obj):
+            raise TypeError("Dict key must be str")
+
+        encoder = encoding._FallbackEncoder()
+        encoder._dumps = dumps
+        self.assertEqual('{"message": "test"}',
+                         encoder.encode({u'message': u'test', (1, 2): 1}))
+
+
+
+class FindEncoderTest(unittest.TestCase):
+    """
+    Tests for L{encoding.findEncoder}.
+    """
+
+    def test_default(self):
+        """
+        The default encoder is one of the known encoders.
+        """
+        self.assertIn(encoding.defaultEncoder.name,
+                      [name for name, _ in encoding.ENCODERS])
+
+
+    def test_thirdPartyByName(self):
+        """
+        Third party encoders are only selected when asked for by name.
+        """
+        self.patch(encoding, 'ENCODERS',
+                   [('ujson', encoding.StdlibJSONEncoder),
+                    ('simplejson', encoding.SimplejsonEncoder)])
+
+        self.assertIsInstance(encoding.findEncoder(),
+                              encoding.SimplejsonEncoder)
+        self.assertIsInstance(encoding.findEncoder(['ujson']),
+                              encoding.StdlibJSONEncoder)
+
+
+    def test_purePythonFallback(self):
+        """
+        Without the C speedups of simplejson, simplejson is still selected
+        by default, instead of the standard library's json.
+        """
+        def unavailable():
+            raise ImportError()
+        self.patch(encoding, 'ENCODERS',
+                   [(name, unavailable if name == 'simplejson' else factory)
+                    for name, factory in encoding.ENCODERS])
+
+        encoder = encoding.findEncoder()
+        self.assertIsInstance(encoder, encoding.SimplejsonEncoder)
+
+
+    def test_stdlibDifferences(self):
+        """
+        The standard library's json renders Decimals and named tuples
+        differently from the reference encoder.
+        """
+        Point = collections.namedtuple('Point', 'x y')
+        reference = encoding.SimplejsonEncoder()
+        stdlib = encoding.StdlibJSONEncoder()
+        for value in (decimal.Decimal('1.5'), Point(1, 2)):
+            obj = {u'value': value}
+            self.assertNotEqual(reference.encode(obj), stdlib.encode(obj))
+
+
+    def test_names(self):
+        """
+        Only the named encoders are considered.
+        """
+        encoder = encoding.findEncoder(['json'])
+        self.assertIsInstance(encoder, encoding.StdlibJSONEncoder)
+
+
+    def test_unavailable(self):
+        """
+        Unavailable encoders are skipped.
+        """
+        def unavailable():
+            raise ImportError()
+
+        self.patch(encoding, 'ENCODERS', [('simplejson', unavailable),
+                                          ('json',
+                                           encoding.StdlibJSONEncoder)])
+        encoder = encoding.findEncoder(['simplejson', 'json'])
+        self.assertEqual('json', encoder.name)
+
+
+    def test_noneAvailable(self):
+        """
+        If no encoder is available, ValueError is raised.
+        """
+        self.assertRaises(ValueError, encoding.findEncoder, ['nonexistent'])
+
+
+
+class ReadOnlyDictTest(unittest.TestCase):
+    """
+    Tests for L{encoding.ReadOnlyDict}.
+    """
+
+    def setUp(self):
+        self.fields = encoding.ReadOnlyDict({u'hostname': u'foo'})
+
+
+    def test_modify(self):
+        """
+        All ways of modifying the dictionary raise L{TypeError}.
+        """
+        self.assertRaises(TypeError, self.fields.__setitem__, u'a', 1)
+        self.assertRaises(TypeError, self.fields.__delitem__, u'hostname')
+        self.assertRaises(TypeError, self.fields.clear)
+        self.assertRaises(TypeError, self.fields.pop, u'hostname')
+        self.assertRaises(TypeError, self.fields.popitem)
+        self.assertRaises(TypeError, self.fields.setdefault, u'a', 1)
+        self.assertRaises(TypeError, self.fields.update, {u'a': 1})
+        self.assertEqual({u'hostname': u'foo'}, self.fields)
+
+
+    def test_copy(self):
+        """
+        Copies are read-only too.
+        """
+        for fields in (copy.copy(self.fields), copy.deepcopy(self.fields)):
+            self.assertEqual(self.fields, fields)
+            self.assertIsInstance(fields, encoding.ReadOnlyDict)
+
+
+
+class JSONFragmentTest(unittest.TestCase):
+    """
+    Tests for L{encoding.JSONFragment}.
+    """
+
+    def setUp(self):
+        self.fields = {u'hostname': u'foo.example.org', u'appname': u'test'}
+        self.fragment = encoding.JSONFragment(self.fields)
+
+
+    def splice(self, obj):
+        encoded = encoding.defaultEncoder.encode(obj)
+        return simplejson.loads(self.fragment.splice(encoded, obj))
+
+
+    def test_splice(self):
+        """
+        The fields are added to the encoded object.
+        """
+        result = self.splice({u'message': u'test'})
+        self.assertEqual({u'message': u'test',
+                          u'hostname': u'foo.example.org',
+                          u'appname': u'test'},
+                         result)
+
+
+    def test_spliceEmpty(self):
+        """
+        The fields are added to an encoded empty object.
+        """
+        self.assertEqual(self.fields, self.splice({}))
+
+
+    def test_spliceOverride(self):
+        """
+        Fields in the object take precedence over those in the fragment.
+        """
+        result = self.splice({u'message': u'test', u'hostname': u'bar'})
+        self.assertEqual({u'message': u'test',
+                          u'hostname': u'bar',
+                          u'appname': u'test'},
+                         result)
+
+
+    def test_spliceOverrideAll(self):
+        """
+        If all fields are overridden, the encoded object is unchanged.
+        """
+        obj = {u'hostname': u'bar', u'appname': u'other'}
+        encoded = encoding.defaultEncoder.encode(obj)
+        self.assertEqual(encoded, self.fragment.splice(encoded, obj))
+
+
+    def test_spliceOverrideCached(self):
+        """
+        Partial fragments for overridden fields are cached.
+        """
+        self.splice({u'hostname': u'bar'})
+        self.splice({u'hostname': u'baz'})
+        self.assertEqual(1, len(self.fragment._partial))
+
+
+    def test_spliceOverrideCacheBounded(self):
+        """
+        The number of cached partial fragments is bounded.
+        """
+        self.fragment.maxPartial = 1
+        self.assertEqual({u'hostname': u'bar', u'appname': u'test'},
+                         self.splice({u'hostname': u'bar'}))
+        self.assertEqual({u'hostname': u'foo.example.org',
+                          u'appname': u'other'},
+                         self.splice({u'appname': u'other'}))
+        self.assertEqual(1, len(self.fragment._partial))
+
+
+    def test_spliceNoFields(self):
+        """
+        A fragment without fields leaves the encoded object unchanged.
+        """
+        fragment = encoding.JSONFragment({})
+        self.assertEqual(b'{"a": 1}', fragment.splice(b'{"a": 1}', {u'a': 1}))
@@ -7,7 +7,7 @@ Tests for L{udplog.kafka}.
 from __future__ import division, absolute_import
 
 import simplejson
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.trial import unittest
 
 from udplog import kafka
@@ -19,8 +19,9 @@ class FakeKafkaProducer(object):
         self.produced = []
 
 
-    def send_messages(self, topic, message):
-        self.produced.append((topic, message))
+    def send_messages(self, topic, *messages):
+        for message in messages:
+            self.produced.append((topic, message))
         return True
 
 
@@ -32,7 +33,7 @@ class FakeKafkaProducer(object):
 class KafkaPublisherServiceTest(unittest.TestCase):
 
     def setUp(self):
-        self.dispatcher = Dispatcher()
+        self.dispatcher = Dispatcher(clock=task.Clock())
         self.producer = FakeKafkaProducer()
         kafka._make_producer = lambda _: self.producer
         config = {
@@ -53,6 +54,7 @@ class KafkaPublisherServiceTest(unittest.TestCase):
         yield self.publisher.startService()
         # Then
         self.dispatcher.eventReceived(event)
+        self.dispatcher.flush()
         self.assertEqual(1, len(self.producer.produced))
 
 
@@ -68,6 +70,7 @@ class KafkaPublisherServiceTest(unittest.TestCase):
         self.publisher.stopService()
         # Then
         self.dispatcher.eventReceived(event)
+        self.dispatcher.flush()
         self.assertEqual(1, len(self.producer.produced))
 
 
@@ -82,6 +85,7 @@ class KafkaPublisherServiceTest(unittest.TestCase):
         yield self.publisher.startService()
         # When
         self.dispatcher.eventReceived(event)
+        self.dispatcher.flush()
         # Then
         output = self.producer.produced[-1]
         self.assertEqual('foo', output[0])
@@ -103,6 +107,7 @@ class KafkaPublisherServiceTest(unittest.TestCase):
         yield self.publisher.startService()
         # When
         self.dispatcher.eventReceived(event)
+        self.dispatcher.flush()
         # Then
         self.assertEqual(0, len(self.producer.produced))
         self.assertEqual(1, len(self.flushLoggedErrors(TypeError)))
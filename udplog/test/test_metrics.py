@@ -0,0 +1,166 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{udplog.metrics}.
+"""
+
+from __future__ import division, absolute_import
+
+import errno
+import time
+
+from twisted.trial import unittest
+
+from udplog import metrics
+
+class EmissionMetricsTest(unittest.TestCase):
+    """
+    Tests for L{metrics.EmissionMetrics}.
+    """
+
+    def setUp(self):
+        self.now = 1000.0
+        self.patch(time, 'time', lambda: self.now)
+        self.metrics = metrics.EmissionMetrics()
+
+
+    def test_snapshotInitial(self):
+        """
+        Initially, all counters are zero.
+        """
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(0, snapshot['eventsSent'])
+        self.assertEqual(0, snapshot['datagramsSent'])
+        self.assertEqual(0, snapshot['bytesSent'])
+        self.assertEqual({}, snapshot['sendErrors'])
+        self.assertEqual(0, snapshot['failureFallbacks'])
+        self.assertEqual({}, snapshot['dropped'])
+        self.assertEqual(0, sum(snapshot['serializeTime']['counts']))
+
+
+    def test_datagramSent(self):
+        """
+        Sent datagrams are counted with their events and bytes.
+        """
+        self.metrics.datagramSent(1, 100)
+        self.metrics.datagramSent(3, 250)
+
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(4, snapshot['eventsSent'])
+        self.assertEqual(2, snapshot['datagramsSent'])
+        self.assertEqual(350, snapshot['bytesSent'])
+
+
+    def test_datagramSentMany(self):
+        """
+        Datagrams beyond the number that is queued are counted, too.
+        """
+        for _ in xrange(metrics.MAX_UNCOUNTED * 2 + 1):
+            self.metrics.datagramSent(2, 100)
+
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(metrics.MAX_UNCOUNTED * 2 + 1,
+                         snapshot['datagramsSent'])
+        self.assertEqual((metrics.MAX_UNCOUNTED * 2 + 1) * 2,
+                         snapshot['eventsSent'])
+        self.assertEqual((metrics.MAX_UNCOUNTED * 2 + 1) * 100,
+                         snapshot['bytesSent'])
+        self.assertEqual(0, len(self.metrics._uncounted))
+
+
+    def test_sendFailed(self):
+        """
+        Send errors are counted by error number.
+        """
+        self.metrics.sendFailed(errno.EMSGSIZE)
+        self.metrics.sendFailed(errno.EMSGSIZE)
+        self.metrics.sendFailed(None)
+
+        self.assertEqual({errno.EMSGSIZE: 2, None: 1},
+                         self.metrics.snapshot()['sendErrors'])
+
+
+    def test_failureSerialized(self):
+        """
+        Failure fallbacks are counted.
+        """
+        self.metrics.failureSerialized()
+        self.assertEqual(1, self.metrics.snapshot()['failureFallbacks'])
+
+
+    def test_eventsDropped(self):
+        """
+        Dropped events are counted by reason.
+        """
+        self.metrics.eventsDropped('sampling')
+        self.metrics.eventsDropped('queue', 3)
+
+        self.assertEqual({'sampling': 1, 'queue': 3},
+                         self.metrics.snapshot()['dropped'])
+
+
+    def test_eventSerialized(self):
+        """
+        Serialization times are collected in a histogram.
+        """
+        self.metrics.eventSerialized(0.000001)
+        self.metrics.eventSerialized(0.00003)
+        self.metrics.eventSerialized(10)
+
+        histogram = self.metrics.snapshot()['serializeTime']
+        bounds = histogram['bounds']
+        counts = histogram['counts']
+        self.assertEqual(len(bounds) + 1, len(counts))
+        self.assertEqual(1, counts[0])
+        self.assertEqual(1, counts[bounds.index(0.00005)])
+        self.assertEqual(1, counts[-1])
+        self.assertAlmostEqual(10.000031, histogram['total'])
+
+
+    def test_snapshotCopy(self):
+        """
+        Snapshots are not affected by later updates.
+        """
+        snapshot = self.metrics.snapshot()
+        self.metrics.eventsDropped('queue')
+        self.metrics.eventSerialized(0.001)
+
+        self.assertEqual({}, snapshot['dropped'])
+        self.assertEqual(0, sum(snapshot['serializeTime']['counts']))
+
+
+    def test_snapshotUptime(self):
+        """
+        The snapshot includes the time since the metrics were created.
+        """
+        self.now += 5
+        self.assertEqual(5, self.metrics.snapshot()['uptime'])
+
+
+    def test_reportDisabled(self):
+        """
+        Without a report interval, there are no reports.
+        """
+        self.now += 3600
+        self.assertIdentical(None, self.metrics.report(self.now))
+
+
+    def test_report(self):
+        """
+        Reports are due every report interval.
+        """
+        self.metrics = metrics.EmissionMetrics(reportInterval=60)
+        self.metrics.datagramSent(1, 100)
+
+        self.now += 30
+        self.assertIdentical(None, self.metrics.report(self.now))
+
+        self.now += 30
+        report = self.metrics.report(self.now)
+        self.assertEqual('INFO', report['logLevel'])
+        self.assertEqual(1, report['eventsSent'])
+        self.assertIn('message', report)
+
+        self.now += 1
+        self.assertIdentical(None, self.metrics.report(self.now))
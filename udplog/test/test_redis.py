@@ -10,11 +10,11 @@ from __future__ import division, absolute_import
 import simplejson
 
 from twisted.application.internet import TCPClient
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.trial import unittest
 
 from udplog import redis
-from udplog.twisted import Dispatcher
+from udplog.twisted import Dispatcher, Event
 
 class FakeRedisClient(object):
 
@@ -34,7 +34,7 @@ class FakeRedisClient(object):
 class RedisPublisherServiceTest(unittest.TestCase):
 
     def setUp(self):
-        self.dispatcher = Dispatcher()
+        self.dispatcher = Dispatcher(clock=task.Clock())
         self.client = FakeRedisClient()
         self.publisher = redis.RedisPublisher(self.dispatcher,
                                               self.client,
@@ -53,6 +53,7 @@ class RedisPublisherServiceTest(unittest.TestCase):
         self.publisher.startService()
 
         self.dispatcher.eventReceived(event)
+        self.dispatcher.flush()
         self.assertEqual(1, len(self.client.pushes))
 
 
@@ -68,6 +69,7 @@ class RedisPublisherServiceTest(unittest.TestCase):
         self.publisher.stopService()
 
         self.dispatcher.eventReceived(event)
+        self.dispatcher.flush()
         self.assertEqual(1, len(self.client.pushes))
 
 
@@ -86,6 +88,34 @@ class RedisPublisherServiceTest(unittest.TestCase):
         self.assertEqual(u'test', eventDict['message'])
 
 
+    def test_sendEvents(self):
+        """
+        A batch of events is pushed at once.
+        """
+        self.publisher.startService()
+        self.dispatcher.eventReceived({'message': u'first'})
+        self.dispatcher.eventReceived({'message': u'second'})
+        self.dispatcher.flush()
+
+        self.assertEqual(1, len(self.client.pushes))
+        key, values, _ = self.client.pushes[-1]
+        self.assertEqual([u'first', u'second'],
+                         [simplejson.loads(value)['message']
+                          for value in values])
+
+
+    def test_sendEventEncoded(self):
+        """
+        The JSON of received events is pushed without encoding them again.
+        """
+        event = Event.fromJSON('test', '{"message":"test"}')
+        self.publisher.sendEvent(event)
+
+        output = self.client.pushes[-1]
+        self.assertEqual('{"category": "test", "message":"test"}',
+                         output[1][0])
+
+
     def test_sendEventUnserializable(self):
         """
         An event that cannot be serialized is dropped and an error logged.
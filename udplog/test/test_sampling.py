@@ -0,0 +1,205 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{udplog.sampling}.
+"""
+
+from __future__ import division, absolute_import
+
+from twisted.trial import unittest
+
+from udplog import sampling
+
+class TokenBucketTest(unittest.TestCase):
+    """
+    Tests for L{sampling.TokenBucket}.
+    """
+
+    def setUp(self):
+        self.patch(sampling.time, 'time', lambda: 1000.0)
+        self.bucket = sampling.TokenBucket(2, 3)
+
+
+    def test_burst(self):
+        """
+        A full bucket accepts a burst of events.
+        """
+        self.assertEqual([True, True, True, False],
+                         [self.bucket.consume(1000.0) for _ in range(4)])
+
+
+    def test_refill(self):
+        """
+        Tokens are added at the configured rate.
+        """
+        for _ in range(3):
+            self.bucket.consume(1000.0)
+
+        self.assertFalse(self.bucket.consume(1000.25))
+        self.assertTrue(self.bucket.consume(1000.5))
+        self.assertFalse(self.bucket.consume(1000.5))
+
+
+    def test_refillLimit(self):
+        """
+        The bucket holds no more than the burst size.
+        """
+        self.assertEqual([True, True, True, False],
+                         [self.bucket.consume(2000.0) for _ in range(4)])
+
+
+    def test_burstDefault(self):
+        """
+        Without an explicit burst size, it is the same as the rate.
+        """
+        bucket = sampling.TokenBucket(5)
+        self.assertEqual(5, bucket.burst)
+
+
+
+class EventSamplerTest(unittest.TestCase):
+    """
+    Tests for L{sampling.EventSampler}.
+    """
+
+    def setUp(self):
+        self.now = 1000.0
+        self.patch(sampling.time, 'time', lambda: self.now)
+        self.random = 0.5
+        self.patch(sampling.random, 'random', lambda: self.random)
+
+
+    def test_acceptNoRules(self):
+        """
+        Without rules, all events are accepted unaltered.
+        """
+        sampler = sampling.EventSampler()
+        eventDict = {'message': 'test'}
+        self.assertTrue(sampler.accept('test', eventDict))
+        self.assertEqual({'message': 'test'}, eventDict)
+
+
+    def test_sampleAccepted(self):
+        """
+        Sampled events that are accepted carry the sample rate.
+        """
+        sampler = sampling.EventSampler(sampleRates={'test': 0.75})
+        eventDict = {}
+        self.assertTrue(sampler.accept('test', eventDict))
+        self.assertEqual(0.75, eventDict['sampleRate'])
+
+
+    def test_sampleRejected(self):
+        """
+        Events are rejected with the complement of the sample rate.
+        """
+        sampler = sampling.EventSampler(sampleRates={'test': 0.25})
+        eventDict = {}
+        self.assertFalse(sampler.accept('test', eventDict))
+        self.assertNotIn('sampleRate', eventDict)
+
+
+    def test_sampleOtherCategory(self):
+        """
+        Sample rates only apply to their category.
+        """
+        sampler = sampling.EventSampler(sampleRates={'test': 0})
+        eventDict = {}
+        self.assertTrue(sampler.accept('other', eventDict))
+        self.assertNotIn('sampleRate', eventDict)
+
+
+    def test_sampleRateOne(self):
+        """
+        With a sample rate of 1, events do not get a sample rate.
+        """
+        sampler = sampling.EventSampler(sampleRates={'test': 1})
+        eventDict = {}
+        self.assertTrue(sampler.accept('test', eventDict))
+        self.assertNotIn('sampleRate', eventDict)
+
+
+    def test_sampleLogLevel(self):
+        """
+        A rule for category and log level takes precedence.
+        """
+        sampler = sampling.EventSampler(sampleRates={'test': 0,
+                                                     ('test', 'ERROR'): 1})
+        self.assertTrue(sampler.accept('test', {'logLevel': 'ERROR'}))
+        self.assertFalse(sampler.accept('test', {'logLevel': 'INFO'}))
+        self.assertFalse(sampler.accept('test', {}))
+
+
+    def test_rateLimit(self):
+        """
+        Events over the rate limit are rejected.
+        """
+        sampler = sampling.EventSampler(rateLimits={'test': (1, 2)})
+        self.assertEqual([True, True, False],
+                         [sampler.accept('test', {}) for _ in range(3)])
+
+        self.now += 1
+        self.assertTrue(sampler.accept('test', {}))
+
+
+    def test_rateLimitLogLevel(self):
+        """
+        Every rule has its own token bucket.
+        """
+        sampler = sampling.EventSampler(rateLimits={'test': (1, 1),
+                                                    ('test', 'ERROR'): (1, 1)})
+        self.assertTrue(sampler.accept('test', {'logLevel': 'INFO'}))
+        self.assertFalse(sampler.accept('test', {'logLevel': 'INFO'}))
+        self.assertTrue(sampler.accept('test', {'logLevel': 'ERROR'}))
+
+
+    def test_report(self):
+        """
+        Rejected events are reported per category.
+        """
+        sampler = sampling.EventSampler(sampleRates={'sampled': 0},
+                                        rateLimits={'limited': (1, 1)},
+                                        reportInterval=10)
+        for _ in range(3):
+            sampler.accept('sampled', {})
+            sampler.accept('limited', {})
+
+        self.now += 10
+        report = sampler.report(self.now)
+
+        self.assertEqual({'sampled': 3}, report['sampledOut'])
+        self.assertEqual({'limited': 2}, report['rateLimited'])
+        self.assertEqual(10, report['interval'])
+        self.assertEqual('WARNING', report['logLevel'])
+        self.assertEqual("Dropped 5 events by sampling and rate limiting",
+                         report['message'])
+
+
+    def test_reportNotDue(self):
+        """
+        No report is made before the interval has passed.
+        """
+        sampler = sampling.EventSampler(sampleRates={'sampled': 0},
+                                        reportInterval=10)
+        sampler.accept('sampled', {})
+        self.assertIdentical(None, sampler.report(self.now + 5))
+
+
+    def test_reportReset(self):
+        """
+        Counts are reset after a report.
+        """
+        sampler = sampling.EventSampler(sampleRates={'sampled': 0},
+                                        reportInterval=10)
+        sampler.accept('sampled', {})
+        sampler.report(self.now + 10)
+        self.assertIdentical(None, sampler.report(self.now + 20))
+
+
+    def test_reportNothingRejected(self):
+        """
+        No report is made if no events were rejected.
+        """
+        sampler = sampling.EventSampler(reportInterval=10)
+        self.assertIdentical(None, sampler.report(self.now + 10))
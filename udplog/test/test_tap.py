@@ -0,0 +1,221 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{udplog.tap}.
+"""
+
+from __future__ import division, absolute_import
+
+import os
+import socket
+
+from twisted.application import internet
+from twisted.internet import defer, error
+from twisted.trial import unittest
+
+from udplog import tap, twisted
+
+class MakeServerServiceTest(unittest.TestCase):
+    """
+    Tests for L{tap.makeServerService}.
+    """
+
+    def makeService(self, *args):
+        config = tap.Options()
+        config.parseOptions(['--udplog-interface=127.0.0.1',
+                             '--udplog-port=0'] + list(args))
+        return tap.makeServerService(config)
+
+
+    def startService(self, service):
+        service.privilegedStartService()
+        service.startService()
+
+
+    def protocols(self, service):
+        """
+        Get the UDPLog protocols of the servers of a service, by type.
+        """
+        return dict((type(server), server.kwargs['protocol'])
+                    for server in service
+                    if isinstance(server.kwargs.get('protocol'),
+                                  twisted.UDPLogProtocol))
+
+
+    def test_defaults(self):
+        """
+        By default, there is only a UDP server.
+        """
+        service = self.makeService()
+        protocols = self.protocols(service)
+
+        self.assertEqual([internet.UDPServer], protocols.keys())
+
+
+    def test_unixSocket(self):
+        """
+        With a UNIX socket, there is also a server listening on it, that
+        dispatches to the same dispatcher.
+        """
+        path = self.mktemp()
+        service = self.makeService('--udplog-unix-socket=' + path)
+        protocols = self.protocols(service)
+
+        self.assertEqual(set([internet.UDPServer, tap.UNIXDatagramServer]),
+                         set(protocols))
+        server, = [server for server in service
+                   if isinstance(server, tap.UNIXDatagramServer)]
+        self.assertEqual(path, server.kwargs['address'])
+        self.assertIdentical(
+            protocols[internet.UDPServer].callback.__self__,
+            protocols[tap.UNIXDatagramServer].callback.__self__)
+
+
+    def test_unixSocketNotPrimary(self):
+        """
+        Only the primary process listens on the UNIX socket.
+        """
+        config = tap.Options()
+        config.parseOptions(['--udplog-unix-socket=' + self.mktemp()])
+        service = tap.makeServerService(config, primary=False)
+
+        self.assertEqual([internet.UDPServer],
+                         self.protocols(service).keys())
+
+
+    def test_restoreTracebacksDefault(self):
+        """
+        By default, tracebacks are not restored.
+        """
+        service = self.makeService()
+        protocol, = self.protocols(service).values()
+        self.assertIdentical(None, protocol.tracebacks)
+
+
+    def test_restoreTracebacks(self):
+        """
+        With restoring tracebacks, the servers share a traceback cache of
+        the configured size.
+        """
+        service = self.makeService('--udplog-restore-tracebacks',
+                                   '--udplog-traceback-cache-size=50',
+                                   '--udplog-unix-socket=' + self.mktemp())
+        tracebacks = [protocol.tracebacks
+                      for protocol in self.protocols(service).values()]
+
+        self.assertIsInstance(tracebacks[0], twisted.TracebackCache)
+        self.assertEqual(50, tracebacks[0].maxSize)
+        self.assertIdentical(tracebacks[0], tracebacks[1])
+        self.assertIn('tracebacksRestored', service.stats())
+
+
+    def test_tracebackCacheSizeDefault(self):
+        """
+        The traceback cache holds 1000 tracebacks by default.
+        """
+        service = self.makeService('--udplog-restore-tracebacks')
+        protocol, = self.protocols(service).values()
+        self.assertEqual(1000, protocol.tracebacks.maxSize)
+
+
+    def test_batchDelayDefault(self):
+        """
+        By default, the dispatcher does not delay batches.
+        """
+        service = self.makeService()
+        protocol, = self.protocols(service).values()
+        self.assertEqual(0, protocol.callback.__self__.batchDelay)
+
+
+    def test_batchDelay(self):
+        """
+        The batch delay is passed on to the dispatcher.
+        """
+        service = self.makeService('--udplog-batch-delay=0.05')
+        protocol, = self.protocols(service).values()
+        self.assertEqual(0.05, protocol.callback.__self__.batchDelay)
+
+
+    def test_lazyDefault(self):
+        """
+        By default, events are decoded right away.
+        """
+        service = self.makeService()
+        protocol, = self.protocols(service).values()
+        self.assertFalse(protocol.lazy)
+
+
+    def test_lazy(self):
+        """
+        In lazy mode, all UDPLog servers defer decoding events.
+        """
+        service = self.makeService('--udplog-lazy',
+                                   '--udplog-unix-socket=' + self.mktemp())
+        protocols = self.protocols(service).values()
+
+        self.assertEqual(2, len(protocols))
+        for protocol in protocols:
+            self.assertTrue(protocol.lazy)
+
+
+    def test_unixSocketRestart(self):
+        """
+        The UNIX datagram socket left behind by a stopped server is replaced
+        when starting the server again.
+        """
+        path = self.mktemp()
+        service = self.makeService('--udplog-unix-socket=' + path)
+        self.startService(service)
+        d = defer.maybeDeferred(service.stopService)
+
+        def restart(_):
+            self.assertTrue(os.path.exists(path))
+            service = self.makeService('--udplog-unix-socket=' + path)
+            self.startService(service)
+            self.addCleanup(service.stopService)
+
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.addCleanup(client.close)
+            client.connect(path)
+        d.addCallback(restart)
+        return d
+
+
+    def test_unixSocketInUse(self):
+        """
+        The UNIX datagram socket of a running server is not replaced.
+        """
+        path = self.mktemp()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(path)
+
+        service = self.makeService('--udplog-unix-socket=' + path)
+        self.assertRaises(error.CannotListenError, self.startService,
+                          service)
+        self.addCleanup(service.stopService)
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(client.close)
+        client.connect(path)
+        client.send(b'test:\t{}')
+        self.assertEqual(b'test:\t{}', server.recv(1024))
+
+
+    def test_unixSocketRegularFile(self):
+        """
+        A regular file at the path of the UNIX datagram socket is not
+        removed.
+        """
+        path = self.mktemp()
+        with open(path, 'w') as f:
+            f.write('data')
+
+        service = self.makeService('--udplog-unix-socket=' + path)
+        self.assertRaises(error.CannotListenError, self.startService,
+                          service)
+        self.addCleanup(service.stopService)
+
+        with open(path) as f:
+            self.assertEqual('data', f.read())
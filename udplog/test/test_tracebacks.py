@@ -0,0 +1,162 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{udplog.tracebacks}.
+"""
+
+from __future__ import division, absolute_import
+
+from twisted.trial import unittest
+
+from udplog import tracebacks
+
+TRACEBACK = """Traceback (most recent call last):
+  File "/srv/example/web.py", line 123, in render
+    return self.lookup(request.args['id'])
+  File "/srv/example/web.py", line 45, in lookup
+    return self.items[key]
+KeyError: '%s'
+"""
+
+OTHER_TRACEBACK = """Traceback (most recent call last):
+  File "/srv/example/web.py", line 123, in render
+    return self.lookup(request.args['id'])
+  File "/srv/example/web.py", line 47, in lookup
+    return self.items[key]
+KeyError: 'abc'
+"""
+
+class FingerprintTest(unittest.TestCase):
+    """
+    Tests for L{tracebacks.fingerprint}.
+    """
+
+    def test_sameFrames(self):
+        """
+        Tracebacks through the same frames have the same fingerprint.
+        """
+        self.assertEqual(tracebacks.fingerprint(TRACEBACK % 'abc', 'KeyError'),
+                         tracebacks.fingerprint(TRACEBACK % 'def', 'KeyError'))
+
+
+    def test_otherFrames(self):
+        """
+        Tracebacks through different frames have different fingerprints.
+        """
+        self.assertNotEqual(
+            tracebacks.fingerprint(TRACEBACK % 'abc', 'KeyError'),
+            tracebacks.fingerprint(OTHER_TRACEBACK, 'KeyError'))
+
+
+    def test_otherType(self):
+        """
+        Tracebacks of different exception types have different fingerprints.
+        """
+        self.assertNotEqual(
+            tracebacks.fingerprint(TRACEBACK % 'abc', 'KeyError'),
+            tracebacks.fingerprint(TRACEBACK % 'abc', 'IndexError'))
+
+
+    def test_noFrames(self):
+        """
+        Traceback text without frames is fingerprinted as a whole.
+        """
+        self.assertNotEqual(tracebacks.fingerprint(u'KeyError: abc'),
+                            tracebacks.fingerprint(u'KeyError: def'))
+
+
+    def test_unicode(self):
+        """
+        Unicode and UTF-8 encoded tracebacks have the same fingerprint.
+        """
+        text = TRACEBACK % u'\u2603'
+        self.assertEqual(tracebacks.fingerprint(text, u'KeyError'),
+                         tracebacks.fingerprint(text.encode('utf-8'),
+                                                b'KeyError'))
+
+
+    def test_format(self):
+        """
+        The fingerprint is 16 hexadecimal digits.
+        """
+        self.assertRegexpMatches(tracebacks.fingerprint(TRACEBACK % 'abc'),
+                                 r'^[0-9a-f]{16}$')
+
+
+
+class TracebackFilterTest(unittest.TestCase):
+    """
+    Tests for L{tracebacks.TracebackFilter}.
+    """
+
+    def setUp(self):
+        self.filter = tracebacks.TracebackFilter(limit=2, window=60,
+                                                 maxFingerprints=2)
+
+
+    def filterEvents(self, excText, now, count=1):
+        events = []
+        for _ in xrange(count):
+            eventDict = {'message': 'test',
+                         'excType': 'KeyError',
+                         'excText': excText}
+            self.filter.filter(eventDict, now)
+            events.append(eventDict)
+        return events
+
+
+    def test_limit(self):
+        """
+        Tracebacks are kept the first C{limit} times in a window.
+        """
+        events = self.filterEvents(TRACEBACK % 'abc', 1000, 4)
+
+        self.assertEqual([True, True, False, False],
+                         ['excText' in event for event in events])
+        self.assertEqual([3, 4], [event['excRepeated']
+                                  for event in events[2:]])
+        self.assertEqual(1, len(set(event['excFingerprint']
+                                    for event in events)))
+
+
+    def test_window(self):
+        """
+        After the window, tracebacks are sent in full again.
+        """
+        self.filterEvents(TRACEBACK % 'abc', 1000, 3)
+        events = self.filterEvents(TRACEBACK % 'abc', 1060)
+
+        self.assertIn('excText', events[0])
+        self.assertNotIn('excRepeated', events[0])
+
+
+    def test_distinct(self):
+        """
+        Distinct tracebacks are counted separately.
+        """
+        self.filterEvents(TRACEBACK % 'abc', 1000, 3)
+        events = self.filterEvents(OTHER_TRACEBACK, 1000)
+
+        self.assertIn('excText', events[0])
+
+
+    def test_maxFingerprints(self):
+        """
+        If full, the least recently seen fingerprint is forgotten.
+        """
+        self.filterEvents(TRACEBACK % 'abc', 1000, 2)
+        self.filterEvents(OTHER_TRACEBACK, 1000)
+        self.filterEvents(u'KeyError: abc', 1000)
+        events = self.filterEvents(TRACEBACK % 'abc', 1000)
+
+        self.assertIn('excText', events[0])
+
+
+    def test_noTraceback(self):
+        """
+        Events without traceback text are left alone.
+        """
+        eventDict = {'message': 'test'}
+        self.filter.filter(eventDict, 1000)
+        self.assertEqual({'message': 'test'}, eventDict)
@@ -8,8 +8,11 @@ Tests for L{udplog.twisted}.
 
 from __future__ import division, absolute_import
 
+import copy
 import logging
 
+import simplejson
+
 from zope.interface import verify
 
 from twisted.internet import defer
@@ -19,6 +22,7 @@ from twisted.python import failure
 from twisted.python import log
 from twisted.trial import unittest
 
+from udplog import compression
 from udplog import twisted
 from udplog import udplog
 
@@ -235,6 +239,246 @@ class TwistedLogHandlerTest(unittest.TestCase):
 
 
 
+class EventTest(unittest.TestCase):
+    """
+    Tests for L{twisted.Event} and L{twisted.encodeEvent}.
+    """
+
+    def test_fromJSON(self):
+        """
+        The event holds the decoded fields and the category.
+        """
+        event = twisted.Event.fromJSON('test', '{"message": "a"}')
+        self.assertEqual({'category': 'test', 'message': 'a'}, event)
+
+
+    def test_fromJSONNotDict(self):
+        """
+        If the JSON does not encode a dictionary, TypeError is raised.
+        """
+        self.assertRaises(TypeError, twisted.Event.fromJSON, 'test', '[1]')
+
+
+    def test_toJSON(self):
+        """
+        The original JSON is reused, with the category added.
+        """
+        event = twisted.Event.fromJSON('test', '{"message":   "a"}')
+        self.assertEqual('{"category": "test", "message":   "a"}',
+                         event.toJSON())
+        self.assertEqual('{"message":   "a"}',
+                         event.toJSON(withCategory=False))
+
+
+    def test_toJSONEmpty(self):
+        """
+        An empty event dictionary is encoded with just the category.
+        """
+        event = twisted.Event.fromJSON('test', '{ }')
+        self.assertEqual({'category': 'test'},
+                         simplejson.loads(event.toJSON()))
+
+
+    def test_toJSONUTF8(self):
+        """
+        Non-ASCII text in the original JSON is passed on as is.
+        """
+        data = u'{"message": "\u2603"}'.encode('utf-8')
+        event = twisted.Event.fromJSON('test', data)
+        self.assertEqual(u'\u2603',
+                         simplejson.loads(event.toJSON())['message'])
+
+
+    def test_toJSONCached(self):
+        """
+        The encoding is cached.
+        """
+        event = twisted.Event.fromJSON('test', '{"message": "a"}')
+        self.assertIdentical(event.toJSON(), event.toJSON())
+
+
+    def test_toJSONCategoryField(self):
+        """
+        If the original JSON has a category field, it is replaced.
+        """
+        event = twisted.Event.fromJSON('test', '{"category": "other"}')
+        self.assertEqual({'category': 'test'},
+                         simplejson.loads(event.toJSON()))
+        self.assertEqual({}, simplejson.loads(event.toJSON(False)))
+
+
+    def test_modified(self):
+        """
+        Modifying the event discards the cached encodings.
+        """
+        modifications = [
+            lambda event: event.__setitem__('message', 'b'),
+            lambda event: event.__delitem__('message'),
+            lambda event: event.pop('message'),
+            lambda event: event.popitem(),
+            lambda event: event.setdefault('extra', 1),
+            lambda event: event.update(extra=1),
+            lambda event: event.clear(),
+            ]
+
+        for modify in modifications:
+            event = twisted.Event.fromJSON('test', '{"message": "a"}')
+            event.toJSON()
+            modify(event)
+            self.assertEqual(dict(event), simplejson.loads(event.toJSON()))
+
+
+    def test_copy(self):
+        """
+        A modified copy does not affect the encoding of the original.
+        """
+        event = twisted.Event.fromJSON('test', '{"message": "a"}')
+        encoded = event.toJSON()
+        other = copy.copy(event)
+        other['message'] = 'b'
+
+        self.assertEqual(encoded, event.toJSON())
+        self.assertEqual('b', simplejson.loads(other.toJSON())['message'])
+
+
+    def test_encodeEventDict(self):
+        """
+        Plain dictionaries are encoded, optionally without category.
+        """
+        event = {'category': 'test', 'message': 'a'}
+        self.assertEqual(event, simplejson.loads(twisted.encodeEvent(event)))
+        self.assertEqual({'message': 'a'},
+                         simplejson.loads(twisted.encodeEvent(event, False)))
+        self.assertIn('category', event)
+
+
+
+class LazyEventTest(unittest.TestCase):
+    """
+    Tests for L{twisted.LazyEvent}.
+    """
+
+    def setUp(self):
+        self.malformed = []
+
+
+    def makeEvent(self, data):
+        return twisted.LazyEvent('test', data,
+                                 lambda: self.malformed.append(None))
+
+
+    def test_category(self):
+        """
+        The category is available without decoding.
+        """
+        event = self.makeEvent('{"message": "a"}')
+        self.assertEqual('test', event['category'])
+        self.assertIdentical(None, event._event)
+
+
+    def test_fields(self):
+        """
+        Other fields are decoded on first access.
+        """
+        event = self.makeEvent('{"message": "a"}')
+        self.assertEqual('a', event['message'])
+        self.assertEqual({'category': 'test', 'message': 'a'}, dict(event))
+        self.assertEqual(2, len(event))
+
+
+    def test_modify(self):
+        """
+        The event can be modified, changing its encoding.
+        """
+        event = self.makeEvent('{"message": "a"}')
+        event['message'] = 'b'
+        del event['category']
+
+        self.assertEqual({'message': 'b'}, simplejson.loads(event.toJSON()))
+
+
+    def test_toJSON(self):
+        """
+        Without decoding, the original JSON is reused.
+        """
+        event = self.makeEvent('{"message": "a"}')
+
+        self.assertEqual('{"category": "test", "message": "a"}',
+                         twisted.encodeEvent(event))
+        self.assertEqual('{"message": "a"}',
+                         twisted.encodeEvent(event, withCategory=False))
+        self.assertIdentical(None, event._event)
+
+
+    def test_toJSONCategoryField(self):
+        """
+        If the original JSON has a category field, it is replaced.
+        """
+        event = self.makeEvent('{"category": "other"}')
+        self.assertEqual({}, simplejson.loads(event.toJSON(False)))
+
+
+    def test_truncated(self):
+        """
+        JSON that is not enclosed in braces is rejected right away.
+        """
+        self.assertRaises(ValueError, self.makeEvent, '{"message": "a"')
+        self.assertRaises(ValueError, self.makeEvent, '3')
+
+
+    def test_malformed(self):
+        """
+        Malformed JSON is detected on access, and counted once.
+        """
+        event = self.makeEvent('{"message": }')
+
+        self.assertRaises(ValueError, event.get, 'message')
+        self.assertRaises(ValueError, event.get, 'message')
+        self.assertEqual(1, len(self.malformed))
+
+
+    def test_toJSONNotDecoded(self):
+        """
+        Serializing the original JSON does not parse it.
+        """
+        def loads(*args, **kwargs):
+            self.fail("Parsed")
+        self.patch(twisted.simplejson, 'loads', loads)
+
+        event = self.makeEvent(' {"message": "a"}\n')
+        self.assertEqual('{"category": "test", "message": "a"}',
+                         twisted.encodeEvent(event))
+        self.assertEqual('{"message": "a"}',
+                         twisted.encodeEvent(event, withCategory=False))
+        self.assertIdentical(None, event._event)
+
+
+    def test_malformedToJSON(self):
+        """
+        Malformed JSON is passed on as is, and only counted once decoded.
+        """
+        event = self.makeEvent('{"message": }')
+
+        self.assertEqual('{"message": }',
+                         twisted.encodeEvent(event, withCategory=False))
+        self.assertEqual(0, len(self.malformed))
+
+        self.assertRaises(ValueError, event.get, 'message')
+        self.assertEqual(1, len(self.malformed))
+
+
+    def test_copy(self):
+        """
+        A modified copy does not affect the original.
+        """
+        event = self.makeEvent('{"message": "a"}')
+        other = copy.copy(event)
+        other['message'] = 'b'
+
+        self.assertEqual('a', event['message'])
+
+
+
 class UDPLogProtocolTest(unittest.TestCase):
     """
     Tests for L{udplog.twisted.UDPLogProtocol}.
@@ -257,6 +501,20 @@ class UDPLogProtocolTest(unittest.TestCase):
 
         self.assertEqual('test_category', event.get('category'))
         self.assertEqual('value', event.get('key'))
+        self.assertEqual('{"category": "test_category", "key": "value"}',
+                         twisted.encodeEvent(event))
+
+
+    def test_datagramReceivedMultiline(self):
+        """
+        A single event with JSON spread over multiple lines is received.
+        """
+        datagram = 'test_category: {\n    "key": "value",\n    "n": 1\n}\n'
+        self.protocol.datagramReceived(datagram, None)
+
+        self.assertEqual(1, len(self.events))
+        self.assertEqual('value', self.events[-1]['key'])
+        self.assertEqual(0, self.protocol.malformed)
 
 
     def test_datagramReceivedNoMsg(self):
@@ -286,6 +544,475 @@ class UDPLogProtocolTest(unittest.TestCase):
         self.assertEqual(1, len(self.flushLoggedErrors(TypeError)))
 
 
+    def test_datagramReceivedMalformed(self):
+        """
+        Events that cannot be decoded are counted.
+        """
+        self.protocol.datagramReceived("""test_category:\t{"key":""", None)
+        self.protocol.datagramReceived("""test_category""", None)
+        self.assertEqual(2, self.protocol.malformed)
+        self.flushLoggedErrors(ValueError)
+
+
+    def test_datagramReceivedLazy(self):
+        """
+        In lazy mode, events are passed on undecoded.
+        """
+        self.protocol.lazy = True
+        datagram = """test_category:\t{"key": "value"}"""
+        self.protocol.datagramReceived(datagram, None)
+
+        event = self.events[-1]
+        self.assertIsInstance(event, twisted.LazyEvent)
+        self.assertEqual('{"category": "test_category", "key": "value"}',
+                         twisted.encodeEvent(event))
+        self.assertEqual('value', event['key'])
+
+
+    def test_datagramReceivedLazyMalformed(self):
+        """
+        In lazy mode, malformed events are counted when decoded.
+        """
+        self.protocol.lazy = True
+        self.protocol.datagramReceived("""test_category:\t{"key"}""", None)
+        self.assertEqual(0, self.protocol.malformed)
+
+        self.assertRaises(ValueError, self.events[-1].get, 'key')
+        self.assertEqual(1, self.protocol.malformed)
+
+
+    def test_datagramReceivedLazyTruncated(self):
+        """
+        In lazy mode, truncated events are counted and logged right away.
+        """
+        self.protocol.lazy = True
+        self.protocol.datagramReceived("""test_category:\t{"key":""", None)
+
+        self.assertEqual([], self.events)
+        self.assertEqual(1, self.protocol.malformed)
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+
+
+    def test_datagramReceivedLazySequence(self):
+        """
+        In lazy mode, events with sequence numbers are still tracked.
+        """
+        self.protocol.lazy = True
+        datagram = """test_category:\t{"senderId": "a", "sequence": 0}"""
+        self.protocol.datagramReceived(datagram, None)
+
+        self.assertIsInstance(self.events[-1], twisted.Event)
+        self.assertEqual(1, self.protocol.tracker.received)
+
+
+
+    def test_datagramReceivedMultiple(self):
+        """
+        A datagram can hold multiple events separated by newlines.
+        """
+        datagram = ("""test_category:\t{"key": "value1"}\n"""
+                    """test_category:\t{"key": "value2"}""")
+        self.protocol.datagramReceived(datagram, None)
+
+        self.assertEqual(2, len(self.events))
+        self.assertEqual('value1', self.events[0].get('key'))
+        self.assertEqual('value2', self.events[1].get('key'))
+
+
+    def test_datagramReceivedMultipleInvalid(self):
+        """
+        An invalid event in a datagram does not affect the others.
+        """
+        datagram = ("""test_category:\t{"key": "value1"}\n"""
+                    """test_category:\t{"key":"value\n"""
+                    """test_category:\t{"key": "value2"}""")
+        self.protocol.datagramReceived(datagram, None)
+
+        self.assertEqual(2, len(self.events))
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+
+
+    def test_datagramReceivedChunked(self):
+        """
+        Chunked datagrams are reassembled before decoding.
+        """
+        datagram = ("""test_category:\t{"key": "%s"}""" % ('a' * 200,))
+        chunks = udplog.chunkDatagram(datagram, 1, 100)
+        for chunk in chunks[:-1]:
+            self.protocol.datagramReceived(chunk, None)
+        self.assertEqual(0, len(self.events))
+
+        self.protocol.datagramReceived(chunks[-1], None)
+        self.assertEqual(1, len(self.events))
+        self.assertEqual('a' * 200, self.events[-1].get('key'))
+
+
+    def test_datagramReceivedCompressed(self):
+        """
+        Compressed datagrams are decompressed before decoding.
+        """
+        datagram = ("""test_category:\t{"key": "value1"}\n"""
+                    """test_category:\t{"key": "value2"}""")
+        self.protocol.datagramReceived(compression.compress(datagram), None)
+
+        self.assertEqual(2, len(self.events))
+        self.assertEqual('value1', self.events[0].get('key'))
+        self.assertEqual('value2', self.events[1].get('key'))
+
+
+    def test_datagramReceivedCompressedChunked(self):
+        """
+        Chunked compressed datagrams are reassembled and decompressed.
+        """
+        datagram = ("""test_category:\t{"key": "%s"}""" % ('a' * 200,))
+        compressed = compression.compress(datagram)
+        for chunk in udplog.chunkDatagram(compressed, 1, 20):
+            self.protocol.datagramReceived(chunk, None)
+
+        self.assertEqual(1, len(self.events))
+        self.assertEqual('a' * 200, self.events[-1].get('key'))
+
+
+    def test_datagramReceivedCompressedInvalid(self):
+        """
+        An invalid compressed datagram is logged.
+        """
+        self.protocol.datagramReceived(compression.MAGIC + b'\xff', None)
+        self.assertEqual(0, len(self.events))
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+
+
+    def test_datagramReceivedChunkMalformed(self):
+        """
+        A malformed chunk is logged.
+        """
+        self.protocol.datagramReceived(udplog.CHUNK_MAGIC + b'\x00', None)
+        self.assertEqual(0, len(self.events))
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+
+
+    def test_datagramReceivedSequence(self):
+        """
+        Events with sequence numbers are accounted for by the tracker.
+        """
+        datagram = ("""test:\t{"senderId": "a", "sequence": 0}\n"""
+                    """test:\t{"senderId": "a", "sequence": 2}""")
+        self.protocol.datagramReceived(datagram, None)
+
+        self.assertEqual(2, len(self.events))
+        self.assertEqual(2, self.protocol.tracker.received)
+        self.assertEqual(1, self.protocol.tracker.lost)
+
+
+    def test_trackerShared(self):
+        """
+        A tracker can be passed to share it between protocols.
+        """
+        tracker = twisted.SequenceTracker()
+        protocol = twisted.UDPLogProtocol(self.events.append,
+                                          tracker=tracker)
+        self.assertIdentical(tracker, protocol.tracker)
+
+
+
+    def test_datagramReceivedTracebacks(self):
+        """
+        If set, the traceback cache restores left out traceback text.
+        """
+        protocol = twisted.UDPLogProtocol(
+            self.events.append, tracebacks=twisted.TracebackCache())
+        datagram = ("""test:\t{"excFingerprint": "a", "excText": "tb"}\n"""
+                    """test:\t{"excFingerprint": "a", "excRepeated": 2}""")
+        protocol.datagramReceived(datagram, None)
+
+        self.assertEqual('tb', self.events[1].get('excText'))
+
+
+
+class SequenceTrackerTest(unittest.TestCase):
+    """
+    Tests for L{udplog.twisted.SequenceTracker}.
+    """
+
+    def setUp(self):
+        self.tracker = twisted.SequenceTracker(maxSenders=2, window=3)
+
+
+    def receive(self, senderId, *sequences):
+        for sequence in sequences:
+            self.tracker.eventReceived({'senderId': senderId,
+                                        'sequence': sequence})
+
+
+    def test_inOrder(self):
+        """
+        Consecutive sequence numbers are received without loss.
+        """
+        self.receive('a', 5, 6, 7)
+        snapshot = self.tracker.snapshot()
+        self.assertEqual(3, snapshot['received'])
+        self.assertEqual(0, snapshot['lost'])
+        self.assertEqual(0.0, snapshot['lossRate'])
+
+
+    def test_gap(self):
+        """
+        Missing sequence numbers count as lost.
+        """
+        self.receive('a', 0, 1, 4)
+        snapshot = self.tracker.snapshot()
+        self.assertEqual(3, snapshot['received'])
+        self.assertEqual(2, snapshot['lost'])
+        self.assertEqual(2 / 5, snapshot['lossRate'])
+
+
+    def test_reordered(self):
+        """
+        Missing sequence numbers that arrive late count as reordered.
+        """
+        self.receive('a', 0, 2, 1)
+        snapshot = self.tracker.snapshot()
+        self.assertEqual(0, snapshot['lost'])
+        self.assertEqual(1, snapshot['reordered'])
+        self.assertEqual(0, snapshot['duplicates'])
+
+
+    def test_duplicate(self):
+        """
+        Sequence numbers received before count as duplicates.
+        """
+        self.receive('a', 0, 1, 1, 0)
+        snapshot = self.tracker.snapshot()
+        self.assertEqual(0, snapshot['lost'])
+        self.assertEqual(2, snapshot['duplicates'])
+
+
+    def test_window(self):
+        """
+        Only the most recent missing sequence numbers are remembered.
+        """
+        self.receive('a', 0, 10, 1, 9)
+        snapshot = self.tracker.snapshot()
+        self.assertEqual(8, snapshot['lost'])
+        self.assertEqual(1, snapshot['reordered'])
+        self.assertEqual(1, snapshot['duplicates'])
+
+
+    def test_senders(self):
+        """
+        Sequence numbers are tracked per sender.
+        """
+        self.receive('a', 0)
+        self.receive('b', 5)
+        self.receive('a', 1)
+        self.receive('b', 6)
+        snapshot = self.tracker.snapshot()
+        self.assertEqual(2, snapshot['senders'])
+        self.assertEqual(0, snapshot['lost'])
+
+
+    def test_evict(self):
+        """
+        If the table is full, the least recently seen sender is evicted.
+        """
+        self.receive('a', 0)
+        self.receive('b', 0)
+        self.receive('a', 1)
+        self.receive('c', 0)
+        self.receive('b', 2)
+        snapshot = self.tracker.snapshot()
+        self.assertEqual(2, snapshot['evicted'])
+        self.assertEqual(0, snapshot['lost'])
+
+
+    def test_noSequence(self):
+        """
+        Events without a sender identifier or sequence number are ignored.
+        """
+        self.tracker.eventReceived({'message': 'test'})
+        self.tracker.eventReceived({'senderId': 'a'})
+        self.tracker.eventReceived({'senderId': 'a', 'sequence': '1'})
+        self.assertEqual(0, self.tracker.snapshot()['received'])
+
+
+
+class ChunkReassemblerTest(unittest.TestCase):
+    """
+    Tests for L{udplog.twisted.ChunkReassembler}.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.reassembler = twisted.ChunkReassembler(timeout=5, maxPending=2,
+                                                    clock=self.clock)
+        self.datagram = b'test:\t{"key": "%s"}' % (b'a' * 200,)
+
+
+    def test_inOrder(self):
+        """
+        Chunks received in order are reassembled.
+        """
+        chunks = udplog.chunkDatagram(self.datagram, 1, 100)
+        results = [self.reassembler.chunkReceived(chunk, None)
+                   for chunk in chunks]
+        self.assertEqual([None] * (len(chunks) - 1) + [self.datagram],
+                         results)
+
+
+    def test_outOfOrder(self):
+        """
+        Chunks received out of order are reassembled.
+        """
+        chunks = udplog.chunkDatagram(self.datagram, 1, 100)
+        for chunk in reversed(chunks[1:]):
+            self.assertIdentical(None,
+                                 self.reassembler.chunkReceived(chunk, None))
+        self.assertEqual(self.datagram,
+                         self.reassembler.chunkReceived(chunks[0], None))
+
+
+    def test_duplicate(self):
+        """
+        Duplicate chunks do not complete a datagram.
+        """
+        chunks = udplog.chunkDatagram(self.datagram, 1, 100)
+        self.reassembler.chunkReceived(chunks[0], None)
+        self.assertIdentical(None,
+                             self.reassembler.chunkReceived(chunks[0], None))
+
+
+    def test_interleaved(self):
+        """
+        Chunks of different datagrams are kept apart.
+        """
+        chunks1 = udplog.chunkDatagram(self.datagram, 1, 100)
+        chunks2 = udplog.chunkDatagram(self.datagram.upper(), 2, 100)
+        results = []
+        for chunk1, chunk2 in zip(chunks1, chunks2):
+            results.append(self.reassembler.chunkReceived(chunk1, None))
+            results.append(self.reassembler.chunkReceived(chunk2, None))
+        self.assertEqual([self.datagram, self.datagram.upper()],
+                         [result for result in results if result])
+
+
+    def test_sender(self):
+        """
+        Chunks from different senders are kept apart.
+        """
+        chunks = udplog.chunkDatagram(self.datagram, 1, 100)
+        self.reassembler.chunkReceived(chunks[0], ('127.0.0.1', 1))
+        for chunk in chunks[1:]:
+            self.assertIdentical(
+                None,
+                self.reassembler.chunkReceived(chunk, ('127.0.0.1', 2)))
+
+
+    def test_timeout(self):
+        """
+        Incomplete datagrams are discarded after the timeout.
+        """
+        chunks = udplog.chunkDatagram(self.datagram, 1, 100)
+        self.reassembler.chunkReceived(chunks[0], None)
+        self.clock.advance(5)
+        for chunk in chunks[1:]:
+            self.assertIdentical(None,
+                                 self.reassembler.chunkReceived(chunk, None))
+        self.assertEqual(1, self.reassembler.expired)
+
+
+    def test_evict(self):
+        """
+        If the table is full, the oldest incomplete datagram is evicted.
+        """
+        chunks1 = udplog.chunkDatagram(self.datagram, 1, 100)
+        self.reassembler.chunkReceived(chunks1[0], None)
+        self.reassembler.chunkReceived(
+            udplog.chunkDatagram(self.datagram, 2, 100)[0], None)
+        self.reassembler.chunkReceived(
+            udplog.chunkDatagram(self.datagram, 3, 100)[0], None)
+
+        self.assertEqual(1, self.reassembler.evicted)
+        for chunk in chunks1[1:]:
+            self.assertIdentical(None,
+                                 self.reassembler.chunkReceived(chunk, None))
+
+
+    def test_inconsistentTotal(self):
+        """
+        Chunks of one message with different totals are rejected.
+        """
+        chunks1 = udplog.chunkDatagram(self.datagram, 1, 100)
+        chunks2 = udplog.chunkDatagram(self.datagram * 2, 1, 100)
+        self.reassembler.chunkReceived(chunks1[0], None)
+        self.assertRaises(ValueError, self.reassembler.chunkReceived,
+                          chunks2[1], None)
+
+
+    def test_pendingBytes(self):
+        """
+        The size of the chunks of incomplete datagrams is tracked.
+        """
+        chunks = udplog.chunkDatagram(self.datagram, 1, 100)
+        self.reassembler.chunkReceived(chunks[0], None)
+        self.reassembler.chunkReceived(chunks[0], None)
+        self.assertEqual(100 - udplog.CHUNK_HEADER_SIZE,
+                         self.reassembler.pendingBytes)
+
+        for chunk in chunks[1:]:
+            self.reassembler.chunkReceived(chunk, None)
+        self.assertEqual(0, self.reassembler.pendingBytes)
+
+
+    def test_evictBytes(self):
+        """
+        If the chunks of incomplete datagrams exceed the budget, the oldest
+        are evicted.
+        """
+        self.reassembler.maxPending = 10
+        self.reassembler.maxPendingBytes = 150
+        chunks1 = udplog.chunkDatagram(self.datagram, 1, 100)
+        self.reassembler.chunkReceived(chunks1[0], None)
+        self.reassembler.chunkReceived(
+            udplog.chunkDatagram(self.datagram, 2, 100)[0], None)
+
+        self.assertEqual(1, self.reassembler.evicted)
+        self.assertTrue(self.reassembler.pendingBytes <= 150)
+        for chunk in chunks1[1:]:
+            self.assertIdentical(None,
+                                 self.reassembler.chunkReceived(chunk, None))
+
+
+    def test_evictBytesInterleaved(self):
+        """
+        The budget also holds for chunks added to incomplete datagrams.
+        """
+        reassembler = twisted.ChunkReassembler(maxPendingBytes=100000,
+                                               clock=task.Clock())
+        datagram = b'x' * 50000
+        messages = [udplog.chunkDatagram(datagram, messageId, 1000)
+                    for messageId in xrange(20)]
+
+        for seq in xrange(len(messages[0]) - 1):
+            for chunks in messages:
+                reassembler.chunkReceived(chunks[seq], None)
+                self.assertTrue(reassembler.pendingBytes <= 100000)
+
+        self.assertNotEqual(0, reassembler.evicted)
+
+
+    def test_tooLarge(self):
+        """
+        Chunks of datagrams larger than the maximum message size are
+        rejected.
+        """
+        self.reassembler.maxMessageSize = 150
+        chunks = udplog.chunkDatagram(self.datagram, 1, 100)
+        self.assertRaises(ValueError, self.reassembler.chunkReceived,
+                          chunks[0], None)
+        self.assertEqual(1, self.reassembler.rejected)
+        self.assertEqual(0, self.reassembler.pendingBytes)
+
+
 
 class Dispatcher(unittest.TestCase):
     """
@@ -357,6 +1084,137 @@ class Dispatcher(unittest.TestCase):
         self.dispatcher.unregister(consumer)
 
 
+    def test_registerBatch(self):
+        """
+        A batch consumer receives the events gathered in one reactor
+        iteration.
+        """
+        clock = task.Clock()
+        self.dispatcher = twisted.Dispatcher(clock=clock)
+        batches = []
+        def consumer(events):
+            batches.append(events)
+        self.dispatcher.registerBatch(consumer)
+        self.dispatcher.eventReceived({'message': 'a'})
+        self.dispatcher.eventReceived({'message': 'b'})
+
+        self.assertEqual([], batches)
+        clock.advance(0)
+        self.assertEqual([[{'message': 'a'}, {'message': 'b'}]], batches)
+        self.assertEqual(1, self.dispatcher.batches)
+
+
+    def test_registerBatchDelay(self):
+        """
+        With a batch delay, events are gathered for that many seconds.
+        """
+        clock = task.Clock()
+        self.dispatcher = twisted.Dispatcher(batchDelay=1, clock=clock)
+        batches = []
+        def consumer(events):
+            batches.append(events)
+        self.dispatcher.registerBatch(consumer)
+        self.dispatcher.eventReceived({'message': 'a'})
+        clock.advance(0.5)
+        self.dispatcher.eventReceived({'message': 'b'})
+
+        self.assertEqual([], batches)
+        clock.advance(0.5)
+        self.assertEqual(1, len(batches))
+        self.assertEqual(2, len(batches[0]))
+
+
+    def test_maxBatchSize(self):
+        """
+        A full batch is dispatched right away.
+        """
+        clock = task.Clock()
+        self.dispatcher = twisted.Dispatcher(batchDelay=1, maxBatchSize=2,
+                                             clock=clock)
+        batches = []
+        def consumer(events):
+            batches.append(events)
+        self.dispatcher.registerBatch(consumer)
+        for message in 'abc':
+            self.dispatcher.eventReceived({'message': message})
+
+        self.assertEqual(1, len(batches))
+        clock.advance(1)
+        self.assertEqual([2, 1], [len(batch) for batch in batches])
+
+
+    def test_registerBatchMixed(self):
+        """
+        Per-event consumers are still called for every event.
+        """
+        clock = task.Clock()
+        self.dispatcher = twisted.Dispatcher(clock=clock)
+        events = []
+        batches = []
+        self.dispatcher.register(lambda event: events.append(event))
+        self.dispatcher.registerBatch(lambda events: batches.append(events))
+        self.dispatcher.eventReceived(None)
+
+        self.assertEqual([None], events)
+        clock.advance(0)
+        self.assertEqual([[None]], batches)
+
+
+    def test_registerBatchException(self):
+        """
+        A failed batch consumer does not affect others.
+        """
+        clock = task.Clock()
+        self.dispatcher = twisted.Dispatcher(clock=clock)
+        batches = []
+        def err(events):
+            raise ValueError("Oops")
+        self.dispatcher.registerBatch(err)
+        self.dispatcher.registerBatch(lambda events: batches.append(events))
+        self.dispatcher.eventReceived(None)
+        clock.advance(0)
+
+        self.assertEqual([[None]], batches)
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+
+
+    def test_unregisterBatch(self):
+        """
+        An unregistered batch consumer no longer receives events.
+        """
+        clock = task.Clock()
+        self.dispatcher = twisted.Dispatcher(clock=clock)
+        batches = []
+        def consumer(events):
+            batches.append(events)
+        self.dispatcher.registerBatch(consumer)
+        self.dispatcher.unregisterBatch(consumer)
+        self.dispatcher.unregisterBatch(consumer)
+        self.dispatcher.eventReceived(None)
+        clock.advance(0)
+
+        self.assertEqual([], batches)
+        self.assertEqual([], clock.getDelayedCalls())
+
+
+    def test_flush(self):
+        """
+        Flushing dispatches the pending batch and cancels the scheduled
+        dispatch.
+        """
+        clock = task.Clock()
+        self.dispatcher = twisted.Dispatcher(batchDelay=1, clock=clock)
+        batches = []
+        def consumer(events):
+            batches.append(events)
+        self.dispatcher.registerBatch(consumer)
+        self.dispatcher.eventReceived(None)
+        self.dispatcher.flush()
+
+        self.assertEqual([[None]], batches)
+        self.assertEqual([], clock.getDelayedCalls())
+
+
 
 class UDPLogClientFactoryTest(unittest.TestCase):
     """
@@ -609,3 +1467,60 @@ class QueueProducerTest(unittest.TestCase):
 
 
 
+class TracebackCacheTest(unittest.TestCase):
+    """
+    Tests for L{udplog.twisted.TracebackCache}.
+    """
+
+    def setUp(self):
+        self.cache = twisted.TracebackCache(maxSize=2)
+
+
+    def test_restore(self):
+        """
+        Traceback text is restored in events with a known fingerprint.
+        """
+        self.cache.eventReceived({'excFingerprint': 'a', 'excText': 'tb'})
+        event = {'excFingerprint': 'a', 'excRepeated': 4}
+        self.cache.eventReceived(event)
+
+        self.assertEqual('tb', event['excText'])
+        self.assertEqual(1, self.cache.restored)
+
+
+    def test_unknown(self):
+        """
+        Events with an unknown fingerprint are counted as missed.
+        """
+        event = {'excFingerprint': 'a', 'excRepeated': 4}
+        self.cache.eventReceived(event)
+
+        self.assertNotIn('excText', event)
+        self.assertEqual(1, self.cache.missed)
+
+
+    def test_noFingerprint(self):
+        """
+        Events without a fingerprint are left alone.
+        """
+        event = {'message': 'test'}
+        self.cache.eventReceived(event)
+        self.assertEqual({'message': 'test'}, event)
+
+
+    def test_evict(self):
+        """
+        If full, the least recently used traceback is evicted.
+        """
+        self.cache.eventReceived({'excFingerprint': 'a', 'excText': 'tbA'})
+        self.cache.eventReceived({'excFingerprint': 'b', 'excText': 'tbB'})
+        self.cache.eventReceived({'excFingerprint': 'a'})
+        self.cache.eventReceived({'excFingerprint': 'c', 'excText': 'tbC'})
+
+        event = {'excFingerprint': 'b'}
+        self.cache.eventReceived(event)
+        self.assertNotIn('excText', event)
+
+        event = {'excFingerprint': 'a'}
+        self.cache.eventReceived(event)
+        self.assertEqual('tbA', event['excText'])
@@ -9,15 +9,25 @@ Tests for L{udplog.udplog}.
 from __future__ import division, absolute_import
 
 import errno
+import gc
 import logging
+import logging.config
+import os
 import socket
+import struct
 import sys
+import threading
 import time
+import weakref
 
+import ConfigParser
 import StringIO
 
+import simplejson
+
 from twisted.trial import unittest
 
+from udplog import compression, encoding, metrics, sampling, tracebacks
 from udplog import udplog
 
 class UDPLoggerTest(unittest.TestCase):
@@ -286,126 +296,2450 @@ class UDPLoggerTest(unittest.TestCase):
         self.assertEqual(u'bar.example.org', eventDict[u'hostname'])
 
 
+    def test_augmentDefaultFieldsPartialOverride(self):
+        """
+        Default fields not overridden in an event are still added.
+        """
+        defaultFields = {u'hostname': u'foo.example.org',
+                         u'appname': u'test'}
 
-class UDPLogHandlerTest(unittest.TestCase):
-    """
-    Tests for L{udplog.logging.UDPLogHandler}.
-    """
+        logger = udplog.UDPLogger(defaultFields=defaultFields)
+        self._catchOutput(logger)
 
-    def setUp(self):
-        self.udplogger = udplog.MemoryLogger()
-        self.handler = udplog.UDPLogHandler(self.udplogger, category='test')
-        self.logger = logging.Logger('test_logger')
-        self.logger.addHandler(self.handler)
+        logger.log('test', {u'message': u'test',
+                            u'hostname': u'bar.example.org'})
+        logger.log('test', {u'message': u'test'})
 
+        category, eventDict = udplog.unserialize(self.output[0])
+        self.assertEqual(u'bar.example.org', eventDict[u'hostname'])
+        self.assertEqual(u'test', eventDict[u'appname'])
 
-    def test_emit(self):
+        category, eventDict = udplog.unserialize(self.output[1])
+        self.assertEqual(u'foo.example.org', eventDict[u'hostname'])
+        self.assertEqual(u'test', eventDict[u'appname'])
+
+
+    def test_augmentDefaultFieldsEncodedOnce(self):
         """
-        A message logged through python logging is sent out over udp.
+        Default fields are encoded once, not for every event.
         """
-        self.logger.debug("Hello")
+        encoded = []
 
-        self.assertEqual(1, len(self.udplogger.logged))
-        category, eventDict = self.udplogger.logged[-1]
+        class RecordingEncoder(object):
+            name = 'recording'
 
-        self.assertEqual('Hello', eventDict.get('message'))
-        self.assertEqual('DEBUG', eventDict.get('logLevel'))
-        self.assertEqual('test_logger', eventDict.get('logName'))
-        self.assertIn('timestamp', eventDict)
+            def encode(self, obj):
+                encoded.append(dict(obj))
+                return encoding.defaultEncoder.encode(obj)
+
+        defaultFields = {u'hostname': u'foo.example.org'}
+        logger = udplog.UDPLogger(defaultFields=defaultFields,
+                                  encoder=RecordingEncoder())
+        self._catchOutput(logger)
 
+        logger.log('test', {u'message': u'test 1'})
+        logger.log('test', {u'message': u'test 2'})
 
-    def test_emitFormatted(self):
+        self.assertEqual([defaultFields], encoded[:1])
+        for eventDict in encoded[1:]:
+            self.assertNotIn(u'hostname', eventDict)
+
+        for output in self.output:
+            category, eventDict = udplog.unserialize(output)
+            self.assertEqual(u'foo.example.org', eventDict[u'hostname'])
+
+
+    def test_augmentDefaultFieldsEmptyEvent(self):
         """
-        Messages are formatted and arguments are included in the event.
+        Default fields are added to events without other fields.
         """
-        self.logger.debug("Hello, %(object)s!", {'object': "world"})
+        logger = udplog.UDPLogger(defaultFields={u'hostname': u'foo'})
+        result = logger.serialize('test', {})
 
-        self.assertEqual(1, len(self.udplogger.logged))
-        category, eventDict = self.udplogger.logged[-1]
+        category, eventDict = udplog.unserialize(result)
+        self.assertEqual({u'hostname': u'foo'}, eventDict)
 
-        self.assertEqual('Hello, world!', eventDict.get('message'))
-        self.assertEqual('world', eventDict.get('object'))
 
+    def test_augmentDefaultFieldsSet(self):
+        """
+        Setting new default fields affects subsequent events.
+        """
+        logger = udplog.UDPLogger(defaultFields={u'hostname': u'foo'})
+        self._catchOutput(logger)
 
-    def test_emitException(self):
+        logger.defaultFields = {u'hostname': u'bar'}
+        logger.log('test', {u'message': u'test'})
+
+        category, eventDict = udplog.unserialize(self.output[0])
+        self.assertEqual({u'hostname': u'bar'}, logger.defaultFields)
+        self.assertEqual(u'bar', eventDict[u'hostname'])
+
+
+    def test_augmentDefaultFieldsReadOnly(self):
         """
-        Logging an exception renders the traceback.
+        Modifying the default fields in place fails, instead of being
+        silently ignored.
         """
-        try:
-            {}['something']
-        except Exception:
-            self.logger.exception('Oops')
+        logger = udplog.UDPLogger(defaultFields={u'hostname': u'foo'})
 
-        self.assertEqual(1, len(self.udplogger.logged))
-        _, eventDict = self.udplogger.logged[-1]
+        self.assertRaises(TypeError, logger.defaultFields.__setitem__,
+                          u'hostname', u'bar')
+        self.assertRaises(TypeError, logger.defaultFields.update,
+                          {u'hostname': u'bar'})
+        self.assertEqual({u'hostname': u'foo'}, logger.defaultFields)
 
-        self.assertEqual('Oops', eventDict.get('message'))
-        self.assertEqual('ERROR', eventDict.get('logLevel'))
-        self.assertEqual('exceptions.KeyError', eventDict.get('excType'))
-        self.assertEqual("'something'", eventDict.get('excValue'))
-        self.assertTrue(eventDict.get('excText').startswith('Traceback'))
 
+    def test_augmentDefaultFieldsNotDuplicated(self):
+        """
+        Events augmented with default fields do not get them twice.
+        """
+        logger = udplog.UDPLogger(defaultFields={u'hostname': u'foo'})
+        eventDict = {u'message': u'test'}
+        logger.augment(eventDict)
+        result = logger.serialize('test', eventDict)
 
-    def test_emitExceptionWithoutContext(self):
+        self.assertEqual(1, result.count(b'hostname'))
+
+
+
+    def test_encoderDefault(self):
         """
-        Logging an exception without context succeeds.
+        By default, the fastest available encoder is used.
+        """
+        from udplog import encoding
+        logger = udplog.UDPLogger()
+        self.assertIdentical(encoding.defaultEncoder, logger.encoder)
 
-        If L{logging.Logger.exception} is called outside of an C{except} block,
-        exception context might be lost. The result of the internal call to
-        C{sys.exc_info} then yields a tuple of three C{None}s, which should
-        simply result in the C{excValue} being C{'None'}.
+
+    def test_serializeEncoder(self):
         """
-        self.logger.exception('Oops')
+        Events are serialized with the encoder, prefixed by the category.
+        """
+        class FakeEncoder(object):
+            name = 'fake'
 
-        self.assertEqual(1, len(self.udplogger.logged))
-        _, eventDict = self.udplogger.logged[-1]
+            def encode(self, obj):
+                return b'{"fake": true}'
 
-        self.assertEqual('Oops', eventDict.get('message'))
-        self.assertEqual('ERROR', eventDict.get('logLevel'))
-        self.assertIdentical('NoneType', eventDict.get('excType'))
-        self.assertEqual('None', eventDict.get('excValue'))
-        self.assertIdentical(None, eventDict['excText'])
+        logger = udplog.UDPLogger(encoder=FakeEncoder())
+        self.assertEqual(b'test:\t{"fake": true}',
+                         logger.serialize('test', {u'message': u'test'}))
 
 
-    def test_emit_extra(self):
+    def test_logBatch(self):
         """
-        Values passed in the extra keyword argument are added to the eventDict.
+        With batching, events are buffered until flushed.
         """
-        self.logger.debug("Hello", extra={'foo': 'bar'})
+        logger = udplog.UDPLogger(batchSize=1024)
+        self._catchOutput(logger)
 
-        category, eventDict = self.udplogger.logged[-1]
-        self.assertIn('foo', eventDict)
-        self.assertEqual('bar', eventDict['foo'])
+        logger.log('test', {u'message': u'first'})
+        logger.log('test', {u'message': u'second'})
+        self.assertEqual(0, len(self.output))
 
+        logger.flush()
+        self.assertEqual(1, len(self.output))
 
+        msgs = udplog.splitDatagram(self.output[0])
+        self.assertEqual(2, len(msgs))
+        self.assertEqual(u'first', udplog.unserialize(msgs[0])[1][u'message'])
+        self.assertEqual(u'second', udplog.unserialize(msgs[1])[1][u'message'])
 
-class UDPLogHandlerFactoryTest(unittest.TestCase):
-    """
-    Tests for L{udplog.ConfigurableUDPLogHandler}.
-    """
 
-    def test_argsDefaults(self):
+    def test_logBatchSize(self):
         """
-        Without arguments, the logger and handler have their defaults.
+        If an event does not fit in the batch, the batch is flushed first.
         """
-        handler = udplog.ConfigurableUDPLogHandler()
-        logger = handler.logger
+        logger = udplog.UDPLogger(batchSize=120)
+        self._catchOutput(logger)
 
-        self.assertEquals('python_logging', handler.category)
-        self.assertEquals(('127.0.0.1', 55647), logger.socket.getpeername())
-        self.assertEquals({'hostname': socket.gethostname()},
-                          logger.defaultFields)
+        logger.log('test', {u'message': u'a' * 40, u'timestamp': 1})
+        logger.log('test', {u'message': u'b' * 40, u'timestamp': 1})
+        self.assertEqual(1, len(self.output))
+        self.assertEqual(1, len(udplog.splitDatagram(self.output[0])))
 
+        logger.flush()
+        self.assertEqual(2, len(self.output))
+        self.assertEqual(u'b' * 40,
+                         udplog.unserialize(self.output[1])[1][u'message'])
 
-    def test_args(self):
+
+    def test_logBatchTooLarge(self):
         """
-        All arguments are passed on.
+        An event larger than the batch size is sent out on its own.
         """
-        handler = udplog.ConfigurableUDPLogHandler({'foo': 'bar'}, 'test',
-                                                   '10.0.0.1', 55648, False)
-        logger = handler.logger
+        logger = udplog.UDPLogger(batchSize=64)
+        self._catchOutput(logger)
 
-        self.assertEquals('test', handler.category)
-        self.assertEquals(('10.0.0.1', 55648), logger.socket.getpeername())
-        self.assertNotIn('hostname', logger.defaultFields)
-        self.assertEquals('bar', logger.defaultFields['foo'])
+        logger.log('test', {u'message': u'small'})
+        logger.log('test', {u'message': u'a' * 64})
+        self.assertEqual(2, len(self.output))
+        self.assertEqual(u'small',
+                         udplog.unserialize(self.output[0])[1][u'message'])
+        self.assertEqual(u'a' * 64,
+                         udplog.unserialize(self.output[1])[1][u'message'])
+
+
+    def test_logBatchInterval(self):
+        """
+        The batch is flushed when its oldest event exceeds the interval.
+        """
+        now = [1000.0]
+        self.patch(udplog.time, 'time', lambda: now[0])
+
+        logger = udplog.UDPLogger(batchSize=1024, batchInterval=5)
+        self._catchOutput(logger)
+
+        # The flusher thread would see the patched time, too.
+        logger._flusher.start = lambda: None
+
+        logger.log('test', {u'message': u'first'})
+        now[0] += 4
+        logger.log('test', {u'message': u'second'})
+        self.assertEqual(0, len(self.output))
+
+        now[0] += 1
+        logger.log('test', {u'message': u'third'})
+        self.assertEqual(1, len(self.output))
+        self.assertEqual(3, len(udplog.splitDatagram(self.output[0])))
+
+
+    def test_logBatchIntervalIdle(self):
+        """
+        The batch is flushed after the interval, without logging another
+        event.
+        """
+        logger = udplog.UDPLogger(batchSize=1024, batchInterval=0.01)
+        self._catchOutput(logger)
+
+        logger.log('test', {u'message': u'first'})
+
+        deadline = time.time() + 5
+        while not self.output and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(1, len(self.output))
+        self.assertEqual(u'first',
+                         udplog.unserialize(self.output[0])[1][u'message'])
+
+
+    def test_logBatchIntervalFlusherExiting(self):
+        """
+        If the flusher thread is exiting, a new one is started for the next
+        batch.
+        """
+        logger = udplog.UDPLogger(batchSize=1024, batchInterval=0.01)
+        self._catchOutput(logger)
+
+        # Stand in for a flusher thread that stopped waiting, but did not
+        # exit yet.
+        exiting = threading.Event()
+        self.addCleanup(exiting.set)
+        logger._flusher.thread = threading.Thread(target=exiting.wait)
+        logger._flusher.thread.start()
+
+        logger.log('test', {u'message': u'first'})
+
+        deadline = time.time() + 5
+        while not self.output and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(1, len(self.output))
+
+
+    def test_logBatchFailure(self):
+        """
+        If sending a batch fails, its events are sent out individually.
+        """
+        logger = udplog.UDPLogger(batchSize=self.MAX_DATAGRAM_SIZE * 2)
+        self._catchOutput(logger)
+
+        logger.log('test', {u'message': u'a' * (self.MAX_DATAGRAM_SIZE // 2)})
+        logger.log('test', {u'message': u'b' * (self.MAX_DATAGRAM_SIZE // 2)})
+        logger.log('test', {u'message': u'c' * (self.MAX_DATAGRAM_SIZE // 2)})
+        logger.flush()
+
+        self.assertEqual(3, len(self.output))
+        for msg in self.output:
+            self.assertEqual(1, len(udplog.splitDatagram(msg)))
+
+
+    def test_logBatchFlushAtExit(self):
+        """
+        With batching, the buffer is flushed when the process exits.
+        """
+        self.patch(udplog, '_exitLoggers', weakref.WeakSet())
+
+        udplog.UDPLogger()
+        self.assertEqual(0, len(udplog._exitLoggers))
+
+        logger = udplog.UDPLogger(batchSize=1024)
+        self._catchOutput(logger)
+        logger.log('test', {u'message': u'test'})
+        self.assertEqual(0, len(self.output))
+
+        udplog._flushAtExit()
+        self.assertEqual(1, len(self.output))
+        self.assertFalse(logger._flusher.thread.is_alive())
+
+
+    def test_logBatchCollected(self):
+        """
+        A logger with batching can be garbage collected, along with its
+        socket.
+        """
+        logger = udplog.UDPLogger(batchSize=1024)
+        ref = weakref.ref(logger)
+        sockRef = weakref.ref(logger.socket)
+        del logger
+        gc.collect()
+
+        self.assertIdentical(None, ref())
+        self.assertIdentical(None, sockRef())
+
+
+    def test_flushEmpty(self):
+        """
+        Flushing an empty batch buffer sends nothing.
+        """
+        logger = udplog.UDPLogger(batchSize=1024)
+        self._catchOutput(logger)
+
+        logger.flush()
+        self.assertEqual(0, len(self.output))
+
+
+
+    def test_logChunked(self):
+        """
+        With chunking, large events are split into chunks.
+        """
+        logger = udplog.UDPLogger(chunkSize=1024)
+        self._catchOutput(logger)
+
+        logger.log('test', {u'message': u'a' * 2900})
+        self.assertEqual(3, len(self.output))
+
+        messageIds = set()
+        payload = []
+        for seq, chunk in enumerate(self.output):
+            self.assertTrue(chunk.startswith(udplog.CHUNK_MAGIC))
+            self.assertTrue(len(chunk) <= 1024)
+            messageId, chunkSeq, total, data = udplog.parseChunk(chunk)
+            messageIds.add(messageId)
+            self.assertEqual(seq, chunkSeq)
+            self.assertEqual(3, total)
+            payload.append(data)
+
+        self.assertEqual(1, len(messageIds))
+        category, eventDict = udplog.unserialize(b''.join(payload))
+        self.assertEqual(u'a' * 2900, eventDict[u'message'])
+
+
+    def test_logChunkedSmall(self):
+        """
+        With chunking, small events are sent as is.
+        """
+        logger = udplog.UDPLogger(chunkSize=1024)
+        self._catchOutput(logger)
+
+        logger.log('test', {u'message': u'test'})
+        self.assertEqual(1, len(self.output))
+        self.assertTrue(self.output[0].startswith(b'test:\t'))
+
+
+    def test_logChunkedTooLong(self):
+        """
+        With chunking, events larger than the datagram limit are not lost.
+        """
+        logger = udplog.UDPLogger(chunkSize=1024)
+        self._catchOutput(logger)
+
+        logger.log('test', {u'message': u'a' * self.MAX_DATAGRAM_SIZE})
+        payload = b''.join(udplog.parseChunk(chunk)[3]
+                           for chunk in self.output)
+        category, eventDict = udplog.unserialize(payload)
+        self.assertEqual('test', category)
+
+
+    def test_logChunkedMessageIds(self):
+        """
+        Every chunked datagram has its own message identifier.
+        """
+        logger = udplog.UDPLogger(chunkSize=1024)
+        self._catchOutput(logger)
+
+        logger.log('test', {u'message': u'a' * 2000})
+        logger.log('test', {u'message': u'a' * 2000})
+        messageIds = set(udplog.parseChunk(chunk)[0] for chunk in self.output)
+        self.assertEqual(2, len(messageIds))
+
+
+    def test_logChunkedFork(self):
+        """
+        After forking, message identifiers start at a new random offset.
+        """
+        logger = udplog.UDPLogger(chunkSize=1024)
+        self._catchOutput(logger)
+
+        logger.log('test', {u'message': u'a' * 2000})
+        self.patch(udplog.os, 'getpid', lambda: -1)
+        self.patch(udplog._random, 'getrandbits', lambda bits: 7)
+        logger.log('test', {u'message': u'a' * 2000})
+        logger.log('test', {u'message': u'a' * 2000})
+
+        messageIds = [udplog.parseChunk(chunk)[0] for chunk in self.output]
+        self.assertEqual([7 << 32] * 3 + [(7 << 32) + 1] * 3,
+                         messageIds[3:])
+
+
+    def test_chunkSizeTooSmall(self):
+        """
+        The chunk size must leave room for the payload.
+        """
+        self.assertRaises(ValueError, udplog.UDPLogger,
+                          chunkSize=udplog.CHUNK_HEADER_SIZE)
+
+
+
+    def test_socketPath(self):
+        """
+        With a socket path, events are sent over a UNIX datagram socket.
+        """
+        path = self.mktemp()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(path)
+
+        logger = udplog.UDPLogger(socketPath=path)
+        self.assertEqual(socket.AF_UNIX, logger.socket.family)
+
+        logger.log('test', {u'message': u'test'})
+        category, eventDict = udplog.unserialize(server.recv(65536))
+        self.assertEqual('test', category)
+        self.assertEqual(u'test', eventDict[u'message'])
+
+
+    def _bindServer(self, path):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(path)
+        return server
+
+
+    def test_socketPathMissing(self):
+        """
+        The UNIX datagram socket does not need to exist yet.
+        """
+        path = self.mktemp()
+        logger = udplog.UDPLogger(socketPath=path)
+
+        logger.log('test', {u'message': u'dropped'})
+        self.assertEqual({errno.ENOENT: 1},
+                         logger.metrics.snapshot()['sendErrors'])
+
+        server = self._bindServer(path)
+        logger._backoffUntil = 0
+        logger.log('test', {u'message': u'test'})
+
+        category, eventDict = udplog.unserialize(server.recv(65536))
+        self.assertEqual(u'test', eventDict[u'message'])
+
+
+    def test_socketPathRestart(self):
+        """
+        After the server restarted, events are sent to its new socket.
+        """
+        path = self.mktemp()
+        server = self._bindServer(path)
+        logger = udplog.UDPLogger(socketPath=path)
+        logger.log('test', {u'message': u'before'})
+        server.recv(65536)
+
+        server.close()
+        os.unlink(path)
+        server = self._bindServer(path)
+
+        logger.log('test', {u'message': u'after'})
+        logger.log('test', {u'message': u'again'})
+
+        category, eventDict = udplog.unserialize(server.recv(65536))
+        self.assertEqual(u'after', eventDict[u'message'])
+        category, eventDict = udplog.unserialize(server.recv(65536))
+        self.assertEqual(u'again', eventDict[u'message'])
+        self.assertEqual({}, logger.metrics.snapshot()['dropped'])
+
+
+    def test_socketPathStopped(self):
+        """
+        While the server is stopped, events are dropped and backed off from.
+        """
+        path = self.mktemp()
+        server = self._bindServer(path)
+        logger = udplog.UDPLogger(socketPath=path)
+
+        server.close()
+        logger.log('test', {u'message': u'test'})
+        logger.log('test', {u'message': u'test'})
+
+        self.assertEqual({'backoff': 2},
+                         logger.metrics.snapshot()['dropped'])
+
+
+    def test_nonBlocking(self):
+        """
+        With nonBlocking, the sockets are non-blocking.
+        """
+        logger = udplog.UDPLogger(nonBlocking=True)
+        self.assertEqual(0.0, logger.socket.gettimeout())
+
+
+    def test_nonBlockingDrop(self):
+        """
+        Events that would block are dropped and counted.
+        """
+        logger = udplog.UDPLogger(nonBlocking=True)
+
+        def send(data):
+            raise socket.error(errno.EAGAIN,
+                               "Resource temporarily unavailable")
+        self.patch(logger.socket, 'send', send)
+        self.patch(logger, 'serializeFailure', None)
+
+        logger.log('test', {u'message': u'test'})
+
+        snapshot = logger.metrics.snapshot()
+        self.assertEqual({'wouldBlock': 1}, snapshot['dropped'])
+        self.assertEqual({errno.EAGAIN: 1}, snapshot['sendErrors'])
+
+
+    def test_nonBlockingSocketPath(self):
+        """
+        Sending to a UNIX datagram socket that is not read from does not
+        block, but drops events.
+        """
+        path = self.mktemp()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(path)
+
+        logger = udplog.UDPLogger(socketPath=path, nonBlocking=True)
+        for _ in xrange(5000):
+            logger.log('test', {u'message': u'test'})
+
+        snapshot = logger.metrics.snapshot()
+        self.assertEqual(5000, snapshot['eventsSent'] +
+                               snapshot['dropped']['wouldBlock'])
+
+
+    def test_sendBufferSize(self):
+        """
+        The size of the send buffer can be set.
+        """
+        logger = udplog.UDPLogger(sendBufferSize=16384)
+        size = logger.socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+
+        # Linux doubles the requested size, to allow for bookkeeping.
+        self.assertIn(size, (16384, 32768))
+
+
+    def test_logCompressed(self):
+        """
+        With compression, datagrams are compressed.
+        """
+        logger = udplog.UDPLogger(compress=True)
+        self._catchOutput(logger)
+
+        eventDict = {u'message': u'test', u'logLevel': u'INFO',
+                     u'logName': u'__main__', u'filename': u'test.py',
+                     u'funcName': u'main', u'lineno': 4}
+        logger.log('python_logging', eventDict)
+
+        self.assertEqual(1, len(self.output))
+        self.assertTrue(compression.isCompressed(self.output[0]))
+        self.assertLess(len(self.output[0]),
+                        len(logger.serialize('python_logging', eventDict)))
+
+        category, result = udplog.unserialize(self.output[0])
+        self.assertEqual('python_logging', category)
+        self.assertEqual(u'test', result[u'message'])
+
+
+    def test_logCompressedNotSmaller(self):
+        """
+        Datagrams that do not get smaller are sent uncompressed.
+        """
+        class RandomEncoder(object):
+            name = 'random'
+
+            def encode(self, obj):
+                return os.urandom(32)
+
+        logger = udplog.UDPLogger(compress=True, encoder=RandomEncoder())
+        self._catchOutput(logger)
+
+        logger.log('t', {})
+        self.assertFalse(compression.isCompressed(self.output[0]))
+
+
+    def test_logCompressedChunked(self):
+        """
+        Compressed datagrams can be split into chunks.
+        """
+        logger = udplog.UDPLogger(compress=True, chunkSize=100)
+        self._catchOutput(logger)
+
+        logger.log('test', {u'message': os.urandom(300).encode('hex')})
+
+        self.assertLess(1, len(self.output))
+        payload = b''.join(udplog.parseChunk(chunk)[3]
+                           for chunk in self.output)
+        self.assertTrue(compression.isCompressed(payload))
+        category, eventDict = udplog.unserialize(payload)
+        self.assertEqual('test', category)
+
+
+    def test_logSampler(self):
+        """
+        Events rejected by the sampler are not serialized.
+        """
+        serialized = []
+
+        class FakeEncoder(object):
+            name = 'fake'
+
+            def encode(self, obj):
+                serialized.append(obj)
+                return b'{}'
+
+        sampler = sampling.EventSampler(sampleRates={'dropped': 0})
+        logger = udplog.UDPLogger(encoder=FakeEncoder(), sampler=sampler)
+        self._catchOutput(logger)
+
+        logger.log('dropped', {u'message': u'test'})
+        logger.log('test', {u'message': u'test'})
+
+        self.assertEqual(1, len(self.output))
+        self.assertEqual(1, len(serialized))
+        self.assertTrue(self.output[0].startswith(b'test:'))
+
+
+    def test_metricsSent(self):
+        """
+        Sent events and bytes are counted.
+        """
+        logger = udplog.UDPLogger()
+        self._catchOutput(logger)
+
+        logger.log('test', {u'message': u'test'})
+
+        snapshot = logger.metrics.snapshot()
+        self.assertEqual(1, snapshot['eventsSent'])
+        self.assertEqual(len(self.output[0]), snapshot['bytesSent'])
+
+
+    def test_metricsSerializeTimeDefault(self):
+        """
+        By default, serialization is not timed.
+        """
+        logger = udplog.UDPLogger()
+        self._catchOutput(logger)
+
+        logger.log('test', {u'message': u'test'})
+
+        snapshot = logger.metrics.snapshot()
+        self.assertEqual(0, sum(snapshot['serializeTime']['counts']))
+
+
+    def test_metricsSerializeTime(self):
+        """
+        If enabled, serialization times are collected.
+        """
+        logger = udplog.UDPLogger(timeSerialization=True)
+        self._catchOutput(logger)
+
+        logger.log('test', {u'message': u'test'})
+
+        snapshot = logger.metrics.snapshot()
+        self.assertEqual(1, sum(snapshot['serializeTime']['counts']))
+
+
+    def test_metricsBatch(self):
+        """
+        Events sent out in one datagram are counted individually.
+        """
+        logger = udplog.UDPLogger(batchSize=8192)
+        self._catchOutput(logger)
+
+        logger.log('test', {u'message': u'test 1'})
+        logger.log('test', {u'message': u'test 2'})
+        logger.flush()
+
+        snapshot = logger.metrics.snapshot()
+        self.assertEqual(2, snapshot['eventsSent'])
+        self.assertEqual(1, snapshot['datagramsSent'])
+
+
+    def test_metricsChunked(self):
+        """
+        The bytes of all chunks are counted.
+        """
+        logger = udplog.UDPLogger(chunkSize=1000)
+        self._catchOutput(logger)
+
+        logger.log('test', {u'message': u'x' * 2900})
+
+        snapshot = logger.metrics.snapshot()
+        self.assertEqual(1, snapshot['eventsSent'])
+        self.assertEqual(sum(len(chunk) for chunk in self.output),
+                         snapshot['bytesSent'])
+
+
+    def test_metricsSendError(self):
+        """
+        Send errors are counted by error number, as are failure fallbacks.
+        """
+        logger = udplog.UDPLogger()
+        self._catchOutput(logger)
+
+        logger.log('test', {u'message': u'x' * 10000})
+
+        snapshot = logger.metrics.snapshot()
+        self.assertEqual({errno.EMSGSIZE: 1}, snapshot['sendErrors'])
+        self.assertEqual(1, snapshot['failureFallbacks'])
+        self.assertEqual(1, snapshot['eventsSent'])
+
+
+    def test_metricsSampling(self):
+        """
+        Events rejected by the sampler are counted.
+        """
+        sampler = sampling.EventSampler(sampleRates={'dropped': 0})
+        logger = udplog.UDPLogger(sampler=sampler)
+        self._catchOutput(logger)
+
+        logger.log('dropped', {u'message': u'test'})
+
+        self.assertEqual({'sampling': 1}, logger.metrics.snapshot()['dropped'])
+
+
+    def test_metricsReport(self):
+        """
+        With a metrics interval, metrics are sent out with category udplog.
+        """
+        now = [1000.0]
+        self.patch(time, 'time', lambda: now[0])
+
+        logger = udplog.UDPLogger(metricsInterval=60)
+        self._catchOutput(logger)
+
+        logger.log('test', {u'message': u'test'})
+        now[0] += 60
+        logger.log('test', {u'message': u'test'})
+
+        self.assertEqual(3, len(self.output))
+        category, eventDict = udplog.unserialize(self.output[1])
+        self.assertEqual(u'udplog', category)
+        self.assertEqual(1, eventDict[u'eventsSent'])
+
+
+    def test_logSamplerReport(self):
+        """
+        The sampler's reports are sent out with category udplog.
+        """
+        sampler = sampling.EventSampler(sampleRates={'dropped': 0},
+                                        reportInterval=0)
+        logger = udplog.UDPLogger(sampler=sampler)
+        self._catchOutput(logger)
+
+        logger.log('dropped', {u'message': u'test'})
+
+        self.assertEqual(1, len(self.output))
+        category, eventDict = udplog.unserialize(self.output[0])
+        self.assertEqual('udplog', category)
+        self.assertEqual({u'dropped': 1}, eventDict[u'sampledOut'])
+
+
+    def test_sequenceNumbers(self):
+        """
+        Events are stamped with a sender identifier and sequence number.
+        """
+        logger = udplog.UDPLogger(sequenceNumbers=True)
+        self._catchOutput(logger)
+
+        logger.log('test', {u'message': u'test'})
+        logger.log('test', {u'message': u'test'})
+
+        events = [udplog.unserialize(data)[1] for data in self.output]
+        self.assertEqual([0, 1], [event[u'sequence'] for event in events])
+        self.assertEqual([logger.senderId] * 2,
+                         [event[u'senderId'] for event in events])
+
+
+    def test_sequenceNumbersDisabled(self):
+        """
+        By default, events are not stamped with sequence numbers.
+        """
+        logger = udplog.UDPLogger()
+        self._catchOutput(logger)
+
+        logger.log('test', {u'message': u'test'})
+
+        category, eventDict = udplog.unserialize(self.output[0])
+        self.assertNotIn(u'senderId', eventDict)
+        self.assertNotIn(u'sequence', eventDict)
+
+
+    def test_sequenceNumbersSampled(self):
+        """
+        Events rejected by the sampler do not use up sequence numbers.
+        """
+        sampler = sampling.EventSampler(sampleRates={'dropped': 0})
+        logger = udplog.UDPLogger(sampler=sampler, sequenceNumbers=True)
+        self._catchOutput(logger)
+
+        logger.log('dropped', {u'message': u'test'})
+        logger.log('test', {u'message': u'test'})
+
+        category, eventDict = udplog.unserialize(self.output[0])
+        self.assertEqual(0, eventDict[u'sequence'])
+
+
+    def test_sequenceNumbersFork(self):
+        """
+        After forking, a new sender identifier is used, starting at zero.
+        """
+        logger = udplog.UDPLogger(sequenceNumbers=True)
+        self._catchOutput(logger)
+        senderId = logger.senderId
+
+        logger.log('test', {u'message': u'test'})
+        self.patch(udplog.os, 'getpid', lambda: -1)
+        logger.log('test', {u'message': u'test'})
+
+        category, eventDict = udplog.unserialize(self.output[1])
+        self.assertNotEqual(senderId, eventDict[u'senderId'])
+        self.assertEqual(0, eventDict[u'sequence'])
+
+
+    def test_sequenceNumbersFailure(self):
+        """
+        An event replaced by a report of its failure keeps its sequence.
+        """
+        logger = udplog.UDPLogger(sequenceNumbers=True)
+        self._catchOutput(logger)
+
+        logger.log('test', {u'message': u'a' * self.MAX_DATAGRAM_SIZE})
+
+        category, eventDict = udplog.unserialize(self.output[0])
+        self.assertEqual(u'udplog', category)
+        self.assertEqual(0, eventDict[u'sequence'])
+        self.assertEqual(logger.senderId, eventDict[u'senderId'])
+
+
+    def test_tracebackFilter(self):
+        """
+        Repeated tracebacks are left out, keeping the fingerprint.
+        """
+        logger = udplog.UDPLogger(
+            tracebackFilter=tracebacks.TracebackFilter(limit=1))
+        self._catchOutput(logger)
+
+        for _ in xrange(2):
+            logger.log('test', {u'message': u'test',
+                                u'excType': u'KeyError',
+                                u'excText': u'KeyError: abc'})
+
+        events = [udplog.unserialize(data)[1] for data in self.output]
+        self.assertIn(u'excText', events[0])
+        self.assertNotIn(u'excText', events[1])
+        self.assertEqual(2, events[1][u'excRepeated'])
+        self.assertEqual(events[0][u'excFingerprint'],
+                         events[1][u'excFingerprint'])
+
+
+    def test_count(self):
+        """
+        Counters are aggregated and sent out in a summary event.
+        """
+        now = [1000.0]
+        self.patch(time, 'time', lambda: now[0])
+        logger = udplog.UDPLogger(aggregateInterval=10)
+        self._catchOutput(logger)
+
+        # The reporter thread would see the patched time, too.
+        logger._reporter.start = lambda: None
+
+        for _ in xrange(100):
+            logger.count(u'hits')
+        self.assertEqual([], self.output)
+
+        now[0] += 10
+        logger.count(u'hits')
+
+        self.assertEqual(1, len(self.output))
+        category, eventDict = udplog.unserialize(self.output[0])
+        self.assertEqual(u'metrics', category)
+        self.assertEqual({u'hits': 101}, eventDict[u'counts'])
+
+
+    def test_timing(self):
+        """
+        Timings are aggregated into percentiles, per category.
+        """
+        logger = udplog.UDPLogger()
+        self._catchOutput(logger)
+
+        for ms in xrange(1, 101):
+            logger.timing(u'request', ms, category='web')
+        logger.flush()
+
+        category, eventDict = udplog.unserialize(self.output[0])
+        self.assertEqual(u'web', category)
+        timing = eventDict[u'timings'][u'request']
+        self.assertEqual(100, timing[u'count'])
+        self.assertTrue(49.5 <= timing[u'p50'] <= 50.5)
+        self.assertIn(u'sketch', timing)
+
+
+    def test_aggregatesIdle(self):
+        """
+        Summaries are sent out every interval, without logging or
+        aggregating anything else.
+        """
+        logger = udplog.UDPLogger(aggregateInterval=0.01)
+        self._catchOutput(logger)
+
+        logger.count(u'hits')
+        self.assertEqual([], self.output)
+
+        deadline = time.time() + 5
+        while not self.output and time.time() < deadline:
+            time.sleep(0.01)
+
+        category, eventDict = udplog.unserialize(self.output[0])
+        self.assertEqual({u'hits': 1}, eventDict[u'counts'])
+
+        logger._reporter.thread.join(5)
+        self.assertFalse(logger._reporter.thread.is_alive())
+
+
+    def test_aggregatesFlushAtExit(self):
+        """
+        Aggregates are sent out when the process exits, without keeping the
+        logger alive.
+        """
+        self.patch(udplog, '_exitLoggers', weakref.WeakSet())
+        logger = udplog.UDPLogger()
+        self._catchOutput(logger)
+
+        logger.count(u'hits')
+        self.assertIn(logger, udplog._exitLoggers)
+
+        udplog._flushAtExit()
+        self.assertEqual(1, len(self.output))
+        self.assertFalse(logger._reporter.thread.is_alive())
+
+        ref = weakref.ref(logger)
+        del logger
+        gc.collect()
+        self.assertIdentical(None, ref())
+
+
+    def test_aggregatesOnLog(self):
+        """
+        Due summaries are also sent out when logging an event.
+        """
+        now = [1000.0]
+        self.patch(time, 'time', lambda: now[0])
+        logger = udplog.UDPLogger(aggregateInterval=10)
+        self._catchOutput(logger)
+
+        # The reporter thread would see the patched time, too.
+        logger._reporter.start = lambda: None
+
+        logger.count(u'hits')
+        now[0] += 10
+        logger.log('test', {u'message': u'test'})
+
+        categories = [udplog.unserialize(data)[0] for data in self.output]
+        self.assertEqual([u'metrics', u'test'], categories)
+
+
+    def test_bind(self):
+        """
+        Events logged through a bound logger get the context fields.
+        """
+        logger = udplog.UDPLogger(defaultFields={u'hostname': u'foo'})
+        self._catchOutput(logger)
+
+        bound = logger.bind(requestId=u'abc')
+        bound.log('test', {u'message': u'test'})
+
+        category, eventDict = udplog.unserialize(self.output[0])
+        self.assertEqual(u'test', eventDict[u'message'])
+        self.assertEqual(u'abc', eventDict[u'requestId'])
+        self.assertEqual(u'foo', eventDict[u'hostname'])
+
+
+    def test_bindOverride(self):
+        """
+        Event fields override context fields, which override default fields.
+        """
+        logger = udplog.UDPLogger(defaultFields={u'hostname': u'foo',
+                                                 u'route': u'default'})
+        self._catchOutput(logger)
+
+        bound = logger.bind(route=u'/index', requestId=u'abc')
+        bound.log('test', {u'message': u'test', u'requestId': u'def'})
+
+        category, eventDict = udplog.unserialize(self.output[0])
+        self.assertEqual(u'def', eventDict[u'requestId'])
+        self.assertEqual(u'/index', eventDict[u'route'])
+        self.assertEqual(u'foo', eventDict[u'hostname'])
+
+
+    def test_bindEncodedOnce(self):
+        """
+        Context fields are encoded once, not for every event.
+        """
+        encoded = []
+
+        class RecordingEncoder(object):
+            name = 'recording'
+
+            def encode(self, obj):
+                encoded.append(dict(obj))
+                return encoding.defaultEncoder.encode(obj)
+
+        logger = udplog.UDPLogger(encoder=RecordingEncoder())
+        self._catchOutput(logger)
+
+        bound = logger.bind(requestId=u'abc')
+        del encoded[:]
+        bound.log('test', {u'message': u'test'})
+        bound.log('test', {u'message': u'test'})
+
+        self.assertEqual(2, len(encoded))
+        for eventDict in encoded:
+            self.assertNotIn(u'requestId', eventDict)
+
+
+    def test_bindNested(self):
+        """
+        Binding on a bound logger adds to its context fields.
+        """
+        logger = udplog.UDPLogger()
+        self._catchOutput(logger)
+
+        bound = logger.bind(requestId=u'abc').bind(userId=1)
+        bound.log('test', {u'message': u'test'})
+
+        category, eventDict = udplog.unserialize(self.output[0])
+        self.assertEqual(u'abc', eventDict[u'requestId'])
+        self.assertEqual(1, eventDict[u'userId'])
+
+
+    def test_bindContext(self):
+        """
+        Within a bound logger's block, events logged get its context fields.
+        """
+        logger = udplog.UDPLogger()
+        self._catchOutput(logger)
+
+        with logger.bind(requestId=u'abc') as bound:
+            self.assertIdentical(bound, logger.currentContext())
+            logger.log('test', {u'message': u'inside'})
+        logger.log('test', {u'message': u'outside'})
+
+        self.assertIdentical(None, logger.currentContext())
+        category, eventDict = udplog.unserialize(self.output[0])
+        self.assertEqual(u'abc', eventDict[u'requestId'])
+        category, eventDict = udplog.unserialize(self.output[1])
+        self.assertNotIn(u'requestId', eventDict)
+
+
+    def test_bindContextNested(self):
+        """
+        Binding within a block extends the current context.
+        """
+        logger = udplog.UDPLogger()
+        self._catchOutput(logger)
+
+        with logger.bind(requestId=u'abc'):
+            with logger.bind(userId=1):
+                logger.log('test', {u'message': u'inner'})
+            logger.log('test', {u'message': u'outer'})
+
+        category, eventDict = udplog.unserialize(self.output[0])
+        self.assertEqual(u'abc', eventDict[u'requestId'])
+        self.assertEqual(1, eventDict[u'userId'])
+        category, eventDict = udplog.unserialize(self.output[1])
+        self.assertEqual(u'abc', eventDict[u'requestId'])
+        self.assertNotIn(u'userId', eventDict)
+
+
+    def test_bindContextThread(self):
+        """
+        The current context is not shared with other threads.
+        """
+        logger = udplog.UDPLogger()
+        self._catchOutput(logger)
+
+        with logger.bind(requestId=u'abc'):
+            thread = threading.Thread(target=logger.log,
+                                      args=('test', {u'message': u'test'}))
+            thread.start()
+            thread.join()
+
+        category, eventDict = udplog.unserialize(self.output[0])
+        self.assertNotIn(u'requestId', eventDict)
+
+
+class UDPLoggerDestinationsTest(unittest.TestCase):
+    """
+    Tests for sending to multiple destinations with L{udplog.UDPLogger}.
+    """
+
+    destinations = [('127.0.0.1', 55701),
+                    ('127.0.0.1', 55702),
+                    ('127.0.0.1', 55703)]
+
+    def setUp(self):
+        self.now = 1000.0
+        self.patch(time, 'time', lambda: self.now)
+        self.refused = set()
+
+
+    def _makeLogger(self, destinations=None, **kwargs):
+        """
+        Set up a logger that records the destination of every datagram.
+        """
+        destinations = destinations or self.destinations
+        logger = udplog.UDPLogger(destinations=destinations, **kwargs)
+        self.output = []
+
+        for destination, sock in zip(destinations, logger.sockets):
+            def send(data, destination=destination):
+                if destination in self.refused:
+                    raise socket.error(errno.ECONNREFUSED,
+                                       "Connection refused")
+                self.output.append((destination, data))
+            self.patch(sock, 'send', send)
+
+        return logger
+
+
+    def _destinationsByCategory(self, logger, categories):
+        for category in categories:
+            logger.log(category, {u'message': u'test'})
+        return {udplog.unserialize(data)[0]: destination
+                for destination, data in self.output}
+
+
+    def test_sockets(self):
+        """
+        A socket is connected to every destination.
+        """
+        logger = udplog.UDPLogger(destinations=self.destinations)
+        self.assertEqual(self.destinations,
+                         [sock.getpeername() for sock in logger.sockets])
+        self.assertIdentical(logger.sockets[0], logger.socket)
+
+
+    def test_noDestinations(self):
+        """
+        An empty list of destinations is rejected.
+        """
+        self.assertRaises(ValueError, udplog.UDPLogger, destinations=[])
+
+
+    def test_unknownBalance(self):
+        """
+        Unknown balancing methods are rejected.
+        """
+        self.assertRaises(ValueError, udplog.UDPLogger, balance='random')
+
+
+    def test_hash(self):
+        """
+        Events of one category are always sent to the same destination.
+        """
+        logger = self._makeLogger()
+        for _ in range(3):
+            logger.log('test', {u'message': u'test'})
+
+        self.assertEqual(1, len(set(destination
+                                    for destination, _ in self.output)))
+
+
+    def test_hashSpread(self):
+        """
+        Categories are spread across all destinations.
+        """
+        logger = self._makeLogger()
+        result = self._destinationsByCategory(
+            logger, ['category%d' % i for i in range(100)])
+
+        self.assertEqual(set(self.destinations), set(result.values()))
+
+
+    def test_hashConsistent(self):
+        """
+        The destination of a category does not depend on the order of the
+        destinations, and removing one only moves its own categories.
+        """
+        categories = ['category%d' % i for i in range(100)]
+        result = self._destinationsByCategory(self._makeLogger(),
+                                              categories)
+
+        reordered = self._destinationsByCategory(
+            self._makeLogger(list(reversed(self.destinations))), categories)
+        self.assertEqual(result, reordered)
+
+        removed = self.destinations[1]
+        remaining = [destination for destination in self.destinations
+                     if destination != removed]
+        reduced = self._destinationsByCategory(self._makeLogger(remaining),
+                                               categories)
+        for category, destination in result.iteritems():
+            if destination != removed:
+                self.assertEqual(destination, reduced[category])
+
+
+    def test_roundRobin(self):
+        """
+        With round robin, datagrams are sent to each destination in turn.
+        """
+        logger = self._makeLogger(balance=udplog.BALANCE_ROUND_ROBIN)
+        for _ in range(6):
+            logger.log('test', {u'message': u'test'})
+
+        self.assertEqual(self.destinations * 2,
+                         [destination for destination, _ in self.output])
+
+
+    def test_batchHash(self):
+        """
+        Batches are split up by destination.
+        """
+        categories = ['category%d' % i for i in range(20)]
+        expected = self._destinationsByCategory(self._makeLogger(),
+                                                categories)
+
+        logger = self._makeLogger(batchSize=8192)
+        for category in categories:
+            logger.log(category, {u'message': u'test'})
+        logger.flush()
+
+        self.assertEqual(len(set(expected.values())), len(self.output))
+        batched = {}
+        for destination, data in self.output:
+            for event in udplog.splitDatagram(data):
+                batched[udplog.unserialize(event)[0]] = destination
+        self.assertEqual(expected, batched)
+
+
+    def test_hashUnicode(self):
+        """
+        Unicode categories are hashed as UTF-8, also in batches.
+        """
+        category = u'caf\xe9'
+        logger = self._makeLogger()
+        logger.log(category, {u'message': u'test'})
+        destination = self.output[0][0]
+
+        logger = self._makeLogger(batchSize=8192)
+        logger.log(category, {u'message': u'test'})
+        logger.log(category, {u'message': u'test'})
+        logger.flush()
+
+        self.assertEqual([destination], [dest for dest, _ in self.output])
+        self.assertEqual(2, len(udplog.splitDatagram(self.output[0][1])))
+        self.assertEqual(logger._pickDestination(category.encode('utf-8')),
+                         logger._pickDestination(category))
+
+
+    def test_refused(self):
+        """
+        A datagram refused by its destination is sent to the next one.
+        """
+        logger = self._makeLogger(balance=udplog.BALANCE_ROUND_ROBIN)
+        self.refused.add(self.destinations[0])
+
+        logger.log('test', {u'message': u'test'})
+
+        self.assertEqual([self.destinations[1]],
+                         [destination for destination, _ in self.output])
+        snapshot = logger.metrics.snapshot()
+        self.assertEqual({errno.ECONNREFUSED: 1}, snapshot['sendErrors'])
+        self.assertEqual(1, snapshot['eventsSent'])
+
+
+    def test_refusedCooldown(self):
+        """
+        A destination that refused a datagram is skipped until its cooldown
+        period is over.
+        """
+        logger = self._makeLogger(balance=udplog.BALANCE_ROUND_ROBIN,
+                                  cooldown=10)
+        self.refused.add(self.destinations[0])
+        logger.log('test', {u'message': u'test'})
+        self.refused.clear()
+
+        for _ in range(4):
+            logger.log('test', {u'message': u'test'})
+        self.assertNotIn(self.destinations[0],
+                         [destination for destination, _ in self.output])
+
+        self.now += 10
+        for _ in range(3):
+            logger.log('test', {u'message': u'test'})
+        self.assertIn(self.destinations[0],
+                      [destination for destination, _ in self.output])
+
+
+    def test_refusedHash(self):
+        """
+        With hashing, a category of a refusing destination moves to another
+        one.
+        """
+        logger = self._makeLogger()
+        logger.log('test', {u'message': u'test'})
+        original = self.output[0][0]
+
+        self.refused.add(original)
+        logger.log('test', {u'message': u'test'})
+        self.refused.clear()
+        logger.log('test', {u'message': u'test'})
+
+        self.assertNotEqual(original, self.output[1][0])
+        self.assertEqual(self.output[1][0], self.output[2][0])
+
+
+    def test_refusedAll(self):
+        """
+        If all destinations refuse a datagram, this is reported as a failure.
+        """
+        logger = self._makeLogger(backoff=None)
+        self.refused.update(self.destinations)
+        self.patch(sys, 'stderr', StringIO.StringIO())
+
+        logger.log('test', {u'message': u'test'})
+
+        self.assertEqual([], self.output)
+        self.assertIn('Failed to send udplog message', sys.stderr.getvalue())
+
+
+    def test_refusedSingle(self):
+        """
+        With a single destination, refused datagrams are reported as
+        failures, as before.
+        """
+        logger = self._makeLogger(self.destinations[:1], backoff=None)
+        self.refused.add(self.destinations[0])
+        self.patch(sys, 'stderr', StringIO.StringIO())
+
+        logger.log('test', {u'message': u'test'})
+
+        self.assertEqual({errno.ECONNREFUSED: 2},
+                         logger.metrics.snapshot()['sendErrors'])
+
+
+
+    def test_backoff(self):
+        """
+        If all destinations refuse a datagram, events are dropped for the
+        backoff period, without reporting failures.
+        """
+        logger = self._makeLogger(backoff=5)
+        self.refused.update(self.destinations)
+        self.patch(logger, 'serializeFailure', None)
+
+        for _ in range(3):
+            logger.log('test', {u'message': u'test'})
+
+        self.assertEqual([], self.output)
+        snapshot = logger.metrics.snapshot()
+        self.assertEqual({'backoff': 3}, snapshot['dropped'])
+        self.assertEqual({errno.ECONNREFUSED: len(self.destinations)},
+                         snapshot['sendErrors'])
+
+
+    def test_backoffProbe(self):
+        """
+        After the backoff period, the next event is sent, backing off again
+        if that fails too.
+        """
+        logger = self._makeLogger(self.destinations[:1], backoff=5)
+        self.refused.add(self.destinations[0])
+
+        logger.log('test', {u'message': u'test'})
+        self.now += 5
+        logger.log('test', {u'message': u'test'})
+        logger.log('test', {u'message': u'test'})
+
+        self.assertEqual({errno.ECONNREFUSED: 2},
+                         logger.metrics.snapshot()['sendErrors'])
+        self.assertEqual({'backoff': 3},
+                         logger.metrics.snapshot()['dropped'])
+
+
+    def test_backoffRecovered(self):
+        """
+        Once sending succeeds again, a summary of the failures is sent.
+        """
+        logger = self._makeLogger(self.destinations[:1], backoff=5)
+        self.refused.add(self.destinations[0])
+        failedSince = self.now
+
+        logger.log('test', {u'message': u'test'})
+        logger.log('test', {u'message': u'test'})
+        self.refused.clear()
+        self.now += 5
+        logger.log('test', {u'message': u'probe'})
+        logger.log('test', {u'message': u'recovered'})
+        logger.log('test', {u'message': u'test'})
+
+        self.assertEqual(4, len(self.output))
+        category, eventDict = udplog.unserialize(self.output[2][1])
+        self.assertEqual(u'udplog', category)
+        self.assertEqual(2, eventDict[u'dropped'])
+        self.assertEqual(errno.ECONNREFUSED, eventDict[u'errno'])
+        self.assertEqual(failedSince, eventDict[u'failedSince'])
+
+
+    def test_backoffRecoveredOnce(self):
+        """
+        The summary of the failures is sent once, even if another thread
+        takes it between checking for it and taking it.
+        """
+        logger = self._makeLogger(self.destinations[:1], backoff=5)
+        self.refused.add(self.destinations[0])
+        logger.log('test', {u'message': u'test'})
+        self.refused.clear()
+        self.now += 5
+        logger.log('test', {u'message': u'probe'})
+
+        lock = logger._outageLock
+        class RacingLock(object):
+            def __enter__(self):
+                logger._recovered = None
+                return lock.__enter__()
+            def __exit__(self, *args):
+                return lock.__exit__(*args)
+        logger._outageLock = RacingLock()
+
+        logger.log('test', {u'message': u'recovered'})
+
+        categories = [udplog.unserialize(data)[0]
+                      for _, data in self.output]
+        self.assertEqual(['test', 'test'], categories)
+
+
+    def test_backoffProbeRefusedLater(self):
+        """
+        If the send after a successful probe is refused, the outage
+        continues, and the probe counts as dropped.
+        """
+        logger = self._makeLogger(self.destinations[:1], backoff=5)
+        self.refused.add(self.destinations[0])
+        logger.log('test', {u'message': u'test'})
+
+        for _ in range(3):
+            self.now += 5
+            self.refused.clear()
+            logger.log('test', {u'message': u'probe'})
+            self.refused.add(self.destinations[0])
+            logger.log('test', {u'message': u'test'})
+
+        self.refused.clear()
+        self.now += 5
+        logger.log('test', {u'message': u'probe'})
+        logger.log('test', {u'message': u'recovered'})
+
+        categories = [udplog.unserialize(data)[0]
+                      for _, data in self.output]
+        self.assertEqual(['test'] * 5 + ['udplog'], categories)
+        category, eventDict = udplog.unserialize(self.output[-1][1])
+        self.assertEqual(7, eventDict[u'dropped'])
+        self.assertEqual(1000.0, eventDict[u'failedSince'])
+
+
+    def test_backoffClosedPort(self):
+        """
+        Sending to a closed UDP port only fails upon the send after the one
+        that was refused. A probe that appears to succeed does not end the
+        outage, so that all dropped events are reported once sending really
+        succeeds.
+        """
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        destination = server.getsockname()
+        server.close()
+
+        logger = udplog.UDPLogger(destinations=[destination], backoff=5)
+        for _ in range(3):
+            for _ in range(10):
+                logger.log('test', {u'message': u'test'})
+            self.now += 5
+
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(destination)
+        logger.log('test', {u'message': u'probe'})
+        logger.log('test', {u'message': u'recovered'})
+
+        server.settimeout(1)
+        datagrams = [server.recv(65536) for _ in range(3)]
+        category, eventDict = udplog.unserialize(datagrams[2])
+        self.assertEqual(u'udplog', category)
+        self.assertEqual(29, eventDict[u'dropped'])
+        self.assertEqual(errno.ECONNREFUSED, eventDict[u'errno'])
+
+
+    def test_backoffBatch(self):
+        """
+        A refused batch drops all of its events.
+        """
+        logger = self._makeLogger(self.destinations[:1], backoff=5,
+                                  batchSize=8192)
+        self.refused.add(self.destinations[0])
+
+        logger.log('test', {u'message': u'test'})
+        logger.log('test', {u'message': u'test'})
+        logger.flush()
+        logger.log('test', {u'message': u'test'})
+
+        self.assertEqual({'backoff': 3},
+                         logger.metrics.snapshot()['dropped'])
+
+
+    def test_backoffOtherErrors(self):
+        """
+        Other errors do not cause backing off.
+        """
+        logger = self._makeLogger(self.destinations[:1], backoff=5)
+        self.patch(logger.socket, 'send', self.sendTooLong)
+
+        logger.log('test', {u'message': u'test'})
+
+        self.assertEqual({}, logger.metrics.snapshot()['dropped'])
+        self.assertEqual(0, logger._backoffUntil)
+
+
+    def sendTooLong(self, data):
+        if data.startswith('test'):
+            raise socket.error(errno.EMSGSIZE, "Message too long")
+        self.output.append((None, data))
+
+
+
+class ChunkDatagramTest(unittest.TestCase):
+    """
+    Tests for L{udplog.udplog.chunkDatagram} and L{udplog.udplog.parseChunk}.
+    """
+
+    def test_roundTrip(self):
+        """
+        Chunks can be parsed and joined into the original datagram.
+        """
+        datagram = b''.join(chr(i % 256) for i in range(1000))
+        chunks = udplog.chunkDatagram(datagram, 42, 100)
+
+        self.assertEqual(12, len(chunks))
+        result = []
+        for seq, chunk in enumerate(chunks):
+            self.assertTrue(len(chunk) <= 100)
+            self.assertEqual((42, seq, 12), udplog.parseChunk(chunk)[:3])
+            result.append(udplog.parseChunk(chunk)[3])
+        self.assertEqual(datagram, b''.join(result))
+
+
+    def test_tooManyChunks(self):
+        """
+        Datagrams that need more than MAX_CHUNKS chunks are rejected.
+        """
+        datagram = b'a' * (udplog.MAX_CHUNKS + 1)
+        self.assertRaises(ValueError, udplog.chunkDatagram, datagram, 1,
+                          udplog.CHUNK_HEADER_SIZE + 1)
+
+
+    def test_parseShort(self):
+        """
+        A chunk shorter than the header is malformed.
+        """
+        self.assertRaises(ValueError, udplog.parseChunk, udplog.CHUNK_MAGIC)
+
+
+    def test_parseSequenceOutOfRange(self):
+        """
+        A chunk with a sequence number beyond the total is malformed.
+        """
+        chunk = udplog.CHUNK_MAGIC + struct.pack('!QHH', 1, 1, 1) + b'abc'
+        self.assertRaises(ValueError, udplog.parseChunk, chunk)
+
+
+class SplitDatagramTest(unittest.TestCase):
+    """
+    Tests for L{udplog.udplog.splitDatagram}.
+    """
+
+    def test_single(self):
+        """
+        A datagram with a single event yields that event.
+        """
+        self.assertEqual([b'test:\t{"a": 1}'],
+                         udplog.splitDatagram(b'test:\t{"a": 1}\n'))
+
+
+    def test_multiple(self):
+        """
+        Events are separated by newlines.
+        """
+        self.assertEqual([b'test:\t{"a": 1}', b'test:\t{"b": 2}'],
+                         udplog.splitDatagram(b'test:\t{"a": 1}\n'
+                                              b'test:\t{"b": 2}'))
+
+
+    def test_multiline(self):
+        """
+        A single event with JSON spread over multiple lines stays whole.
+        """
+        data = simplejson.dumps({u'a': [1, True, None, u'b: c'],
+                                 u'd': {u'e': u'f'}},
+                                indent=4)
+        datagram = b'test: ' + data + b'\n'
+
+        events = udplog.splitDatagram(datagram)
+
+        self.assertEqual(1, len(events))
+        category, eventDict = udplog.unserialize(events[0])
+        self.assertEqual(simplejson.loads(data), eventDict)
+
+
+    def test_multilineBatch(self):
+        """
+        Events with JSON spread over multiple lines can be batched.
+        """
+        data = simplejson.dumps({u'a': 1, u'b': [2, 3]}, indent=0)
+        datagram = b'\n'.join([b'test: ' + data, b'other:\t{"c": 4}'])
+
+        events = udplog.splitDatagram(datagram)
+
+        self.assertEqual([('test', {u'a': 1, u'b': [2, 3]}),
+                          ('other', {u'c': 4})],
+                         [udplog.unserialize(event) for event in events])
+
+
+class LazyThreadTest(unittest.TestCase):
+    """
+    Tests for L{udplog.udplog._LazyThread}.
+    """
+
+    def setUp(self):
+        self.lock = threading.Condition()
+        self.runs = []
+        self.busy = []
+        self.worker = udplog._LazyThread('udplog-test', self.lock, self.work,
+                                         lambda: bool(self.busy and
+                                                      self.busy.pop()))
+
+
+    def work(self):
+        self.runs.append(self.worker.running)
+
+
+    def startAndJoin(self):
+        with self.lock:
+            started = self.worker.start()
+        self.worker.thread.join(5)
+        return started
+
+
+    def test_start(self):
+        """
+        The thread runs the work function, and exits when it returns.
+        """
+        self.assertTrue(self.startAndJoin())
+        self.assertEqual([True], self.runs)
+        self.assertFalse(self.worker.running)
+
+
+    def test_busy(self):
+        """
+        If work was added while exiting, the work function runs again.
+        """
+        self.busy.append(True)
+        self.startAndJoin()
+        self.assertEqual([True, True], self.runs)
+
+
+    def test_startAfterFork(self):
+        """
+        If the flag is inherited from a parent process, a new thread is
+        started.
+        """
+        self.startAndJoin()
+        self.worker.running = True
+
+        self.assertTrue(self.startAndJoin())
+        self.assertEqual(2, len(self.runs))
+
+
+    def test_stop(self):
+        """
+        A stopped thread is not started again.
+        """
+        self.worker.stop()
+        with self.lock:
+            self.assertFalse(self.worker.start())
+        self.assertIdentical(None, self.worker.thread)
+
+
+
+class UDPLogHandlerTest(unittest.TestCase):
+    """
+    Tests for L{udplog.logging.UDPLogHandler}.
+    """
+
+    def setUp(self):
+        self.udplogger = udplog.MemoryLogger()
+        self.handler = udplog.UDPLogHandler(self.udplogger, category='test')
+        self.logger = logging.Logger('test_logger')
+        self.logger.addHandler(self.handler)
+
+
+    def test_emit(self):
+        """
+        A message logged through python logging is sent out over udp.
+        """
+        self.logger.debug("Hello")
+
+        self.assertEqual(1, len(self.udplogger.logged))
+        category, eventDict = self.udplogger.logged[-1]
+
+        self.assertEqual('Hello', eventDict.get('message'))
+        self.assertEqual('DEBUG', eventDict.get('logLevel'))
+        self.assertEqual('test_logger', eventDict.get('logName'))
+        self.assertIn('timestamp', eventDict)
+
+
+    def test_emitFormatted(self):
+        """
+        Messages are formatted and arguments are included in the event.
+        """
+        self.logger.debug("Hello, %(object)s!", {'object': "world"})
+
+        self.assertEqual(1, len(self.udplogger.logged))
+        category, eventDict = self.udplogger.logged[-1]
+
+        self.assertEqual('Hello, world!', eventDict.get('message'))
+        self.assertEqual('world', eventDict.get('object'))
+
+
+    def test_emitException(self):
+        """
+        Logging an exception renders the traceback.
+        """
+        try:
+            {}['something']
+        except Exception:
+            self.logger.exception('Oops')
+
+        self.assertEqual(1, len(self.udplogger.logged))
+        _, eventDict = self.udplogger.logged[-1]
+
+        self.assertEqual('Oops', eventDict.get('message'))
+        self.assertEqual('ERROR', eventDict.get('logLevel'))
+        self.assertEqual('exceptions.KeyError', eventDict.get('excType'))
+        self.assertEqual("'something'", eventDict.get('excValue'))
+        self.assertTrue(eventDict.get('excText').startswith('Traceback'))
+
+
+    def test_emitExceptionWithoutContext(self):
+        """
+        Logging an exception without context succeeds.
+
+        If L{logging.Logger.exception} is called outside of an C{except} block,
+        exception context might be lost. The result of the internal call to
+        C{sys.exc_info} then yields a tuple of three C{None}s, which should
+        simply result in the C{excValue} being C{'None'}.
+        """
+        self.logger.exception('Oops')
+
+        self.assertEqual(1, len(self.udplogger.logged))
+        _, eventDict = self.udplogger.logged[-1]
+
+        self.assertEqual('Oops', eventDict.get('message'))
+        self.assertEqual('ERROR', eventDict.get('logLevel'))
+        self.assertIdentical('NoneType', eventDict.get('excType'))
+        self.assertEqual('None', eventDict.get('excValue'))
+        self.assertIdentical(None, eventDict['excText'])
+
+
+    def test_emit_extra(self):
+        """
+        Values passed in the extra keyword argument are added to the eventDict.
+        """
+        self.logger.debug("Hello", extra={'foo': 'bar'})
+
+        category, eventDict = self.udplogger.logged[-1]
+        self.assertIn('foo', eventDict)
+        self.assertEqual('bar', eventDict['foo'])
+
+
+    def test_emitExtraOverridesArgs(self):
+        """
+        Values passed in extra take precedence over those in the arguments.
+        """
+        self.logger.debug("Hello, %(object)s!", {'object': "world"},
+                          extra={'object': 'extra'})
+
+        category, eventDict = self.udplogger.logged[-1]
+        self.assertEqual('Hello, world!', eventDict['message'])
+        self.assertEqual('extra', eventDict['object'])
+
+
+    def test_emitCategory(self):
+        """
+        The category can be overridden in the arguments or in extra.
+        """
+        self.logger.debug("Hello", {'category': 'args'})
+        self.logger.debug("Hello", extra={'category': 'extra'})
+
+        self.assertEqual(['args', 'extra'],
+                         [category for category, _ in self.udplogger.logged])
+        for _, eventDict in self.udplogger.logged:
+            self.assertNotIn('category', eventDict)
+
+
+    def test_emitNoStandardAttributes(self):
+        """
+        Standard attributes of records are not included, even if set by an
+        earlier formatter.
+        """
+        handler = logging.StreamHandler(StringIO.StringIO())
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        self.logger.addHandler(handler)
+        self.logger.removeHandler(self.handler)
+        self.logger.addHandler(self.handler)
+
+        self.logger.debug("Hello")
+
+        category, eventDict = self.udplogger.logged[-1]
+        self.assertEqual(set(['message', 'logLevel', 'logName', 'filename',
+                              'lineno', 'funcName', 'timestamp']),
+                         set(eventDict))
+
+
+    def test_emitCustomFormatter(self):
+        """
+        A custom formatter is used to render exceptions.
+        """
+        class Formatter(logging.Formatter):
+            def formatException(self, exc_info):
+                return 'formatted'
+
+        self.handler.setFormatter(Formatter())
+
+        try:
+            {}['something']
+        except Exception:
+            self.logger.exception('Oops')
+
+        _, eventDict = self.udplogger.logged[-1]
+        self.assertEqual('Oops', eventDict['message'])
+        self.assertEqual('formatted', eventDict['excText'])
+
+
+    def test_emitExceptionFormattedOnce(self):
+        """
+        An exception rendered by an earlier handler is not rendered again.
+        """
+        record = logging.LogRecord('test_logger', logging.ERROR, __file__, 1,
+                                   'Oops', None,
+                                   (ValueError, ValueError(), None))
+        record.exc_text = 'earlier'
+        self.handler.handle(record)
+
+        _, eventDict = self.udplogger.logged[-1]
+        self.assertEqual('earlier', eventDict['excText'])
+
+
+
+    def test_dedupWindowClosedIdle(self):
+        """
+        The last repeat of a suppressed record is emitted when its window
+        closes, without logging another record.
+        """
+        self.handler.dedupWindow = 0.01
+        for _ in range(3):
+            self.logger.info("Retrying %(what)s", {'what': 'connect'})
+
+        deadline = time.time() + 5
+        while len(self.udplogger.logged) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual([None, 2],
+                         [eventDict.get('repeated')
+                          for _, eventDict in self.udplogger.logged])
+        self.handler._closer.thread.join(5)
+        self.assertFalse(self.handler._closer.thread.is_alive())
+
+
+
+class UDPLogHandlerDedupTest(unittest.TestCase):
+    """
+    Tests for duplicate suppression in L{udplog.udplog.UDPLogHandler}.
+    """
+
+    def setUp(self):
+        self.now = 1000.0
+        self.patch(time, 'time', lambda: self.now)
+
+        self.udplogger = udplog.MemoryLogger()
+        self.handler = udplog.UDPLogHandler(self.udplogger, category='test',
+                                            dedupWindow=10)
+        self.logger = logging.Logger('test_logger')
+        self.logger.addHandler(self.handler)
+
+        # The closer thread would see the patched time, too.
+        self.handler._closer.start = lambda: None
+
+
+    def logRepeated(self, n, message="Retrying %(what)s"):
+        for _ in range(n):
+            self.logger.warning(message, {'what': 'foo'})
+
+
+    def test_first(self):
+        """
+        The first of repeated records is emitted.
+        """
+        self.logRepeated(5)
+        self.assertEqual(1, len(self.udplogger.logged))
+        category, eventDict = self.udplogger.logged[-1]
+        self.assertEqual('Retrying foo', eventDict['message'])
+        self.assertNotIn('repeated', eventDict)
+
+
+    def test_windowClosed(self):
+        """
+        When the window closes, the last repeat is emitted with the count.
+        """
+        self.logRepeated(5)
+        self.now += 10
+        self.logger.info("Something else")
+
+        self.assertEqual(3, len(self.udplogger.logged))
+        category, eventDict = self.udplogger.logged[1]
+        self.assertEqual('test', category)
+        self.assertEqual('Retrying foo', eventDict['message'])
+        self.assertEqual(4, eventDict['repeated'])
+        self.assertEqual('Something else',
+                         self.udplogger.logged[2][1]['message'])
+
+
+    def test_windowClosedNoRepeats(self):
+        """
+        If there were no repeats in a window, nothing extra is emitted.
+        """
+        self.logRepeated(1)
+        self.now += 10
+        self.logger.info("Something else")
+        self.assertEqual(2, len(self.udplogger.logged))
+
+
+    def test_newWindow(self):
+        """
+        After the window closes, a new one opens with the next record.
+        """
+        self.logRepeated(2)
+        self.now += 10
+        self.logRepeated(2)
+
+        self.assertEqual([None, 1, None],
+                         [eventDict.get('repeated')
+                          for _, eventDict in self.udplogger.logged])
+
+
+    def test_distinctMessages(self):
+        """
+        Records with other message templates are not repeats.
+        """
+        self.logRepeated(2, "Retrying %(what)s")
+        self.logRepeated(2, "Giving up on %(what)s")
+        self.assertEqual(2, len(self.udplogger.logged))
+
+
+    def test_distinctCategories(self):
+        """
+        Records with other categories are not repeats.
+        """
+        self.logger.info("Hello", {'category': 'one'})
+        self.logger.info("Hello", {'category': 'two'})
+        self.assertEqual(['one', 'two'],
+                         [category for category, _ in self.udplogger.logged])
+
+
+    def test_flush(self):
+        """
+        Flushing emits the last repeat of suppressed records.
+        """
+        self.logRepeated(3)
+        self.handler.flush()
+
+        self.assertEqual(2, len(self.udplogger.logged))
+        self.assertEqual(2, self.udplogger.logged[-1][1]['repeated'])
+
+        self.handler.flush()
+        self.assertEqual(2, len(self.udplogger.logged))
+
+
+    def test_flushError(self):
+        """
+        Errors emitting the last repeat upon flushing are handled.
+        """
+        errors = []
+        self.patch(self.handler, 'handleError', errors.append)
+        self.logRepeated(3)
+
+        def log(category, eventDict):
+            raise ValueError()
+        self.patch(self.udplogger, 'log', log)
+        self.handler.flush()
+
+        self.assertEqual(1, len(errors))
+
+
+    def test_maxKeys(self):
+        """
+        If too many distinct records are tracked, the oldest is closed.
+        """
+        self.handler.dedupMaxKeys = 1
+        self.logRepeated(3, "Retrying %(what)s")
+        self.logRepeated(1, "Giving up on %(what)s")
+
+        self.assertEqual([None, 2, None],
+                         [eventDict.get('repeated')
+                          for _, eventDict in self.udplogger.logged])
+
+
+    def test_unhashable(self):
+        """
+        Records with unhashable message templates are never suppressed.
+        """
+        self.logger.info([u'unhashable'])
+        self.logger.info([u'unhashable'])
+        self.assertEqual(2, len(self.udplogger.logged))
+
+
+    def test_disabled(self):
+        """
+        Without a window, repeats are not suppressed.
+        """
+        self.handler.dedupWindow = None
+        self.logRepeated(3)
+        self.assertEqual(3, len(self.udplogger.logged))
+
+
+class BlockingMemoryLogger(udplog.MemoryLogger):
+    """
+    Memory logger that blocks logging until released.
+
+    @ivar entered: Set when an event is being logged.
+    @ivar gate: Logging proceeds once this is set.
+    """
+
+    def __init__(self):
+        udplog.MemoryLogger.__init__(self)
+        self.entered = threading.Event()
+        self.gate = threading.Event()
+
+
+    def log(self, category, eventDict):
+        self.entered.set()
+        self.gate.wait()
+        udplog.MemoryLogger.log(self, category, eventDict)
+
+
+
+class QueueingUDPLogHandlerTest(unittest.TestCase):
+    """
+    Tests for L{udplog.udplog.QueueingUDPLogHandler}.
+    """
+
+    def setUp(self):
+        self.udplogger = udplog.MemoryLogger()
+        self.handler = udplog.QueueingUDPLogHandler(self.udplogger,
+                                                    category='test')
+        self.addCleanup(self.handler.close)
+        self.logger = logging.Logger('test_logger')
+        self.logger.addHandler(self.handler)
+
+
+    def _setUpBlocking(self, overflow):
+        """
+        Set up a handler with a queue of two, that blocks on the first record.
+        """
+        self.udplogger = BlockingMemoryLogger()
+        self.addCleanup(self.udplogger.gate.set)
+        self.handler = udplog.QueueingUDPLogHandler(self.udplogger,
+                                                    category='test',
+                                                    queueSize=2,
+                                                    overflow=overflow)
+        self.addCleanup(self.handler.close)
+        self.logger = logging.Logger('test_logger')
+        self.logger.addHandler(self.handler)
+
+        self.logger.info("1")
+        self.udplogger.entered.wait()
+
+
+    def test_emit(self):
+        """
+        Records are emitted from the sender thread.
+        """
+        self.logger.info("Hello, %(object)s!", {'object': "world"})
+        self.handler.close()
+
+        self.assertEqual(1, len(self.udplogger.logged))
+        category, eventDict = self.udplogger.logged[-1]
+
+        self.assertEqual('test', category)
+        self.assertEqual('Hello, world!', eventDict.get('message'))
+        self.assertEqual('world', eventDict.get('object'))
+
+
+    def test_emitArgsChanged(self):
+        """
+        The message is formatted when the record is logged, not when it is
+        sent out.
+        """
+        self._setUpBlocking(udplog.OVERFLOW_DROP_NEW)
+        items = ['a']
+        self.logger.info("Items: %s", items)
+        items.append('b')
+
+        self.udplogger.gate.set()
+        self.handler.close()
+
+        self.assertEqual("Items: ['a']",
+                         self.udplogger.logged[-1][1]['message'])
+
+
+    def test_emitException(self):
+        """
+        The exception is rendered when the record is logged, and its
+        traceback is not queued.
+        """
+        self._setUpBlocking(udplog.OVERFLOW_DROP_NEW)
+        try:
+            {}['something']
+        except Exception:
+            self.logger.exception('Oops')
+
+        record, _ = self.handler._queue[-1]
+        self.assertIdentical(None, record.exc_info[2])
+        self.assertIdentical(None, record.args)
+
+        self.udplogger.gate.set()
+        self.handler.close()
+
+        _, eventDict = self.udplogger.logged[-1]
+        self.assertEqual('Oops', eventDict['message'])
+        self.assertIn('KeyError', eventDict['excText'])
+        self.assertEqual('exceptions.KeyError', eventDict['excType'])
+        self.assertEqual("'something'", eventDict['excValue'])
+
+
+    def test_emitRecordUnchanged(self):
+        """
+        The record passed to other handlers keeps its arguments.
+        """
+        record = logging.LogRecord('test_logger', logging.INFO, __file__, 1,
+                                   'Hello, %s!', ('world',), None)
+        self.handler.handle(record)
+        self.handler.close()
+
+        self.assertEqual(('world',), record.args)
+        self.assertEqual('Hello, world!',
+                         self.udplogger.logged[-1][1]['message'])
+
+
+    def test_emitFormatError(self):
+        """
+        Errors formatting the message are handled on the calling thread.
+        """
+        errors = []
+        self.patch(self.handler, 'handleError', errors.append)
+        self.logger.info("%d", 'a')
+        self.handler.close()
+
+        self.assertEqual(1, len(errors))
+        self.assertEqual([], self.udplogger.logged)
+
+
+    def test_emitContext(self):
+        """
+        Records get the context fields bound on the thread that logged them.
+        """
+        udplogger = udplog.UDPLogger()
+        output = []
+        self.patch(udplogger.socket, 'send', output.append)
+        self.handler.logger = udplogger
+
+        with udplogger.bind(requestId=u'abc'):
+            self.logger.info("inside")
+        self.logger.info("outside")
+        self.handler.close()
+
+        category, eventDict = udplog.unserialize(output[0])
+        self.assertEqual(u'inside', eventDict[u'message'])
+        self.assertEqual(u'abc', eventDict[u'requestId'])
+        category, eventDict = udplog.unserialize(output[1])
+        self.assertNotIn(u'requestId', eventDict)
+
+
+    def test_emitOrder(self):
+        """
+        Records are emitted in the order they were logged.
+        """
+        for i in range(100):
+            self.logger.info("%d", i)
+        self.handler.close()
+
+        self.assertEqual([str(i) for i in range(100)],
+                         [eventDict['message']
+                          for _, eventDict in self.udplogger.logged])
+
+
+    def test_flush(self):
+        """
+        Flushing emits all queued records.
+        """
+        self._setUpBlocking(udplog.OVERFLOW_DROP_NEW)
+        self.logger.info("2")
+
+        self.udplogger.gate.set()
+        self.handler.flush()
+        self.handler.close()
+
+        self.assertEqual(2, len(self.udplogger.logged))
+
+
+    def test_overflowDropNew(self):
+        """
+        With a full queue, new records are dropped and counted.
+        """
+        self._setUpBlocking(udplog.OVERFLOW_DROP_NEW)
+        for i in range(2, 5):
+            self.logger.info("%d", i)
+
+        self.udplogger.gate.set()
+        self.handler.close()
+
+        self.assertEqual(['1', '2', '3'],
+                         [eventDict['message']
+                          for _, eventDict in self.udplogger.logged])
+        self.assertEqual(1, self.handler.dropped)
+
+
+    def test_overflowMetrics(self):
+        """
+        Dropped records are counted in the metrics of the logger, if any.
+        """
+        self._setUpBlocking(udplog.OVERFLOW_DROP_NEW)
+        self.udplogger.metrics = metrics.EmissionMetrics()
+        for i in range(2, 5):
+            self.logger.info("%d", i)
+
+        self.udplogger.gate.set()
+        self.handler.close()
+
+        self.assertEqual({'queue': 1},
+                         self.udplogger.metrics.snapshot()['dropped'])
+
+
+    def test_overflowDropOld(self):
+        """
+        With a full queue, the oldest queued records are dropped and counted.
+        """
+        self._setUpBlocking(udplog.OVERFLOW_DROP_OLD)
+        for i in range(2, 5):
+            self.logger.info("%d", i)
+
+        self.udplogger.gate.set()
+        self.handler.close()
+
+        self.assertEqual(['1', '3', '4'],
+                         [eventDict['message']
+                          for _, eventDict in self.udplogger.logged])
+        self.assertEqual(1, self.handler.dropped)
+
+
+    def test_overflowConcurrent(self):
+        """
+        Records logged concurrently to a full queue are all accounted for.
+        """
+        self._setUpBlocking(udplog.OVERFLOW_DROP_NEW)
+
+        def emit():
+            for i in xrange(100):
+                self.logger.info("%d", i)
+
+        threads = [threading.Thread(target=emit) for _ in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.udplogger.gate.set()
+        self.handler.close()
+
+        self.assertEqual(3, len(self.udplogger.logged))
+        self.assertEqual(398, self.handler.dropped)
+
+
+    def test_overflowUnknown(self):
+        """
+        An unknown overflow policy is rejected.
+        """
+        self.assertRaises(ValueError, udplog.QueueingUDPLogHandler,
+                          self.udplogger, overflow='drop-all')
+
+
+class UDPLogHandlerFactoryTest(unittest.TestCase):
+    """
+    Tests for L{udplog.ConfigurableUDPLogHandler}.
+    """
+
+    def test_argsDefaults(self):
+        """
+        Without arguments, the logger and handler have their defaults.
+        """
+        handler = udplog.ConfigurableUDPLogHandler()
+        logger = handler.logger
+
+        self.assertEquals('python_logging', handler.category)
+        self.assertEquals(('127.0.0.1', 55647), logger.socket.getpeername())
+        self.assertEquals({'hostname': socket.gethostname()},
+                          logger.defaultFields)
+        self.assertIdentical(None, logger.chunkSize)
+
+
+    def test_args(self):
+        """
+        All arguments are passed on.
+        """
+        handler = udplog.ConfigurableUDPLogHandler({'foo': 'bar'}, 'test',
+                                                   '10.0.0.1', 55648, False)
+        logger = handler.logger
+
+        self.assertEquals('test', handler.category)
+        self.assertEquals(('10.0.0.1', 55648), logger.socket.getpeername())
+        self.assertNotIn('hostname', logger.defaultFields)
+        self.assertEquals('bar', logger.defaultFields['foo'])
+
+
+
+    def test_queueingArgs(self):
+        """
+        The queueing variant passes on the UDPLogger arguments.
+        """
+        handler = udplog.ConfigurableQueueingUDPLogHandler(
+            {'foo': 'bar'}, 'test', '10.0.0.1', 55648, False,
+            queueSize=5, overflow=udplog.OVERFLOW_DROP_OLD)
+        self.addCleanup(handler.close)
+        logger = handler.logger
+
+        self.assertEquals('test', handler.category)
+        self.assertEquals(5, handler.queueSize)
+        self.assertEquals(udplog.OVERFLOW_DROP_OLD, handler.overflow)
+        self.assertEquals(('10.0.0.1', 55648), logger.socket.getpeername())
+        self.assertEquals({'foo': 'bar'}, logger.defaultFields)
+
+
+    def test_queueingFileConfig(self):
+        """
+        The queueing variant can be set up from a logging configuration
+        file, that passes all arguments positionally.
+        """
+        parser = ConfigParser.ConfigParser()
+        parser.readfp(StringIO.StringIO("""
+[handlers]
+keys = udplog
+
+[handler_udplog]
+class = udplog.udplog.ConfigurableQueueingUDPLogHandler
+args = ({'foo': 'bar'}, 'test', '10.0.0.1', 55648, False, None, None, None,
+        False, 60, None, None, 'hash', False, None, 5, False, None, 5,
+        'drop-old')
+"""))
+        handler = logging.config._install_handlers(parser, {})['udplog']
+        self.addCleanup(handler.close)
+        logger = handler.logger
+
+        self.assertIsInstance(handler,
+                              udplog.ConfigurableQueueingUDPLogHandler)
+        self.assertEquals('test', handler.category)
+        self.assertEquals(60, handler.dedupWindow)
+        self.assertEquals(5, handler.queueSize)
+        self.assertEquals(udplog.OVERFLOW_DROP_OLD, handler.overflow)
+        self.assertEquals(('10.0.0.1', 55648), logger.socket.getpeername())
+        self.assertEquals({'foo': 'bar'}, logger.defaultFields)
+
+
+
+    def test_destinations(self):
+        """
+        The handler can spread events across multiple destinations.
+        """
+        destinations = [('127.0.0.1', 55701), ('127.0.0.1', 55702)]
+        handler = udplog.ConfigurableUDPLogHandler(
+            destinations=destinations, balance=udplog.BALANCE_ROUND_ROBIN)
+        logger = handler.logger
+
+        self.assertEqual(destinations, logger.destinations)
+        self.assertEqual(udplog.BALANCE_ROUND_ROBIN, logger.balance)
+
+
+    def test_nonBlocking(self):
+        """
+        The handler can use non-blocking sockets with a larger buffer.
+        """
+        handler = udplog.ConfigurableUDPLogHandler(nonBlocking=True,
+                                                   sendBufferSize=262144)
+        logger = handler.logger
+
+        self.assertTrue(logger.nonBlocking)
+        self.assertEqual(262144, logger.sendBufferSize)
+
+
+    def test_tracebackLimit(self):
+        """
+        The handler can leave out repeated tracebacks.
+        """
+        handler = udplog.ConfigurableUDPLogHandler(tracebackLimit=5)
+        tracebackFilter = handler.logger.tracebackFilter
+
+        self.assertIsInstance(tracebackFilter, tracebacks.TracebackFilter)
+        self.assertEqual(5, tracebackFilter.limit)
+
+
+    def test_socketPath(self):
+        """
+        The handler can send to a UNIX datagram socket.
+        """
+        path = self.mktemp()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(path)
+
+        handler = udplog.ConfigurableUDPLogHandler(socketPath=path)
+        logger = handler.logger
+
+        self.assertEquals(path, logger.socketPath)
+        self.assertEquals(path, logger.socket.getpeername())
@@ -0,0 +1,364 @@
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Tests for L{udplog.workers}.
+"""
+
+from __future__ import division, absolute_import
+
+import socket
+
+from twisted.internet import error, task
+from twisted.python import failure, log
+from twisted.trial import unittest
+
+from udplog import tap, workers
+from udplog.twisted import UDPLogProtocol
+
+class ReusePortUDPServerTest(unittest.TestCase):
+    """
+    Tests for L{workers.ReusePortUDPServer}.
+    """
+
+    def startServer(self, port):
+        server = workers.ReusePortUDPServer(port=port,
+                                            protocol=UDPLogProtocol(None),
+                                            interface='127.0.0.1')
+        server.startService()
+        self.addCleanup(server.stopService)
+        return server
+
+
+    def test_sharedPort(self):
+        """
+        Multiple servers can listen on the same port.
+        """
+        first = self.startServer(0)
+        port = first._port.getHost().port
+        second = self.startServer(port)
+
+        self.assertEqual(port, second._port.getHost().port)
+
+
+    def test_reusePort(self):
+        """
+        The socket has C{SO_REUSEPORT} set.
+        """
+        server = self.startServer(0)
+        self.assertTrue(server._port.socket.getsockopt(socket.SOL_SOCKET,
+                                                       socket.SO_REUSEPORT))
+
+
+
+class MergeStatsTest(unittest.TestCase):
+    """
+    Tests for L{workers.mergeStats}.
+    """
+
+    def test_sum(self):
+        """
+        Numbers are added up, also in nested dictionaries.
+        """
+        stats = workers.mergeStats([
+            {'events': 10, 'loss': {'received': 8, 'lost': 2,
+                                    'lossRate': 0.2}},
+            {'events': 5, 'loss': {'received': 10, 'lost': 0,
+                                   'lossRate': 0.0}},
+            ])
+
+        self.assertEqual(15, stats['events'])
+        self.assertEqual(18, stats['loss']['received'])
+        self.assertEqual(2, stats['loss']['lost'])
+
+
+    def test_lossRate(self):
+        """
+        The loss rate is computed from the combined counts.
+        """
+        stats = workers.mergeStats([
+            {'loss': {'received': 8, 'lost': 2, 'lossRate': 0.2}},
+            {'loss': {'received': 10, 'lost': 0, 'lossRate': 0.0}},
+            ])
+
+        self.assertEqual(0.1, stats['loss']['lossRate'])
+
+
+    def test_empty(self):
+        """
+        Without statistics, the result is empty.
+        """
+        self.assertEqual({}, workers.mergeStats([]))
+
+
+
+class ConfigTest(unittest.TestCase):
+    """
+    Tests for L{workers.dumpConfig} and L{workers.loadConfig}.
+    """
+
+    def test_roundTrip(self):
+        """
+        The configuration survives serialization.
+        """
+        config = tap.Options()
+        config.parseOptions(['--udplog-port=55648',
+                             '--redis-host=10.0.0.1',
+                             '--redis-host=10.0.0.2',
+                             '--workers=4',
+                             '--verbose'])
+
+        loaded = workers.loadConfig(workers.dumpConfig(config))
+
+        self.assertEqual(55648, loaded['udplog-port'])
+        self.assertEqual(set(['10.0.0.1', '10.0.0.2']), loaded['redis-hosts'])
+        self.assertEqual(4, loaded['workers'])
+        self.assertTrue(loaded['verbose'])
+        self.assertIsInstance(loaded['udplog-interface'], str)
+
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.written = []
+        self.signals = []
+
+
+    def write(self, data):
+        self.written.append(data)
+
+
+    def signalProcess(self, signal):
+        self.signals.append(signal)
+
+
+
+class FakeReactor(task.Clock):
+    """
+    Clock that records spawned processes.
+    """
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.spawned = []
+
+
+    def spawnProcess(self, processProtocol, executable, args, env):
+        self.spawned.append((processProtocol, executable, args))
+        processProtocol.makeConnection(FakeTransport())
+
+
+
+class WorkerProtocolTest(unittest.TestCase):
+    """
+    Tests for L{workers.WorkerProtocol}.
+    """
+
+    def setUp(self):
+        self.config = tap.Options()
+        self.supervisor = workers.Supervisor(self.config, 1,
+                                             reactor=FakeReactor())
+        self.protocol = workers.WorkerProtocol(self.supervisor, 0)
+        self.transport = FakeTransport()
+        self.protocol.makeConnection(self.transport)
+
+
+    def test_config(self):
+        """
+        The configuration is written to the worker, on a single line.
+        """
+        data = b''.join(self.transport.written)
+        self.assertTrue(data.endswith(b'\n'))
+        loaded = workers.loadConfig(data)
+        self.assertEqual(self.config['udplog-port'], loaded['udplog-port'])
+
+
+    def test_stats(self):
+        """
+        Statistics lines are passed to the supervisor.
+        """
+        self.protocol.outReceived(b'{"events": ')
+        self.protocol.outReceived(b'1}\n{"events": 2}\n')
+
+        self.assertEqual(2, self.supervisor.stats()['events'])
+
+
+    def test_statsMalformed(self):
+        """
+        Malformed statistics are logged.
+        """
+        self.protocol.outReceived(b'{\n')
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+
+
+    def test_errReceived(self):
+        """
+        Lines on standard error are logged.
+        """
+        events = []
+        log.addObserver(events.append)
+        self.addCleanup(log.removeObserver, events.append)
+
+        self.protocol.errReceived(b'Something\nhap')
+        self.protocol.errReceived(b'pened\n')
+
+        self.assertEqual([('Something',), ('happened',)],
+                         [event['message'] for event in events])
+        self.assertEqual('udplog-worker-0', events[0]['system'])
+
+
+    def test_processEnded(self):
+        """
+        When the process has ended, the supervisor is notified.
+        """
+        self.supervisor.workers[0] = self.protocol
+        self.protocol.processEnded(failure.Failure(error.ProcessDone(0)))
+
+        self.assertNotIn(0, self.supervisor.workers)
+        self.assertTrue(self.protocol.ended.called)
+
+
+
+class SupervisorTest(unittest.TestCase):
+    """
+    Tests for L{workers.Supervisor}.
+    """
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.supervisor = workers.Supervisor(tap.Options(), 2,
+                                             statsInterval=60,
+                                             reactor=self.reactor,
+                                             executable='python')
+
+
+    def endWorker(self, index):
+        worker = self.supervisor.workers[index]
+        worker.processEnded(failure.Failure(error.ProcessTerminated(1)))
+
+
+    def test_startService(self):
+        """
+        Starting the service spawns the workers.
+        """
+        self.supervisor.startService()
+
+        self.assertEqual([['python', '-m', 'udplog.workers', '0'],
+                          ['python', '-m', 'udplog.workers', '1']],
+                         [args for _, _, args in self.reactor.spawned])
+        self.assertEqual([0, 1], sorted(self.supervisor.workers))
+
+
+    def test_restart(self):
+        """
+        A worker that ended is restarted after a delay.
+        """
+        self.supervisor.startService()
+        self.endWorker(1)
+
+        self.assertEqual([0], sorted(self.supervisor.workers))
+        self.reactor.advance(self.supervisor.restartDelay)
+
+        self.assertEqual([0, 1], sorted(self.supervisor.workers))
+        self.assertEqual(3, len(self.reactor.spawned))
+        self.assertEqual(1, self.supervisor.restarts)
+
+
+    def test_stopService(self):
+        """
+        Stopping the service terminates the workers, without restarting
+        them.
+        """
+        self.supervisor.startService()
+        transports = [worker.transport
+                      for worker in self.supervisor.workers.values()]
+
+        d = self.supervisor.stopService()
+        self.assertEqual([['TERM'], ['TERM']],
+                         [transport.signals for transport in transports])
+
+        self.endWorker(0)
+        self.endWorker(1)
+        self.reactor.advance(self.supervisor.restartDelay)
+
+        self.assertEqual(2, len(self.reactor.spawned))
+        self.successResultOf(d)
+
+
+    def test_stats(self):
+        """
+        The statistics of the running workers are combined.
+        """
+        self.supervisor.startService()
+        self.supervisor.statsReceived(0, {'events': 3})
+        self.supervisor.statsReceived(1, {'events': 4})
+        self.supervisor.statsReceived(1, {'events': 5})
+
+        stats = self.supervisor.stats()
+        self.assertEqual(8, stats['events'])
+        self.assertEqual(2, stats['workers'])
+        self.assertEqual(0, stats['restarts'])
+
+
+    def test_statsEnded(self):
+        """
+        The statistics of a worker that ended are dropped.
+        """
+        self.supervisor.startService()
+        self.supervisor.statsReceived(0, {'events': 3})
+        self.endWorker(0)
+
+        self.assertNotIn('events', self.supervisor.stats())
+
+
+    def test_logStats(self):
+        """
+        The combined statistics are logged periodically.
+        """
+        events = []
+        log.addObserver(events.append)
+        self.addCleanup(log.removeObserver, events.append)
+
+        self.supervisor.startService()
+        self.supervisor.statsReceived(0, {'events': 3})
+        self.reactor.advance(60)
+
+        messages = [log.textFromEventDict(event) for event in events]
+        self.assertIn('Worker statistics: {"events": 3, "restarts": 0, '
+                      '"workers": 2}', messages)
+
+
+
+class MakeServiceTest(unittest.TestCase):
+    """
+    Tests for L{tap.makeService} with workers.
+    """
+
+    def test_workers(self):
+        """
+        With workers, the service is a supervisor.
+        """
+        config = tap.Options()
+        config.parseOptions(['--workers=3'])
+
+        service = tap.makeService(config)
+
+        self.assertIsInstance(service, workers.Supervisor)
+        self.assertEqual(3, service.count)
+
+
+    def test_stats(self):
+        """
+        The server service reports statistics.
+        """
+        config = tap.Options()
+        config.parseOptions([])
+
+        service = tap.makeServerService(config)
+
+        stats = service.stats()
+        self.assertEqual(0, stats['events'])
+        self.assertEqual(0, stats['loss']['lost'])
+        self.assertEqual(0, stats['chunksExpired'])
+        self.assertEqual(0, stats['malformed'])
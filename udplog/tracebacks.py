@@ -0,0 +1,136 @@
+# -*- test-case-name: udplog.test.test_tracebacks -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Fingerprinting and deduplication of tracebacks.
+
+In a failure storm, the same exception is logged over and over again, each
+time with its full traceback. A L{TracebackFilter} identifies tracebacks by
+their L{fingerprint}, and leaves out the traceback text from events once it
+has been sent a number of times, keeping only the fingerprint and a counter.
+On the receiving end, L{udplog.twisted.TracebackCache} can put the text back
+in.
+"""
+
+from __future__ import division, absolute_import
+
+from collections import OrderedDict
+import hashlib
+import threading
+
+DEFAULT_LIMIT = 3
+DEFAULT_WINDOW = 60
+DEFAULT_MAX_FINGERPRINTS = 1000
+
+def fingerprint(excText, excType=None):
+    """
+    Compute the fingerprint of a traceback.
+
+    The fingerprint covers the exception type and the location of every
+    frame, but not the exception value or the source lines. This way,
+    exceptions raised from the same place have the same fingerprint, even if
+    their values differ, for example by including an identifier.
+
+    Traceback text without frames, as rendered by L{traceback} or Twisted's
+    L{Failure<twisted.python.failure.Failure>}, is fingerprinted as a whole.
+
+    @param excText: The traceback text.
+    @type excText: L{unicode} or L{bytes}
+
+    @param excType: The qualified name of the exception type.
+    @type excType: L{str}
+
+    @return: The fingerprint, as 16 hexadecimal digits.
+    @rtype: L{str}
+    """
+    if isinstance(excText, unicode):
+        excText = excText.encode('utf-8')
+    if isinstance(excType, unicode):
+        excType = excType.encode('utf-8')
+
+    frames = [line.strip() for line in excText.splitlines()
+              if line.startswith('  File ')]
+
+    digest = hashlib.sha1(excType or b'')
+    if frames:
+        for frame in frames:
+            digest.update(b'\n')
+            digest.update(frame)
+    else:
+        digest.update(b'\n')
+        digest.update(excText)
+    return digest.hexdigest()[:16]
+
+
+
+class TracebackFilter(object):
+    """
+    Filter that leaves out repeated tracebacks from events.
+
+    Every event with an C{'excText'} field gets an C{'excFingerprint'}
+    field with the L{fingerprint} of the traceback. The first C{limit}
+    events with a fingerprint in a window of C{window} seconds keep their
+    traceback text. After that, the text is removed, and an C{'excRepeated'}
+    field holds the number of events with that fingerprint so far in the
+    window. The window starts with the first event with the fingerprint.
+
+    @ivar limit: Number of times to send a traceback in full per window.
+    @type limit: L{int}
+
+    @ivar window: Number of seconds in a window.
+    @type window: L{float}
+
+    @ivar maxFingerprints: Maximum number of fingerprints to track. If
+        exceeded, the least recently seen one is forgotten.
+    @type maxFingerprints: L{int}
+    """
+
+    def __init__(self, limit=DEFAULT_LIMIT, window=DEFAULT_WINDOW,
+                       maxFingerprints=DEFAULT_MAX_FINGERPRINTS):
+        self.limit = limit
+        self.window = window
+        self.maxFingerprints = maxFingerprints
+
+        self._lock = threading.Lock()
+
+        # Maps fingerprints to the start of their window and the number of
+        # events in it, in order of last occurrence.
+        self._seen = OrderedDict()
+
+
+    def filter(self, eventDict, now):
+        """
+        Fingerprint the traceback of an event and remove it if repeated.
+
+        Events without an C{'excText'} field are left alone.
+
+        @param eventDict: The event, modified in place.
+        @type eventDict: L{dict}
+
+        @param now: The current time.
+        @type now: L{float}
+        """
+        excText = eventDict.get('excText')
+        if not excText:
+            return
+
+        key = fingerprint(excText, eventDict.get('excType'))
+        eventDict['excFingerprint'] = key
+
+        with self._lock:
+            entry = self._seen.pop(key, None)
+            if entry is None or now - entry[0] >= self.window:
+                if (entry is None and
+                    len(self._seen) >= self.maxFingerprints):
+                    self._seen.popitem(last=False)
+                entry = [now, 0]
+            self._seen[key] = entry
+
+            entry[1] += 1
+            count = entry[1]
+
+        if count > self.limit:
+            del eventDict['excText']
+            eventDict['excRepeated'] = count
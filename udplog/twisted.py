@@ -14,7 +14,8 @@ Logging system and various helpers for creating a UDP Log server.
 
 from __future__ import division, absolute_import
 
-from collections import deque
+from collections import deque, MutableMapping, OrderedDict
+import copy
 import logging
 
 import simplejson
@@ -28,7 +29,7 @@ from twisted.python import log
 from twisted.python import reflect
 from twisted.python.failure import Failure
 
-from udplog import udplog
+from udplog import compression, udplog
 
 class UDPLogObserver(object):
     """
@@ -174,38 +175,735 @@ class TwistedLogHandler(logging.Handler):
 
 
 
+class ChunkReassembler(object):
+    """
+    Reassembler of datagrams split into chunks.
+
+    Chunks of incomplete datagrams are kept in a table that is limited in
+    size and time. If the table is full, either by the number of incomplete
+    datagrams or by the total size of their chunks, the oldest incomplete
+    datagrams are evicted. Incomplete datagrams older than the timeout are
+    discarded. Datagrams that would be larger than C{maxMessageSize} are
+    rejected.
+
+    @ivar timeout: Maximum number of seconds to wait for all chunks of a
+        datagram.
+    @type timeout: L{float}
+
+    @ivar maxPending: Maximum number of incomplete datagrams.
+    @type maxPending: L{int}
+
+    @ivar maxPendingBytes: Maximum total size of the chunks of incomplete
+        datagrams, in bytes. This is checked for every chunk added, evicting
+        other datagrams than the one the chunk belongs to.
+    @type maxPendingBytes: L{int}
+
+    @ivar maxMessageSize: Maximum size of a reassembled datagram, in bytes.
+        Chunks are rejected if their size times the number of chunks exceeds
+        this.
+    @type maxMessageSize: L{int}
+
+    @ivar pendingBytes: Total size of the chunks of incomplete datagrams.
+    @type pendingBytes: L{int}
+
+    @ivar expired: Number of incomplete datagrams discarded after the
+        timeout.
+    @type expired: L{int}
+
+    @ivar evicted: Number of incomplete datagrams discarded because the table
+        was full.
+    @type evicted: L{int}
+
+    @ivar rejected: Number of datagrams rejected for being too large.
+    @type rejected: L{int}
+    """
+
+    def __init__(self, timeout=5, maxPending=1000,
+                       maxPendingBytes=64 * 1024 * 1024,
+                       maxMessageSize=1024 * 1024, clock=None):
+        """
+        @param clock: An object which provides
+            L{twisted.internet.interfaces.IReactorTime}.
+        """
+        self.timeout = timeout
+        self.maxPending = maxPending
+        self.maxPendingBytes = maxPendingBytes
+        self.maxMessageSize = maxMessageSize
+        self.pendingBytes = 0
+        self.expired = 0
+        self.evicted = 0
+        self.rejected = 0
+
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self._clock = clock
+
+        # Maps (addr, messageId) to [started, total, chunks, size], in order
+        # of arrival of the first chunk.
+        self._pending = OrderedDict()
+
+
+    def _discard(self, key):
+        """
+        Discard an incomplete datagram.
+        """
+        self.pendingBytes -= self._pending.pop(key)[3]
+
+
+    def _expire(self, now):
+        """
+        Discard incomplete datagrams older than the timeout.
+        """
+        while self._pending:
+            key, entry = next(self._pending.iteritems())
+            if now - entry[0] < self.timeout:
+                break
+            self._discard(key)
+            self.expired += 1
+
+
+    def _evict(self, key, size):
+        """
+        Evict the oldest incomplete datagrams other than the one being
+        filled, to make room for C{size} more bytes, and for that datagram
+        itself if it is new.
+
+        @param key: The key of the datagram being filled.
+        """
+        new = key not in self._pending
+        while ((new and len(self._pending) >= self.maxPending) or
+               self.pendingBytes + size > self.maxPendingBytes):
+            oldest = next((other for other in self._pending if other != key),
+                          None)
+            if oldest is None:
+                break
+            self._discard(oldest)
+            self.evicted += 1
+
+
+    def chunkReceived(self, chunk, addr):
+        """
+        Add a chunk.
+
+        @param addr: The address of the sender.
+
+        @return: The reassembled datagram if this was its last missing chunk,
+            otherwise C{None}.
+
+        @raise ValueError: If the chunk is malformed or its datagram too
+            large.
+        """
+        messageId, seq, total, payload = udplog.parseChunk(chunk)
+
+        now = self._clock.seconds()
+        self._expire(now)
+
+        key = (addr, messageId)
+        entry = self._pending.get(key)
+
+        if entry is not None and total != entry[1]:
+            self._discard(key)
+            raise ValueError("Inconsistent number of chunks for message "
+                             "%d" % (messageId,))
+
+        chunks = entry[2] if entry is not None else {}
+        size = ((entry[3] if entry is not None else 0) + len(payload) -
+                len(chunks.get(seq, b'')))
+        if len(payload) * total > self.maxMessageSize:
+            if entry is not None:
+                self._discard(key)
+            self.rejected += 1
+            raise ValueError("Message %d exceeds %d bytes" %
+                             (messageId, self.maxMessageSize))
+
+        self._evict(key, size - (entry[3] if entry is not None else 0))
+        if entry is None:
+            entry = self._pending[key] = [now, total, chunks, 0]
+
+        chunks[seq] = payload
+        self.pendingBytes += size - entry[3]
+        entry[3] = size
+
+        if len(chunks) < total:
+            return None
+
+        self._discard(key)
+        return b''.join(chunks[i] for i in xrange(total))
+
+
+
+class SequenceTracker(object):
+    """
+    Tracker of lost, reordered and duplicated events.
+
+    Senders that stamp events with a C{senderId} and consecutive C{sequence}
+    numbers (see L{udplog.udplog.UDPLogger}) allow for accounting for events
+    that did not arrive. For every sender, this tracks the highest sequence
+    number received and the missing ones below it. Missing sequence numbers
+    count as lost, until they arrive late, in which case they count as
+    reordered instead. Sequence numbers that are not missing count as
+    duplicates.
+
+    The table of senders is limited in size, evicting the least recently
+    seen sender when full. Per sender, only the most recent C{window}
+    missing sequence numbers are remembered. Events that arrive later than
+    that count as both lost and duplicated.
+
+    @ivar maxSenders: Maximum number of senders to track.
+    @type maxSenders: L{int}
+
+    @ivar window: Maximum number of missing sequence numbers to remember per
+        sender.
+    @type window: L{int}
+    """
+
+    def __init__(self, maxSenders=1000, window=1000):
+        self.maxSenders = maxSenders
+        self.window = window
+
+        self.received = 0
+        self.lost = 0
+        self.reordered = 0
+        self.duplicates = 0
+        self.evicted = 0
+
+        # Maps senderId to [highest, missing], in order of last arrival.
+        # The missing sequence numbers are in an OrderedDict, oldest first.
+        self._senders = OrderedDict()
+
+
+    def eventReceived(self, event):
+        """
+        Account for a received event.
+
+        Events without a sender identifier or sequence number are ignored.
+
+        @type event: L{dict}
+        """
+        senderId = event.get('senderId')
+        sequence = event.get('sequence')
+        if senderId is None or not isinstance(sequence, (int, long)):
+            return
+
+        self.received += 1
+
+        try:
+            state = self._senders.pop(senderId)
+        except KeyError:
+            if len(self._senders) >= self.maxSenders:
+                self._senders.popitem(last=False)
+                self.evicted += 1
+            self._senders[senderId] = [sequence, OrderedDict()]
+            return
+
+        self._senders[senderId] = state
+        highest, missing = state
+
+        if sequence > highest:
+            self.lost += sequence - highest - 1
+            for number in xrange(max(highest + 1, sequence - self.window),
+                                 sequence):
+                missing[number] = None
+            while len(missing) > self.window:
+                missing.popitem(last=False)
+            state[0] = sequence
+        elif sequence in missing:
+            del missing[sequence]
+            self.lost -= 1
+            self.reordered += 1
+        else:
+            self.duplicates += 1
+
+
+    def snapshot(self):
+        """
+        Get the current values of all counters.
+
+        @return: A dictionary with the numbers of senders tracked, events
+            received, lost, reordered and duplicated, senders evicted and
+            the loss rate: the fraction of events that were sent, but not
+            received.
+        @rtype: L{dict}
+        """
+        sent = self.received + self.lost
+        return {
+            'senders': len(self._senders),
+            'received': self.received,
+            'lost': self.lost,
+            'reordered': self.reordered,
+            'duplicates': self.duplicates,
+            'evicted': self.evicted,
+            'lossRate': self.lost / sent if sent else 0.0,
+            }
+
+
+
+class TracebackCache(object):
+    """
+    Cache of tracebacks by fingerprint.
+
+    Senders with a L{TracebackFilter<udplog.tracebacks.TracebackFilter>}
+    leave out the traceback text of repeated exceptions, keeping only its
+    C{'excFingerprint'}. This remembers the traceback text of events that
+    have both, and puts it back in events that only have the fingerprint.
+    If the fingerprint is unknown, for example because the server restarted,
+    the event is passed on without traceback text.
+
+    The cache is limited in size, evicting the least recently used
+    traceback when full.
+
+    @ivar maxSize: Maximum number of tracebacks to keep.
+    @type maxSize: L{int}
+
+    @ivar restored: Number of events that got their traceback text back.
+    @type restored: L{int}
+
+    @ivar missed: Number of events with an unknown fingerprint.
+    @type missed: L{int}
+    """
+
+    def __init__(self, maxSize=1000):
+        self.maxSize = maxSize
+        self.restored = 0
+        self.missed = 0
+
+        # Maps fingerprints to traceback text, in order of last use.
+        self._tracebacks = OrderedDict()
+
+
+    def eventReceived(self, event):
+        """
+        Remember or restore the traceback text of an event.
+
+        @param event: The event, modified in place.
+        @type event: L{dict}
+        """
+        key = event.get('excFingerprint')
+        if key is None:
+            return
+
+        tracebacks = self._tracebacks
+        excText = event.get('excText')
+        if excText:
+            tracebacks.pop(key, None)
+            if len(tracebacks) >= self.maxSize:
+                tracebacks.popitem(last=False)
+            tracebacks[key] = excText
+            return
+
+        try:
+            excText = tracebacks.pop(key)
+        except KeyError:
+            self.missed += 1
+        else:
+            tracebacks[key] = excText
+            event['excText'] = excText
+            self.restored += 1
+
+
+
+class Event(dict):
+    """
+    Log event that keeps its serialization in JSON.
+
+    Events received by L{UDPLogProtocol} hold on to the JSON they were
+    decoded from, so that backends passing them on as JSON can reuse those
+    bytes, instead of each encoding the event again (see L{encodeEvent}).
+    Encodings are cached, and discarded as soon as the event is modified.
+    Backends that transform events should do so on a copy, to not defeat
+    the cache for others.
+    """
+
+    _body = None
+    _json = None
+
+    @classmethod
+    def fromJSON(cls, category, data):
+        """
+        Create an event from its category and JSON encoding.
+
+        @param category: The category, added to the event as C{'category'}.
+        @type category: L{bytes}
+
+        @param data: The event dictionary, serialized as JSON.
+        @type data: L{bytes}
+
+        @raise ValueError: If C{data} is not valid JSON.
+        @raise TypeError: If C{data} does not encode a dictionary.
+        """
+        eventDict = simplejson.loads(data)
+        if not isinstance(eventDict, dict):
+            raise TypeError("Event is not a dictionary: %r" % (eventDict,))
+
+        event = cls(eventDict)
+        if 'category' not in eventDict:
+            event._body = data
+        dict.__setitem__(event, 'category', category)
+        return event
+
+
+    def _changed(self):
+        self._body = None
+        self._json = None
+
+
+    def __setitem__(self, key, value):
+        self._changed()
+        dict.__setitem__(self, key, value)
+
+
+    def __delitem__(self, key):
+        self._changed()
+        dict.__delitem__(self, key)
+
+
+    def clear(self):
+        self._changed()
+        dict.clear(self)
+
+
+    def pop(self, *args):
+        self._changed()
+        return dict.pop(self, *args)
+
+
+    def popitem(self):
+        self._changed()
+        return dict.popitem(self)
+
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._changed()
+        return dict.setdefault(self, key, default)
+
+
+    def update(self, *args, **kwargs):
+        self._changed()
+        dict.update(self, *args, **kwargs)
+
+
+    def toJSON(self, withCategory=True):
+        """
+        Serialize the event to JSON.
+
+        @param withCategory: Whether to include the C{'category'} field.
+        @type withCategory: L{bool}
+
+        @rtype: L{bytes}
+        """
+        if not withCategory:
+            if self._body is None:
+                eventDict = dict(self)
+                eventDict.pop('category', None)
+                self._body = simplejson.dumps(eventDict)
+            return self._body
+
+        if self._json is None:
+            if self._body is None or 'category' not in self:
+                self._json = simplejson.dumps(self)
+            else:
+                self._json = _addCategory(self['category'], self._body)
+        return self._json
+
+
+
+class LazyEvent(MutableMapping):
+    """
+    Log event that is decoded from JSON on first access of its fields.
+
+    Only the category is available without decoding. Like L{Event}, the
+    original JSON is reused by L{encodeEvent}, so backends that pass events
+    on as JSON do not decode them at all.
+
+    As decoding is deferred, so is the detection of malformed JSON. Only the
+    outer braces are checked up front, catching truncated events. Otherwise,
+    events are passed on unchecked, and accessing the fields of a malformed
+    event raises L{ValueError} or L{TypeError}, calling C{malformed} once.
+    """
+
+    def __init__(self, category, data, malformed=None):
+        """
+        @param category: The category, added to the event as C{'category'}.
+        @type category: L{bytes}
+
+        @param data: The event dictionary, serialized as JSON.
+        @type data: L{bytes}
+
+        @param malformed: Called without arguments if C{data} turns out to
+            be malformed when decoded.
+
+        @raise ValueError: If C{data} is not enclosed in braces, ignoring
+            surrounding whitespace.
+        """
+        data = data.strip()
+        if not (data.startswith('{') and data.endswith('}')):
+            raise ValueError("Malformed event: %r" % (data,))
+
+        self._category = category
+        self._data = data
+        self._malformed = malformed
+        self._event = None
+        self._error = None
+        self._json = None
+
+
+    def decode(self):
+        """
+        Decode the event, calling C{malformed} once if that fails.
+
+        @rtype: L{Event}
+        """
+        if self._event is None:
+            if self._error is not None:
+                raise self._error
+
+            try:
+                self._event = Event.fromJSON(self._category, self._data)
+            except (ValueError, TypeError), e:
+                self._error = e
+                if self._malformed is not None:
+                    self._malformed()
+                raise
+        return self._event
+
+
+    def __getitem__(self, key):
+        if key == 'category' and self._event is None:
+            return self._category
+        return self.decode()[key]
+
+
+    def __setitem__(self, key, value):
+        self.decode()[key] = value
+
+
+    def __delitem__(self, key):
+        del self.decode()[key]
+
+
+    def __iter__(self):
+        return iter(self.decode())
+
+
+    def __len__(self):
+        return len(self.decode())
+
+
+    def __copy__(self):
+        return copy.copy(self.decode())
+
+
+    def __repr__(self):
+        return '<LazyEvent %r: %r>' % (self._category, self._data)
+
+
+    def toJSON(self, withCategory=True):
+        """
+        Serialize the event to JSON.
+
+        Unless the event was decoded or the original JSON has a category
+        field of its own, the original JSON is used as is, without checking
+        that it is valid. This skips parsing it, building an L{Event} and
+        encoding it again.
+
+        @param withCategory: Whether to include the C{'category'} field.
+        @type withCategory: L{bool}
+
+        @rtype: L{bytes}
+        """
+        if self._event is not None or '"category"' in self._data:
+            return self.decode().toJSON(withCategory)
+
+        if not withCategory:
+            return self._data
+
+        if self._json is None:
+            self._json = _addCategory(self._category, self._data)
+        return self._json
+
+
+
+def _addCategory(category, body):
+    """
+    Add the category field to an event dictionary serialized as JSON.
+    """
+    category = simplejson.dumps(category)
+    rest = body[1:].lstrip()
+    if rest.startswith('}'):
+        return '{"category": %s}' % (category,)
+    else:
+        return '{"category": %s, %s' % (category, rest)
+
+
+
+def encodeEvent(event, withCategory=True):
+    """
+    Serialize a log event to JSON.
+
+    For an L{Event} or L{LazyEvent}, this reuses its cached encoding.
+
+    @param event: The log event.
+    @type event: L{dict}
+
+    @param withCategory: Whether to include the C{'category'} field.
+    @type withCategory: L{bool}
+
+    @rtype: L{bytes}
+    """
+    if isinstance(event, (Event, LazyEvent)):
+        return event.toJSON(withCategory)
+
+    if not withCategory and 'category' in event:
+        event = dict(event)
+        del event['category']
+    return simplejson.dumps(event)
+
+
+
 class UDPLogProtocol(protocol.DatagramProtocol):
     """
     UDP Log protocol.
 
     Log events are received as combination of category and a message, separated
     by a colon. This message is a dictionary encoded in JSON. Upon receiving
-    an event, it is decoded and passed to L{eventReceived}.
+    an event, it is decoded and passed to L{eventReceived}, as an L{Event}
+    that keeps the JSON encoding.
+
+    A datagram may contain multiple events, separated by newlines (see
+    L{udplog.udplog.splitDatagram}). Each is decoded and passed on
+    separately.
+
+    Datagrams that were split into chunks by the sender are reassembled with
+    a L{ChunkReassembler}. Compressed datagrams are decompressed (see
+    L{udplog.compression}).
+
+    Events with sequence numbers are accounted for by a L{SequenceTracker},
+    which may be shared between protocols. If C{tracebacks} is set, left out
+    traceback text is restored from that L{TracebackCache}.
+
+    If C{lazy} is set, events are passed on as L{LazyEvent}s, that are only
+    decoded when their fields are accessed. Events with sequence numbers
+    or, with C{tracebacks} set, traceback fingerprints are still decoded
+    right away.
+
+    @ivar malformed: Number of events that could not be decoded, including
+        those of lazy events found to be malformed later.
+    @type malformed: L{int}
     """
 
-    def __init__(self, callback):
+    def __init__(self, callback, reassembler=None, tracker=None,
+                       tracebacks=None, lazy=False):
         self.callback = callback
 
+        if reassembler is None:
+            reassembler = ChunkReassembler()
+        self.reassembler = reassembler
+
+        if tracker is None:
+            tracker = SequenceTracker()
+        self.tracker = tracker
+        self.tracebacks = tracebacks
+        self.lazy = lazy
+        self.malformed = 0
+
+
+    def _mustDecode(self, data):
+        return ('"senderId"' in data or
+                (self.tracebacks is not None and '"excFingerprint"' in data))
+
+
+    def eventMalformed(self):
+        """
+        Called when an event could not be decoded.
+        """
+        self.malformed += 1
+
+
     def datagramReceived(self, datagram, addr):
-        data = datagram.rstrip()
+        if datagram.startswith(udplog.CHUNK_MAGIC):
+            try:
+                datagram = self.reassembler.chunkReceived(datagram, addr)
+            except ValueError:
+                log.err()
+                return
 
-        try:
-            category, event = udplog.unserialize(data)
-            event['category'] = category
-        except (ValueError, TypeError):
-            log.err()
-            return
+            if datagram is None:
+                return
+
+        if compression.isCompressed(datagram):
+            try:
+                datagram = compression.decompress(datagram)
+            except ValueError:
+                log.err()
+                return
+
+        for data in udplog.splitDatagram(datagram):
+            try:
+                category, data = udplog.splitEvent(data)
+                if self.lazy and not self._mustDecode(data):
+                    event = LazyEvent(category, data, self.eventMalformed)
+                else:
+                    event = Event.fromJSON(category, data)
+            except (ValueError, TypeError):
+                self.eventMalformed()
+                log.err()
+                continue
+
+            if isinstance(event, Event):
+                self.tracker.eventReceived(event)
+                if self.tracebacks is not None:
+                    self.tracebacks.eventReceived(event)
+            self.callback(event)
 
-        self.callback(event)
 
 
 class Dispatcher(object):
     """
     Adapter from UDPLogProtocol to a consumer of log events.
+
+    Consumers registered with L{register} are called with every single
+    event, as it is received. Batch consumers, registered with
+    L{registerBatch}, are instead called with a list of events, gathered
+    until C{batchDelay} seconds after the first. With the default delay of
+    0, a batch holds all events from the datagrams read in one iteration of
+    the reactor. This allows backends to send out many events at once. Batch
+    consumers must not modify the list, as it is shared among them.
+
+    @ivar batchDelay: Number of seconds to gather events for batch
+        consumers.
+    @type batchDelay: L{float}
+
+    @ivar maxBatchSize: Maximum number of events in a batch. When reached,
+        the batch is passed on right away.
+    @type maxBatchSize: L{int}
+
+    @ivar received: Number of events dispatched.
+    @type received: L{int}
+
+    @ivar batches: Number of batches dispatched.
+    @type batches: L{int}
     """
 
-    def __init__(self):
+    def __init__(self, batchDelay=0, maxBatchSize=1000, clock=None):
+        """
+        @param clock: An object which provides
+            L{twisted.internet.interfaces.IReactorTime}.
+        """
+        self.batchDelay = batchDelay
+        self.maxBatchSize = maxBatchSize
+
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+
         self._consumers = set()
+        self._batchConsumers = set()
+        self._batch = []
+        self._flushCall = None
+        self.received = 0
+        self.batches = 0
 
 
     def register(self, consumer):
@@ -219,13 +917,59 @@ class Dispatcher(object):
             pass
 
 
+    def registerBatch(self, consumer):
+        """
+        Register a consumer of lists of events.
+        """
+        self._batchConsumers.add(consumer)
+
+
+    def unregisterBatch(self, consumer):
+        try:
+            self._batchConsumers.remove(consumer)
+        except KeyError:
+            pass
+
+
     def eventReceived(self, event):
+        self.received += 1
         for consumer in self._consumers:
             try:
                 consumer(event)
             except:
                 log.err()
 
+        if not self._batchConsumers:
+            return
+
+        self._batch.append(event)
+        if len(self._batch) >= self.maxBatchSize:
+            self.flush()
+        elif self._flushCall is None:
+            self._flushCall = self._clock.callLater(self.batchDelay,
+                                                    self.flush)
+
+
+    def flush(self):
+        """
+        Pass the gathered events to the batch consumers.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+
+        events, self._batch = self._batch, []
+        if not events:
+            return
+
+        self.batches += 1
+        for consumer in list(self._batchConsumers):
+            try:
+                consumer(events)
+            except:
+                log.err()
+
 
 
 class QueueProducer(object):
@@ -388,4 +1132,4 @@ class UDPLogToTwistedLog(object):
 
 
     def sendEvent(self, eventDict):
-        log.msg(simplejson.dumps(eventDict, indent=4, sort_keys=True))
+        log.msg(simplejson.dumps(dict(eventDict), indent=4, sort_keys=True))
@@ -16,27 +16,92 @@ on the Twisted reactor and can be used in any Python project.
 
 from __future__ import division, absolute_import
 
+import atexit
+import bisect
+from collections import deque, OrderedDict
+import copy
+import errno
+import itertools
 import logging
+import os
+import random
+import re
 import socket
+import struct
+import threading
 import time
+import traceback
+import weakref
+import zlib
 
 import simplejson
 
 from twisted.python import reflect
 from twisted.python.failure import Failure
 
+from udplog import aggregation, compression, encoding, metrics, tracebacks
+
 MAX_TRIMMED_MESSAGE_SIZE = 200
 
 DEFAULT_HOST = "127.0.0.1"
 DEFAULT_PORT = 55647
 
+# Multiple serialized events can be packed into one datagram, separated by
+# newlines. As JSON encoding escapes control characters, the serialized events
+# of UDPLogger themselves never contain newlines. Other senders may send
+# single events with JSON spread over multiple lines, so only newlines
+# followed by a category and a colon start a new event. Lines of JSON never
+# start like that, as colons follow quoted keys.
+EVENT_SEPARATOR = b'\n'
+_EVENT_START = re.compile(r'[^\s"{}\[\],:]+:')
+
+DEFAULT_BATCH_INTERVAL = 1
+
+# Datagrams that are too large can be split into chunks. Each chunk starts
+# with CHUNK_MAGIC, which cannot start a category, followed by a header with
+# the message identifier, the sequence number of the chunk and the total
+# number of chunks.
+CHUNK_MAGIC = b'\x1e'
+_CHUNK_HEADER = struct.Struct('!QHH')
+CHUNK_HEADER_SIZE = len(CHUNK_MAGIC) + _CHUNK_HEADER.size
+MAX_CHUNKS = 0xffff
+
+# Keep chunks within the payload size of a UDP datagram on Ethernet.
+DEFAULT_CHUNK_SIZE = 1400
+
+DEFAULT_QUEUE_SIZE = 10000
+
+# Ways to spread events across multiple destinations.
+BALANCE_HASH = 'hash'
+BALANCE_ROUND_ROBIN = 'round-robin'
+
+# Number of seconds to skip a destination that refused a datagram.
+DEFAULT_COOLDOWN = 30
+
+# Number of seconds to drop events after a send failed because nothing
+# listens at the destination, and the errors that cause this.
+DEFAULT_BACKOFF = 5
+BACKOFF_ERRORS = frozenset([errno.ECONNREFUSED, errno.ENOENT])
+
+# Errors after which a UNIX datagram socket is connected again, as the
+# socket it was connected to is gone or was not there yet.
+RECONNECT_ERRORS = frozenset([errno.ECONNREFUSED, errno.ENOTCONN,
+                              errno.ENOENT])
+
+# Number of points per destination on the consistent hash ring.
+HASH_REPLICAS = 100
+
+# Overflow policies for QueueingUDPLogHandler.
+OVERFLOW_DROP_NEW = 'drop-new'
+OVERFLOW_DROP_OLD = 'drop-old'
+
 # As LogRecord instances will get elements of the 'extra' keyword argument
 # to the logging methods bolted on it as attributes, we need to know which
 # fields are the non-extra ones. The following creates an empty LogRecord
 # to list the fields it sets by default.
 __emptyLogRecord = logging.LogRecord(None, None, None, None, None, None, None)
-_DEFAULT_LOGGING_ATTRIBUTES = ['message', 'asctime']
-_DEFAULT_LOGGING_ATTRIBUTES.extend(vars(__emptyLogRecord).keys())
+_DEFAULT_LOGGING_ATTRIBUTES = frozenset(['message', 'asctime'] +
+                                        vars(__emptyLogRecord).keys())
 del __emptyLogRecord
 
 def unserialize(msg):
@@ -44,14 +109,108 @@ def unserialize(msg):
     Unserialize a log event.
 
     A log event is defined as a category, followed by a colon, optional
-    whitespace and a event dictionary serialized as JSON.
+    whitespace and a event dictionary serialized as JSON. Compressed
+    messages (see L{udplog.compression}) are decompressed first.
 
     @return: The category and event dictionary.
     @rtype: C{tuple} of (C{unicode} and C{dict}.
     """
+    category, data = splitEvent(msg)
+    return category, simplejson.loads(data)
+
+
+
+def splitEvent(msg):
+    """
+    Split a serialized log event into its category and JSON encoding.
+
+    Compressed messages (see L{udplog.compression}) are decompressed first.
+
+    @return: The category and the event dictionary serialized as JSON,
+        without surrounding whitespace.
+    @rtype: C{tuple} of (L{bytes}, L{bytes})
+    """
+    if compression.isCompressed(msg):
+        msg = compression.decompress(msg)
 
     category, data = msg.split(':', 1)
-    return category, simplejson.loads(data)
+    return category, data.strip()
+
+
+
+def splitDatagram(datagram):
+    """
+    Split a datagram into the serialized log events it contains.
+
+    A datagram holds one or more serialized log events, separated by
+    C{EVENT_SEPARATOR}. See L{UDPLogger} for the batching of events. Lines
+    that do not start with a category and a colon continue the previous
+    event, so that a single event with JSON spread over multiple lines stays
+    whole.
+
+    @type datagram: L{bytes}
+    @return: The serialized log events, without trailing whitespace.
+    @rtype: L{list} of L{bytes}
+    """
+    events = []
+    for line in datagram.rstrip().split(EVENT_SEPARATOR):
+        if events and not _EVENT_START.match(line):
+            events[-1] += EVENT_SEPARATOR + line
+        else:
+            events.append(line)
+    return [msg.rstrip() for msg in events]
+
+
+
+def chunkDatagram(datagram, messageId, chunkSize):
+    """
+    Split a datagram into chunks.
+
+    @param messageId: Identifier of the datagram, unique per sender.
+    @type messageId: L{int}
+
+    @param chunkSize: Maximum size of the chunks, including the header.
+    @type chunkSize: L{int}
+
+    @return: The chunks, in order.
+    @rtype: L{list} of L{bytes}
+
+    @raise ValueError: If the datagram would need more than C{MAX_CHUNKS}
+        chunks.
+    """
+    payloadSize = chunkSize - CHUNK_HEADER_SIZE
+    total = -(-len(datagram) // payloadSize)
+    if total > MAX_CHUNKS:
+        raise ValueError("Datagram too large for %d chunks of %d bytes" %
+                         (MAX_CHUNKS, chunkSize))
+
+    return [CHUNK_MAGIC +
+            _CHUNK_HEADER.pack(messageId, seq, total) +
+            datagram[offset:offset + payloadSize]
+            for seq, offset in enumerate(xrange(0, len(datagram),
+                                                payloadSize))]
+
+
+
+def parseChunk(chunk):
+    """
+    Parse a chunk created by L{chunkDatagram}.
+
+    @return: The message identifier, sequence number, total number of chunks
+        and payload of the chunk.
+    @rtype: L{tuple}
+
+    @raise ValueError: If the chunk is malformed.
+    """
+    if len(chunk) < CHUNK_HEADER_SIZE or not chunk.startswith(CHUNK_MAGIC):
+        raise ValueError("Malformed chunk header")
+
+    messageId, seq, total = _CHUNK_HEADER.unpack_from(chunk, len(CHUNK_MAGIC))
+    if seq >= total:
+        raise ValueError("Chunk sequence number %d out of range %d" %
+                         (seq, total))
+
+    return messageId, seq, total, chunk[CHUNK_HEADER_SIZE:]
 
 
 
@@ -70,6 +229,128 @@ def augmentWithFailure(eventDict, failure, why=None):
 
 
 
+# Message identifiers of chunked datagrams are seeded from the operating
+# system, as forked processes share the state of the random module.
+_random = random.SystemRandom()
+
+
+
+# Loggers with events buffered for sending out later. A single exit hook
+# flushes them, so that they can still be garbage collected.
+_exitLoggers = weakref.WeakSet()
+
+def _flushAtExit():
+    """
+    Stop the flusher threads and send out the buffered events of all loggers.
+    """
+    for logger in list(_exitLoggers):
+        try:
+            logger._flusher.stop()
+            logger._reporter.stop()
+            logger.flush()
+        except Exception:
+            traceback.print_exc()
+
+atexit.register(_flushAtExit)
+
+
+
+class _LazyThread(object):
+    """
+    Daemon thread that is started when there is work, and exits when idle.
+
+    @ivar lock: Guards the state of the thread and the work it does.
+    @type lock: L{threading.Condition}
+
+    @ivar running: Whether the thread is running, changed with C{lock} held.
+        Callers may check this without holding C{lock}, see C{busy}.
+    @type running: L{bool}
+
+    @ivar stopped: Set by L{stop}, after which the thread is not started
+        again. The work function must return when it is set.
+    @type stopped: L{bool}
+
+    @ivar thread: The current or last thread.
+    @type thread: L{threading.Thread}
+    """
+
+    def __init__(self, name, lock, run, busy=None):
+        """
+        @param name: The name of the thread.
+        @type name: L{str}
+
+        @param lock: See C{lock}.
+
+        @param run: Called without arguments on the thread, with C{lock}
+            held, to do the work. It waits on C{lock} for more, and returns
+            when it is idle or C{stopped} is set.
+
+        @param busy: If set, called with C{lock} held after C{run} returns
+            and C{running} is cleared. If it returns C{True}, C{run} is
+            called again. This picks up work added by callers that saw the
+            thread still running, without holding C{lock}.
+        """
+        self.name = name
+        self.lock = lock
+        self.running = False
+        self.stopped = False
+        self.thread = None
+        self._run = run
+        self._busy = busy
+
+
+    def start(self):
+        """
+        Start the thread, unless it is running or stopped.
+
+        This must be called with C{lock} held.
+
+        @return: Whether a new thread was started.
+        @rtype: L{bool}
+        """
+        if self.stopped:
+            return False
+
+        # A thread that is about to exit reports itself as alive, so rely on
+        # the flag it clears instead. After forking, the flag is inherited,
+        # but the thread of the parent process is gone.
+        if self.running and self.thread.is_alive():
+            return False
+
+        self.thread = threading.Thread(target=self._main, name=self.name)
+        self.thread.daemon = True
+        self.running = True
+        self.thread.start()
+        return True
+
+
+    def stop(self):
+        """
+        Stop the thread and wait for it to exit, before the interpreter shuts
+        down.
+        """
+        with self.lock:
+            self.stopped = True
+            thread = self.thread
+            self.lock.notify()
+
+        if thread is not None:
+            thread.join()
+
+
+    def _main(self):
+        with self.lock:
+            while True:
+                try:
+                    self._run()
+                finally:
+                    self.running = False
+                if self.stopped or self._busy is None or not self._busy():
+                    return
+                self.running = True
+
+
+
 class MemoryLogger(object):
     """
     Keeper of all logs in memory.
@@ -87,39 +368,313 @@ class MemoryLogger(object):
 class UDPLogger(object):
     """
     Dispatcher of structured log events over UDP.
+
+    By default, every log event is sent out in its own datagram. If
+    C{batchSize} is set, serialized events are buffered and packed into a
+    single datagram, separated by C{EVENT_SEPARATOR}. The buffer is flushed
+    when adding another event would exceed C{batchSize} bytes, when the
+    oldest buffered event is older than C{batchInterval} seconds, upon
+    calling L{flush} and when the process exits. The age of the buffer is
+    watched by a daemon thread, started with the first buffered event, that
+    stops after an idle interval.
+
+    @ivar batchSize: Maximum size of a datagram with batched events, in bytes,
+        or C{None} to disable batching.
+    @type batchSize: L{int}
+
+    @ivar batchInterval: Maximum number of seconds an event is held in the
+        batch buffer.
+    @type batchInterval: L{float}
+
+    @ivar encoder: The JSON encoder used to serialize events. Defaults to
+        the fastest available one, see L{udplog.encoding}. Its C{name}
+        attribute identifies the backend.
+
+    @ivar chunkSize: If set, datagrams larger than this number of bytes are
+        split into chunks of at most this size (see L{chunkDatagram}), to be
+        reassembled by the receiver. This allows for sending events that do
+        not fit in a single datagram, and avoids IP fragmentation.
+    @type chunkSize: L{int}
+
+    @ivar socketPath: If set, events are sent to the UNIX datagram socket at
+        this path, instead of over UDP to C{host} and C{port}. This bypasses
+        the IP stack. Note that, unlike with UDP, sending blocks when the
+        receiving end's socket buffer is full. The socket does not need to
+        exist yet: when sending fails because it is missing or was replaced,
+        for example by restarting the server, the path is connected to
+        again (see C{RECONNECT_ERRORS}).
+    @type socketPath: L{bytes}
+
+    @ivar compress: If set, datagrams are compressed with a preset
+        dictionary (see L{udplog.compression}), unless that does not make
+        them smaller. Compression happens before splitting into chunks.
+    @type compress: L{bool}
+
+    @ivar sampler: If set, events are only sent out if accepted by this
+        sampler, before they are serialized. Periodically, the numbers of
+        rejected events are reported in an event with category C{'udplog'}.
+    @type sampler: L{udplog.sampling.EventSampler}
+
+    @ivar tracebackFilter: If set, tracebacks in the C{'excText'} field of
+        events are fingerprinted, and left out of events once they have been
+        sent a number of times, keeping only the fingerprint and a counter.
+    @type tracebackFilter: L{udplog.tracebacks.TracebackFilter}
+
+    @ivar metrics: Counters on sent and dropped events, send errors and,
+        if C{timeSerialization} is set, serialization times. If
+        C{metricsInterval} is set, a snapshot is sent out every
+        C{metricsInterval} seconds, checked whenever an event is logged, in
+        an event with category C{'udplog'}.
+    @type metrics: L{udplog.metrics.EmissionMetrics}
+
+    @ivar destinations: If set, events are spread across these destinations,
+        instead of being sent to C{host} and C{port} or C{socketPath}. A
+        destination is either a tuple of host and port, or the path of a
+        UNIX datagram socket. This allows for running several UDPLog servers
+        to share the load.
+    @type destinations: L{list}
+
+    @ivar balance: How to spread events across C{destinations}. With
+        C{BALANCE_HASH}, every category is sent to one destination, chosen by
+        consistent hashing, so that all processes send it to the same one.
+        Batches are split up by destination. With C{BALANCE_ROUND_ROBIN},
+        every datagram is sent to the next destination.
+    @type balance: L{str}
+
+    @ivar cooldown: Number of seconds to skip a destination after it refused
+        a datagram (C{ECONNREFUSED}), for example because its server is not
+        running. The datagram is then sent to another destination instead.
+    @type cooldown: L{float}
+
+    @ivar aggregator: Aggregator of the counters and timings passed to
+        L{count} and L{timing}. Every C{aggregateInterval} seconds, checked
+        whenever an event is logged or aggregated, and upon L{flush}, they
+        are summarized in one event per category.
+    @type aggregator: L{udplog.aggregation.Aggregator}
+
+    @ivar nonBlocking: If set, the sockets are non-blocking. When a socket's
+        send buffer is full, sending fails right away (C{EAGAIN}) instead of
+        blocking until there is room, and the events in the datagram are
+        dropped and counted in C{metrics}. This keeps logging from stalling
+        the application, notably when sending to a UNIX datagram socket.
+    @type nonBlocking: L{bool}
+
+    @ivar sendBufferSize: If set, the size of the send buffers of the
+        sockets (C{SO_SNDBUF}), in bytes. A larger buffer absorbs larger
+        bursts of events before sending would block or fail. The kernel may
+        adjust the size, within its limits.
+    @type sendBufferSize: L{int}
+
+    @ivar backoff: If set, after a send failed because nothing listens at
+        the destination (C{BACKOFF_ERRORS}), all events are dropped for this
+        number of seconds, without serializing them or reporting the
+        failure. After that, the next event is sent as a probe, backing off
+        again if that fails too. As a UDP socket only reports a refused
+        datagram upon the send after it, the probe is not taken as proof
+        that sending works again: if the next send fails, the probe counts
+        as dropped and the outage continues. Once that send succeeds too, a
+        single event with category C{'udplog'} reports the number of
+        C{dropped} events, the C{errno} of the first failure and the time it
+        happened as C{failedSince}. Events dropped while backing off are
+        also counted in C{metrics}. If C{None}, every failed send is
+        reported as usual.
+    @type backoff: L{float}
+
+    @ivar sequenceNumbers: If set, every event is stamped with a
+        C{senderId} that identifies this logger in this process, and a
+        C{sequence} number that increases by one for every event sent out.
+        This allows the UDPLog server to account for lost, reordered and
+        duplicated events (see L{udplog.twisted.SequenceTracker}). As gaps
+        are tracked per server, this is only meaningful if all events are
+        sent to a single destination.
+    @type sequenceNumbers: L{bool}
+
+    @ivar senderId: The sender identifier for sequence numbers. A new one is
+        generated in child processes after forking.
+    @type senderId: L{str}
+
+    @ivar socket: The socket for the first destination.
+    @type socket: L{socket.socket}
+
+    Context fields that are added to many events, like a request identifier,
+    can be bound to the logger with L{bind}. Like the default fields, they
+    are encoded once, instead of for every event.
     """
 
     def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT,
-                       defaultFields=None):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.connect((host, port))
-
+                       defaultFields=None, batchSize=None,
+                       batchInterval=DEFAULT_BATCH_INTERVAL, encoder=None,
+                       chunkSize=None, socketPath=None, compress=False,
+                       sampler=None, metricsInterval=None,
+                       destinations=None, balance=BALANCE_HASH,
+                       cooldown=DEFAULT_COOLDOWN, sequenceNumbers=False,
+                       tracebackFilter=None, backoff=DEFAULT_BACKOFF,
+                       nonBlocking=False, sendBufferSize=None,
+                       aggregateInterval=aggregation.DEFAULT_INTERVAL,
+                       timeSerialization=False):
+        if chunkSize is not None and chunkSize <= CHUNK_HEADER_SIZE:
+            raise ValueError("Chunk size must exceed the header size %d" %
+                             (CHUNK_HEADER_SIZE,))
+        if balance not in (BALANCE_HASH, BALANCE_ROUND_ROBIN):
+            raise ValueError("Unknown balancing method %r" % (balance,))
+        if destinations is not None and not destinations:
+            raise ValueError("No destinations")
+
+        self.socketPath = socketPath
+        if destinations is None:
+            if socketPath is not None:
+                destinations = [socketPath]
+            else:
+                destinations = [(host, port)]
+
+        self.destinations = destinations
+        self.balance = balance
+        self.cooldown = cooldown
+        self.nonBlocking = nonBlocking
+        self.sendBufferSize = sendBufferSize
+        self._connect(destinations)
+
+        self._ring = _hashRing(destinations)
+        self._ringKeys = [key for key, _ in self._ring]
+        self._roundRobin = itertools.count()
+        self._coolingUntil = [0] * len(destinations)
+
+        self.backoff = backoff
+        self._backoffUntil = 0
+        self._outage = None
+        self._probed = 0
+        self._recovered = None
+
+        # Guards the outage state, that is updated from the threads that log,
+        # flush batches and report aggregates. It is checked without the lock
+        # first, to keep the lock off the path of a healthy logger.
+        self._outageLock = threading.Lock()
+
+        # Holds the stack of entered bound loggers of each thread.
+        self._local = _ContextStack()
+
+        self.encoder = encoder or encoding.defaultEncoder
         self.defaultFields = defaultFields or {}
 
+        self.chunkSize = chunkSize
+        self.compress = compress
+        self.sampler = sampler
+        self.tracebackFilter = tracebackFilter
+        self.metrics = metrics.EmissionMetrics(metricsInterval,
+                                               timeSerialization)
+        self.aggregator = aggregation.Aggregator(aggregateInterval)
+        self._aggregating = False
+        self._reporterLock = threading.Condition()
+        self._reporter = _LazyThread('udplog-aggregates', self._reporterLock,
+                                     self._runReporter, self._hasAggregates)
+
+        self._newMessageIds()
+
+        self.sequenceNumbers = sequenceNumbers
+        self._newSender()
+
+        self.batchSize = batchSize
+        self.batchInterval = batchInterval
+        self._batch = []
+        self._batchLength = 0
+        self._batchStarted = None
+        self._batchLock = threading.Condition()
+        self._flusher = _LazyThread('udplog-flusher', self._batchLock,
+                                    self._runFlusher)
+
+        if self.batchSize:
+            _exitLoggers.add(self)
+
+
+    def _connect(self, destinations):
+        """
+        Set up the sockets for the destinations.
+        """
+        self.sockets = [_connect(destination) for destination in destinations]
+        self.socket = self.sockets[0]
+
+        for sock in self.sockets:
+            if self.sendBufferSize is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                self.sendBufferSize)
+            if self.nonBlocking:
+                sock.setblocking(False)
+
+
+    def _newSender(self):
+        """
+        Generate a new sender identifier and restart the sequence numbers.
+        """
+        self.senderId = '%016x' % (random.getrandbits(64),)
+        self._senderPid = os.getpid()
+        self._sequence = itertools.count()
+
+
+    def _newMessageIds(self):
+        """
+        Restart the message identifiers of chunked datagrams.
+
+        They start at a random offset, so that they are unlikely to clash with
+        those of other senders.
+        """
+        self._messageIds = itertools.count(_random.getrandbits(32) << 32)
+        self._messageIdsPid = os.getpid()
+
+
+    @property
+    def defaultFields(self):
+        """
+        Fields added to every event, unless present in the event.
+
+        These are encoded once, when set, and spliced into every serialized
+        event by L{serialize}. To change them, set a new dictionary: the
+        current one is a read-only copy, that raises L{TypeError} when
+        modified.
+
+        @type: L{encoding.ReadOnlyDict}
+        """
+        return self._defaultFields.fields
+
+
+    @defaultFields.setter
+    def defaultFields(self, defaultFields):
+        self._defaultFields = encoding.JSONFragment(defaultFields,
+                                                    self.encoder)
+
 
     def augment(self, eventDict):
         """
         Augment the event dictionary with timestamp and default fields.
+
+        Note that L{log} does not add the default fields to the event
+        dictionary, as L{serialize} adds them in their pre-encoded form.
         """
         eventDict.setdefault('timestamp', time.time())
         for key, value in self.defaultFields.iteritems():
             eventDict.setdefault(key, value)
 
 
-    def serialize(self, category, eventDict):
+    def serialize(self, category, eventDict, context=None):
         """
         Serialize a log event.
 
-        The dictionary is serialized to JSON. To minimize serialization
-        failures, for unserializable objects it falls back to the L{repr} of
-        such objects.
+        The dictionary is serialized to JSON using C{encoder}. To minimize
+        serialization failures, for unserializable objects it falls back to
+        the L{repr} of such objects. The default fields that are not in the
+        dictionary are added to the result.
 
         @type category: L{str}
         @type eventDict: L{dict}
+
+        @param context: If set, its context fields that are not in the
+            dictionary are also added to the result.
+        @type context: L{BoundLogger}
         """
-        msg = simplejson.dumps(eventDict,
-                               default=lambda x: str(repr(x)),
-                               skipkeys=True)
+        if context is None:
+            fragment = self._defaultFields
+        else:
+            fragment = context.fragment
+        msg = fragment.splice(self.encoder.encode(eventDict), eventDict)
         return "%s:\t%s" % (category, msg)
 
 
@@ -156,10 +711,63 @@ class UDPLogger(object):
 
         newEventDict['original_size'] = size
 
+        # Keep the sequence number, so that the event is not counted as lost.
+        for key in ('senderId', 'sequence'):
+            if key in eventDict:
+                newEventDict[key] = eventDict[key]
+
         self.augment(newEventDict)
+        self.metrics.failureSerialized()
         return self.serialize('udplog', newEventDict)
 
 
+    def _pickDestination(self, key):
+        """
+        Pick the index of the destination to send to.
+
+        Destinations in their cooldown period are skipped, unless all of them
+        are.
+
+        @param key: The category to pick the destination for, if balancing
+            by hash.
+        """
+        count = len(self.sockets)
+        if count == 1:
+            return 0
+
+        if self.balance == BALANCE_HASH:
+            if isinstance(key, unicode):
+                key = key.encode('utf-8')
+            position = bisect.bisect(self._ringKeys,
+                                     zlib.crc32(key) & 0xffffffff)
+            candidates = (self._ring[(position + i) % len(self._ring)][1]
+                          for i in xrange(len(self._ring)))
+        else:
+            start = next(self._roundRobin)
+            candidates = ((start + i) % count for i in xrange(count))
+
+        now = time.time()
+        first = None
+        for index in candidates:
+            if self._coolingUntil[index] <= now:
+                return index
+            elif first is None:
+                first = index
+        return first
+
+
+    def _coolDown(self, index):
+        """
+        Skip a destination for the cooldown period.
+
+        @return: Whether another destination is available to send to.
+        @rtype: L{bool}
+        """
+        now = time.time()
+        self._coolingUntil[index] = now + self.cooldown
+        return any(until <= now for until in self._coolingUntil)
+
+
     def log(self, category, eventDict):
         """
         Log an event.
@@ -174,18 +782,457 @@ class UDPLogger(object):
             to a string before adding them to the event dictionary.
         @type eventDict: C{dict}
         """
-        self.augment(eventDict)
-        data = self.serialize(category, eventDict)
+        self._logInContext(category, eventDict, self.currentContext())
+
+
+    def bind(self, **fields):
+        """
+        Bind context fields to be added to events.
+
+        The fields are added to the fields of the current context, if any,
+        and encoded once, together with the default fields. Fields in an
+        event take precedence over context fields, which in turn take
+        precedence over default fields.
+
+        The returned bound logger can be used directly, or entered as a
+        context manager. In the latter case, it becomes the current context
+        of the thread: all events logged through this logger on the thread,
+        including those from logging handlers, get the context fields, until
+        the block is exited::
+
+            with logger.bind(requestId=requestId, route=route):
+                handleRequest()
+
+        Context is kept per thread, so it is not propagated to other threads
+        or across callbacks on an event loop.
+
+        @return: The bound logger.
+        @rtype: L{BoundLogger}
+        """
+        context = self.currentContext()
+        if context is not None:
+            return context.bind(**fields)
+        else:
+            return BoundLogger(self, fields)
+
+
+    def currentContext(self):
+        """
+        Get the innermost bound logger entered on this thread.
+
+        @rtype: L{BoundLogger}
+        """
+        contexts = self._local.contexts
+        if contexts:
+            return contexts[-1]
+        else:
+            return None
+
+
+    def _logInContext(self, category, eventDict, context):
+        """
+        Log an event with the context fields of a bound logger.
+        """
+        now = time.time()
+        if now < self._backoffUntil:
+            with self._outageLock:
+                if self._outage is not None:
+                    self._outage['dropped'] += 1
+            self.metrics.eventsDropped('backoff')
+            return
+
+        if self.sampler is not None:
+            accepted = self.sampler.accept(category, eventDict)
+
+            report = self.sampler.report(now)
+            if report is not None:
+                self._log('udplog', report)
+
+            if not accepted:
+                self.metrics.eventsDropped('sampling')
+                return
+
+        if self.tracebackFilter is not None:
+            self.tracebackFilter.filter(eventDict, now)
+
+        if self.metrics.reportInterval is not None:
+            report = self.metrics.report(now)
+            if report is not None:
+                self._log('udplog', report)
+
+        if self._aggregating:
+            self._reportAggregates(now)
+
+        self._log(category, eventDict, context, now)
+
+        if self._recovered is not None:
+            with self._outageLock:
+                outage, self._recovered = self._recovered, None
+            if outage is not None:
+                self._log('udplog', outage)
+
+
+    def count(self, name, value=1, category=aggregation.DEFAULT_CATEGORY):
+        """
+        Add to a counter.
+
+        Instead of sending out an event, the counter is kept in process, and
+        periodically sent out in a summary event (see C{aggregator}).
+
+        @param name: The name of the counter.
+        @type name: L{unicode}
+
+        @param value: The value to add.
+        @type value: L{int}
+
+        @param category: The category of the summary event to include the
+            counter in.
+        @type category: L{bytes}
+        """
+        self.aggregator.count(category, name, value)
+        self._aggregated()
+
+
+    def timing(self, name, ms, category=aggregation.DEFAULT_CATEGORY):
+        """
+        Add a timing.
+
+        Instead of sending out an event, the timing is added to a quantile
+        sketch in process, and its count, sum, minimum, maximum, mean and
+        percentiles are periodically sent out in a summary event (see
+        C{aggregator}), along with the sketch itself.
+
+        @param name: The name of the timing.
+        @type name: L{unicode}
+
+        @param ms: The duration in milliseconds.
+        @type ms: L{float}
+
+        @param category: The category of the summary event to include the
+            timing in.
+        @type category: L{bytes}
+        """
+        self.aggregator.timing(category, name, ms)
+        self._aggregated()
+
+
+    def _aggregated(self):
+        """
+        Send out aggregates if due, and make sure they are sent every
+        interval and at exit.
+        """
+        if not self._aggregating:
+            self._aggregating = True
+            _exitLoggers.add(self)
+        # After forking, the flag is inherited, but the thread is gone.
+        reporter = self._reporter
+        if not reporter.running or not reporter.thread.is_alive():
+            with self._reporterLock:
+                reporter.start()
+        self._reportAggregates(time.time())
+
+
+    def _runReporter(self):
+        """
+        Send out the summaries of aggregates every interval.
+
+        This runs on the reporter thread, with C{_reporterLock} held. The
+        thread stops when nothing was aggregated for an interval.
+        """
+        while not self._reporter.stopped:
+            delay = self.aggregator.due() - time.time()
+            if delay > 0:
+                self._reporterLock.wait(delay)
+            elif self.aggregator.isEmpty():
+                return
+            else:
+                self._reportAggregates(time.time())
+
+
+    def _hasAggregates(self):
+        """
+        Check for aggregates added while the reporter thread was exiting.
+        """
+        return not self.aggregator.isEmpty()
+
+
+    def _reportAggregates(self, now, force=False):
+        """
+        Send out the summaries of the aggregates, if due.
+        """
+        for category, eventDict in self.aggregator.report(now, force):
+            self._log(category, eventDict)
+
+
+    def _backOff(self, error, events):
+        """
+        Start or extend backing off after a failed send.
+
+        @param error: The error number of the failure.
+
+        @param events: The number of events in the failed datagram.
+        """
+        now = time.time()
+        with self._outageLock:
+            if self._outage is None:
+                self._outage = {
+                    'message': "Sending resumed after failures",
+                    'logLevel': 'WARNING',
+                    'errno': error,
+                    'failedSince': now,
+                    'dropped': 0,
+                    }
+            self._outage['dropped'] += events + self._probed
+            self._probed = 0
+            self._backoffUntil = now + self.backoff
+        self.metrics.eventsDropped('backoff', events)
+
+
+    def _log(self, category, eventDict, context=None, now=None):
+        """
+        Serialize and send out an event.
+
+        @param now: The current time, if already known.
+        """
+        eventDict.setdefault('timestamp', now or time.time())
+
+        if self.sequenceNumbers:
+            # A forked process must not continue the sequence of its parent.
+            if os.getpid() != self._senderPid:
+                self._newSender()
+            eventDict['senderId'] = self.senderId
+            eventDict['sequence'] = next(self._sequence)
+
+        if self.metrics.timeSerialization:
+            started = time.time()
+            data = self.serialize(category, eventDict, context)
+            self.metrics.eventSerialized(time.time() - started)
+        else:
+            data = self.serialize(category, eventDict, context)
+
+        if self.batchSize:
+            self._addToBatch(category, eventDict, data)
+        else:
+            self._send(category, eventDict, data)
+
+
+    def _addToBatch(self, category, eventDict, data):
+        """
+        Add a serialized event to the batch buffer, flushing as needed.
+        """
+        now = time.time()
+        with self._batchLock:
+            if (self._batch and
+                self._batchLength + len(EVENT_SEPARATOR) + len(data) >
+                self.batchSize):
+                self._flushBatch()
+
+            if len(data) >= self.batchSize:
+                self._send(category, eventDict, data)
+                return
+
+            if not self._batch:
+                self._batchStarted = now
+                self._batchLength = len(data)
+                if not self._flusher.start():
+                    self._batchLock.notify()
+            else:
+                self._batchLength += len(EVENT_SEPARATOR) + len(data)
+            self._batch.append((category, eventDict, data))
+
+            if (self._batchLength >= self.batchSize or
+                now - self._batchStarted >= self.batchInterval):
+                self._flushBatch()
+
+
+    def _runFlusher(self):
+        """
+        Flush the batch buffer when its oldest event exceeds the interval.
+
+        This runs on the flusher thread, with C{_batchLock} held. The thread
+        stops when the buffer stayed empty for an interval.
+        """
+        while not self._flusher.stopped:
+            if self._batchStarted is None:
+                self._batchLock.wait(self.batchInterval)
+                if self._batchStarted is None:
+                    return
+            else:
+                delay = self._batchStarted + self.batchInterval - time.time()
+                if delay > 0:
+                    self._batchLock.wait(delay)
+                else:
+                    self._flushBatch()
+
+
+    def _flushBatch(self):
+        """
+        Send out all buffered events in one datagram.
+
+        If sending the combined datagram fails, the events are sent out
+        individually, so that failures are reported per event.
+        """
+        batch = self._batch
+        self._batch = []
+        self._batchLength = 0
+        self._batchStarted = None
+
+        if len(self.sockets) > 1 and self.balance == BALANCE_HASH:
+            groups = OrderedDict()
+            for entry in batch:
+                index = self._pickDestination(entry[0])
+                groups.setdefault(index, []).append(entry)
+            for group in groups.itervalues():
+                self._sendBatch(group)
+        else:
+            self._sendBatch(batch)
+
+
+    def _sendBatch(self, batch):
+        """
+        Send out buffered events in one datagram.
+        """
+        if not batch:
+            return
+        elif len(batch) == 1:
+            self._send(*batch[0])
+            return
+
+        try:
+            self._sendDatagram(EVENT_SEPARATOR.join(data
+                                                    for _, _, data in batch),
+                               len(batch), batch[0][0])
+        except Exception:
+            for category, eventDict, data in batch:
+                self._send(category, eventDict, data)
+
+
+    def flush(self):
+        """
+        Send out the summaries of aggregates and all events in the batch
+        buffer.
+        """
+        self._reportAggregates(time.time(), force=True)
+        with self._batchLock:
+            self._flushBatch()
+
+
+    def _prepareDatagram(self, datagram):
+        """
+        Compress a datagram and split it into chunks, as configured.
+
+        @return: The datagrams to send.
+        @rtype: L{list} of L{bytes}
+        """
+        if self.compress:
+            compressed = compression.compress(datagram)
+            if len(compressed) < len(datagram):
+                datagram = compressed
+
+        if self.chunkSize and len(datagram) > self.chunkSize:
+            # A forked process must not reuse the identifiers of its parent.
+            if os.getpid() != self._messageIdsPid:
+                self._newMessageIds()
+            return chunkDatagram(datagram, next(self._messageIds),
+                                 self.chunkSize)
+        else:
+            return [datagram]
+
+
+    def _sendDatagram(self, datagram, events=1, key=''):
+        """
+        Send a datagram, compressed and split into chunks as configured.
+
+        @param events: The number of events in the datagram, for C{metrics}.
+
+        @param key: The category to pick the destination for.
+
+        Failures to send are raised, unless the send would block (see
+        C{nonBlocking}) or they cause backing off (see C{backoff}), in which
+        cases the events are dropped.
+        """
+        if self.compress or self.chunkSize:
+            datagrams = self._prepareDatagram(datagram)
+        else:
+            datagrams = (datagram,)
+
+        index = self._pickDestination(key)
+        while True:
+            try:
+                size = self._sendTo(index, datagrams)
+            except Exception as e:
+                error = getattr(e, 'errno', None)
+                self.metrics.sendFailed(error)
+                if (error == errno.ECONNREFUSED and len(self.sockets) > 1 and
+                    self._coolDown(index)):
+                    index = self._pickDestination(key)
+                    continue
+                if self.nonBlocking and error in (errno.EAGAIN,
+                                                  errno.EWOULDBLOCK):
+                    self.metrics.eventsDropped('wouldBlock', events)
+                    return
+                if self.backoff is not None and error in BACKOFF_ERRORS:
+                    self._backOff(error, events)
+                    return
+                raise
+            else:
+                break
+
+        self.metrics.datagramSent(events, size)
+
+        if self._outage is not None:
+            with self._outageLock:
+                if self._outage is not None:
+                    self._backoffUntil = 0
+                    if self._probed:
+                        self._probed = 0
+                        self._recovered, self._outage = self._outage, None
+                    else:
+                        self._probed = events
+
+
+    def _sendTo(self, index, datagrams):
+        """
+        Send datagrams to a destination.
+
+        A UNIX datagram socket sends to the socket it was connected to. If
+        that is gone, or there was none yet, sending fails, and the socket is
+        connected to the path again, to send to the current socket there.
+
+        @param index: The index of the destination.
 
+        @return: The number of bytes sent.
+        @rtype: L{int}
+        """
+        sock = self.sockets[index]
+        destination = self.destinations[index]
+        size = 0
+        for data in datagrams:
+            try:
+                sock.send(data)
+            except socket.error as e:
+                if (isinstance(destination, tuple) or
+                    e.errno not in RECONNECT_ERRORS):
+                    raise
+                sock.connect(destination)
+                sock.send(data)
+            size += len(data)
+        return size
+
+
+    def _send(self, category, eventDict, data):
+        """
+        Send a single serialized event, reporting failures.
+        """
         try:
-            self.socket.send(data)
+            self._sendDatagram(data, key=category)
         except:
             failure = Failure()
             why = "Failed to send udplog message"
             data = self.serializeFailure(category, eventDict, len(data),
                                          failure, why)
             try:
-                self.socket.send(data)
+                self._sendDatagram(data, key='udplog')
             except Exception:
                 import sys
                 text = why + '\n' + failure.getBriefTraceback()
@@ -193,12 +1240,150 @@ class UDPLogger(object):
 
 
 
+class _ContextStack(threading.local):
+    """
+    The bound loggers entered on a thread, innermost last.
+    """
+
+    def __init__(self):
+        self.contexts = []
+
+
+
+class BoundLogger(object):
+    """
+    Logger with context fields bound to it.
+
+    The context fields are encoded once, together with the default fields
+    of the logger at the time of binding, and spliced into every event
+    logged through this bound logger. See L{UDPLogger.bind}.
+
+    @ivar logger: The logger to log events with.
+    @type logger: L{UDPLogger}
+
+    @ivar fields: The context fields.
+    @type fields: L{dict}
+
+    @ivar fragment: The encoded default and context fields.
+    @type fragment: L{encoding.JSONFragment}
+    """
+
+    def __init__(self, logger, fields):
+        self.logger = logger
+        self.fields = fields
+
+        allFields = dict(logger.defaultFields)
+        allFields.update(fields)
+        self.fragment = encoding.JSONFragment(allFields, logger.encoder)
+
+
+    def bind(self, **fields):
+        """
+        Bind additional context fields.
+
+        @return: A new bound logger with the context fields of this one and
+            C{fields}.
+        @rtype: L{BoundLogger}
+        """
+        allFields = dict(self.fields)
+        allFields.update(fields)
+        return BoundLogger(self.logger, allFields)
+
+
+    def log(self, category, eventDict):
+        """
+        Log an event with the context fields.
+
+        See L{UDPLogger.log}.
+        """
+        self.logger._logInContext(category, eventDict, self)
+
+
+    def __enter__(self):
+        self.logger._local.contexts.append(self)
+        return self
+
+
+    def __exit__(self, excType, excValue, traceback):
+        self.logger._local.contexts.pop()
+
+
+
+def _connect(destination):
+    """
+    Set up a datagram socket connected to a destination.
+
+    @param destination: A tuple of host and port, or the path of a UNIX
+        datagram socket. If nothing can be connected to at the path yet, the
+        socket is left unconnected, to be connected upon sending.
+    """
+    if isinstance(destination, tuple):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect(destination)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.connect(destination)
+        except socket.error as e:
+            if e.errno not in RECONNECT_ERRORS:
+                raise
+    return sock
+
+
+
+def _hashRing(destinations):
+    """
+    Set up a consistent hash ring for a list of destinations.
+
+    Every destination gets C{HASH_REPLICAS} points on the ring, derived
+    from the destination itself, so that the ring does not depend on the
+    order of the destinations, and removing one only moves the keys that
+    mapped to it.
+
+    @return: Sorted list of tuples of a point on the ring and the index of
+        its destination.
+    """
+    ring = []
+    for index, destination in enumerate(destinations):
+        if isinstance(destination, tuple):
+            name = '%s:%s' % destination
+        else:
+            name = destination
+
+        for replica in xrange(HASH_REPLICAS):
+            point = zlib.crc32('%s-%d' % (name, replica)) & 0xffffffff
+            ring.append((point, index))
+
+    ring.sort()
+    return ring
+
+
+
 class UDPLogHandler(logging.Handler):
     """
     Python Logging handler that emits to UDP.
+
+    If C{dedupWindow} is set, repeated records are suppressed. Records are
+    considered repeats if they have the same category, logger name, message
+    template and line number. The first record is emitted as usual, after
+    which a window of C{dedupWindow} seconds opens in which repeats are only
+    counted. When the window closes, the last repeat is emitted with a
+    C{'repeated'} field holding the number of repeats. Windows are closed by
+    a separate thread while any are open, and upon emitting a later record or
+    flushing the handler.
+
+    @ivar dedupWindow: Number of seconds to suppress repeated records, or
+        C{None} to disable duplicate suppression.
+    @type dedupWindow: L{float}
+
+    @ivar dedupMaxKeys: Maximum number of distinct records to track. If
+        exceeded, the window of the oldest one is closed early.
+    @type dedupMaxKeys: L{int}
     """
 
-    def __init__(self, logger, category='python_logging'):
+    dedupMaxKeys = 1000
+
+    def __init__(self, logger, category='python_logging', dedupWindow=None):
         """
         @type logger: L{UDPLogger}.
         """
@@ -207,6 +1392,14 @@ class UDPLogHandler(logging.Handler):
 
         self.logger = logger
         self.category = category
+        self.dedupWindow = dedupWindow
+
+        # Maps keys of records to the start of their window, the number of
+        # repeats and the last repeated record, in order of window start.
+        self._repeats = OrderedDict()
+        self._repeatsLock = threading.Condition()
+        self._closer = _LazyThread('udplog-dedup', self._repeatsLock,
+                                   self._runCloser)
 
 
     def emit(self, record):
@@ -214,48 +1407,189 @@ class UDPLogHandler(logging.Handler):
         Emit a record.
         """
         try:
-            eventDict = {
-                    'category': self.category,
-                    'logLevel': record.levelname,
-                    'logName': record.name,
-                    'filename': record.pathname,
-                    'lineno': record.lineno,
-                    'funcName': record.funcName,
-                    'timestamp': record.created,
-                    }
+            if self.dedupWindow is not None and self._suppress(record):
+                return
 
-            if isinstance(record.args, dict):
-                eventDict.update(record.args)
+            self._emit(record)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
 
-            extra = {name: value for name, value in vars(record).iteritems()
-                     if name not in _DEFAULT_LOGGING_ATTRIBUTES}
 
-            eventDict.update(extra)
+    def _emit(self, record, repeated=None):
+        """
+        Render a record to an event and log it.
+
+        @param repeated: If set, the number of suppressed repeats of this
+            record, to be included in the event as C{'repeated'}.
+        """
+        eventDict = {
+                'category': self.category,
+                'logLevel': record.levelname,
+                'logName': record.name,
+                'filename': record.pathname,
+                'lineno': record.lineno,
+                'funcName': record.funcName,
+                'timestamp': record.created,
+                }
+
+        if isinstance(record.args, dict):
+            eventDict.update(record.args)
+
+        attributes = vars(record)
+        for name in attributes.viewkeys() - _DEFAULT_LOGGING_ATTRIBUTES:
+            eventDict[name] = attributes[name]
+
+        self._format(record)
+
+        eventDict['message'] = record.message
+        if record.exc_info:
+            excType, excValue = record.exc_info[0:2]
+            eventDict['excValue'] = reflect.safe_str(excValue)
+            if excValue is None:
+                eventDict['excText'] = None
+                eventDict['excType'] = 'NoneType'
+            else:
+                eventDict['excText'] = record.exc_text
+                eventDict['excType'] = reflect.qual(excType)
+
+        if repeated is not None:
+            eventDict['repeated'] = repeated
+
+        # Extract the category, possibly overridden from record.args.
+        category = eventDict.pop('category')
+
+        self.logger.log(category, eventDict)
+
+
+    def _format(self, record):
+        """
+        Format the message and exception of a record.
 
-            # Format the message for its side effects and extract the message
-            # and exception information
+        The record is formatted for its side effects, setting its C{message}
+        and C{exc_text}. The default formatter only renders the message and
+        the exception, so do just that.
+        """
+        formatter = self.formatter
+        if type(formatter) is logging.Formatter:
+            record.message = record.getMessage()
+            if record.exc_info and not record.exc_text:
+                record.exc_text = formatter.formatException(record.exc_info)
+        else:
             self.format(record)
-            eventDict['message'] = record.message
-            if record.exc_info:
-                excType, excValue = record.exc_info[0:2]
-                eventDict['excValue'] = reflect.safe_str(excValue)
-                if excValue is None:
-                    eventDict['excText'] = None
-                    eventDict['excType'] = 'NoneType'
-                else:
-                    eventDict['excText'] = record.exc_text
-                    eventDict['excType'] = reflect.qual(excType)
 
-            # Extract the category, possibly overridden from record.args.
-            category =  eventDict['category']
-            del eventDict['category']
 
+    def _suppress(self, record):
+        """
+        Check if a record is a repeat to be suppressed.
+
+        This also emits the last repeat of records whose window has closed.
+
+        @return: Whether the record should be suppressed.
+        @rtype: L{bool}
+        """
+        category = self.category
+        if isinstance(record.args, dict):
+            category = record.args.get('category', category)
+
+        key = (category, record.name, record.msg, record.lineno)
+        now = record.created
+
+        with self._repeatsLock:
+            closed = self._closeWindows(now - self.dedupWindow)
+
+            try:
+                entry = self._repeats.get(key)
+            except TypeError:
+                # Unhashable message template.
+                entry = None
+                key = None
+
+            if entry is not None:
+                entry[1] += 1
+                entry[2] = record
+            elif key is not None:
+                if len(self._repeats) >= self.dedupMaxKeys:
+                    closed.append(self._repeats.popitem(last=False)[1])
+                self._repeats[key] = [now, 0, None]
+
+                # As windows are opened in order, a new window never closes
+                # before those that are already open, so a running closer
+                # thread needs no notification.
+                self._closer.start()
+
+        self._emitRepeats(closed)
+
+        return entry is not None
+
+
+    def _emitRepeats(self, closed):
+        """
+        Emit the last repeat of the records of closed windows.
+
+        @param closed: The entries of the closed windows.
+        @type closed: L{list}
+        """
+        for _, repeated, lastRecord in closed:
+            if repeated:
+                try:
+                    self._emit(lastRecord, repeated)
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except:
+                    self.handleError(lastRecord)
+
+
+    def _runCloser(self):
+        """
+        Close windows when they expire, emitting their last repeat.
+
+        This runs on the closer thread, with C{_repeatsLock} held. The thread
+        stops when no windows are open.
+        """
+        while self._repeats and self.dedupWindow is not None:
+            started = next(self._repeats.itervalues())[0]
+            delay = started + self.dedupWindow - time.time()
+            if delay > 0:
+                self._repeatsLock.wait(delay)
+                continue
+
+            closed = self._closeWindows(time.time() - self.dedupWindow)
+
+            self._repeatsLock.release()
+            try:
+                self._emitRepeats(closed)
+            finally:
+                self._repeatsLock.acquire()
+
+
+    def _closeWindows(self, before):
+        """
+        Remove the entries for windows that started before the given time.
+
+        @return: The removed entries.
+        @rtype: L{list}
+        """
+        closed = []
+        while self._repeats:
+            key, entry = next(self._repeats.iteritems())
+            if entry[0] > before:
+                break
+            del self._repeats[key]
+            closed.append(entry)
+        return closed
 
-            self.logger.log(category, eventDict)
-        except (KeyboardInterrupt, SystemExit):
-            raise
-        except:
-            self.handleError(record)
+
+    def flush(self):
+        """
+        Emit the last repeat of all suppressed records.
+        """
+        with self._repeatsLock:
+            closed = self._repeats.values()
+            self._repeats.clear()
+
+        self._emitRepeats(closed)
 
 
 
@@ -291,7 +1625,13 @@ class ConfigurableUDPLogHandler(UDPLogHandler):
 
     def __init__(self, defaultFields=None, category='python_logging',
                        host=DEFAULT_HOST, port=DEFAULT_PORT,
-                       includeHostname=True):
+                       includeHostname=True, batchSize=None,
+                       chunkSize=None, socketPath=None, compress=False,
+                       dedupWindow=None, metricsInterval=None,
+                       destinations=None, balance=BALANCE_HASH,
+                       sequenceNumbers=False, tracebackLimit=None,
+                       backoff=DEFAULT_BACKOFF, nonBlocking=False,
+                       sendBufferSize=None):
         """
         Set up a UDPLogHandler with a UDPLogger.
 
@@ -311,23 +1651,331 @@ class ConfigurableUDPLogHandler(UDPLogHandler):
         @param includeHostname: If set, the default fields include a
             C{'hostname'} field set to the current hostname.
         @type includeHostname: L{bool}.
+
+        @param batchSize: If set, pack multiple events into datagrams of at
+            most this many bytes. See L{UDPLogger}.
+        @type batchSize: L{int}.
+
+        @param chunkSize: If set, split datagrams larger than this many bytes
+            into chunks. See L{UDPLogger}.
+        @type chunkSize: L{int}.
+
+        @param socketPath: If set, send to the UNIX datagram socket at this
+            path instead of C{host} and C{port}.
+        @type socketPath: L{bytes}.
+
+        @param compress: If set, compress datagrams. See L{UDPLogger}.
+        @type compress: L{bool}.
+
+        @param dedupWindow: If set, suppress repeated records for this number
+            of seconds. See L{UDPLogHandler}.
+        @type dedupWindow: L{float}.
+
+        @param metricsInterval: If set, send out emission metrics every this
+            many seconds. See L{UDPLogger}.
+        @type metricsInterval: L{float}.
+
+        @param destinations: If set, spread events across these destinations
+            instead of sending to C{host} and C{port}. See L{UDPLogger}.
+        @type destinations: L{list}.
+
+        @param balance: How to spread events across C{destinations}. See
+            L{UDPLogger}.
+        @type balance: L{str}.
+
+        @param sequenceNumbers: If set, stamp events with a sender identifier
+            and sequence number. See L{UDPLogger}.
+        @type sequenceNumbers: L{bool}.
+
+        @param tracebackLimit: If set, send every distinct traceback in full
+            at most this many times per minute. See L{UDPLogger}.
+        @type tracebackLimit: L{int}.
+
+        @param backoff: Number of seconds to drop events after nothing
+            listened at the destination. See L{UDPLogger}.
+        @type backoff: L{float}.
+
+        @param nonBlocking: If set, drop events instead of blocking when the
+            send buffer is full. See L{UDPLogger}.
+        @type nonBlocking: L{bool}.
+
+        @param sendBufferSize: If set, the size of the send buffer. See
+            L{UDPLogger}.
+        @type sendBufferSize: L{int}.
         """
-        defaultFields = defaultFields or {}
+        logger = _makeLogger(defaultFields, host, port, includeHostname,
+                             batchSize, chunkSize, socketPath, compress,
+                             metricsInterval, destinations, balance,
+                             sequenceNumbers, tracebackLimit, backoff,
+                             nonBlocking, sendBufferSize)
+        UDPLogHandler.__init__(self, logger, category, dedupWindow)
+
+
+
+def _makeLogger(defaultFields=None, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                includeHostname=True, batchSize=None, chunkSize=None,
+                socketPath=None, compress=False, metricsInterval=None,
+                destinations=None, balance=BALANCE_HASH,
+                sequenceNumbers=False, tracebackLimit=None,
+                backoff=DEFAULT_BACKOFF, nonBlocking=False,
+                sendBufferSize=None):
+    """
+    Set up a UDPLogger for the configurable handlers.
+
+    See L{ConfigurableUDPLogHandler.__init__} for the parameters.
+    """
+    defaultFields = defaultFields or {}
+
+    if includeHostname:
+        defaultFields.setdefault('hostname', socket.gethostname())
 
-        if includeHostname:
-            defaultFields.setdefault('hostname', socket.gethostname())
+    if tracebackLimit is not None:
+        tracebackFilter = tracebacks.TracebackFilter(limit=tracebackLimit)
+    else:
+        tracebackFilter = None
 
-        logger = UDPLogger(host=host, port=port, defaultFields=defaultFields)
-        UDPLogHandler.__init__(self, logger, category)
+    return UDPLogger(host=host, port=port, defaultFields=defaultFields,
+                     batchSize=batchSize, chunkSize=chunkSize,
+                     socketPath=socketPath, compress=compress,
+                     metricsInterval=metricsInterval,
+                     destinations=destinations, balance=balance,
+                     sequenceNumbers=sequenceNumbers,
+                     tracebackFilter=tracebackFilter, backoff=backoff,
+                     nonBlocking=nonBlocking, sendBufferSize=sendBufferSize)
+
+
+
+class QueueingUDPLogHandler(UDPLogHandler):
+    """
+    Python Logging handler that emits to UDP from a separate thread.
+
+    Instead of rendering and sending out log records on the thread that logs
+    them, L{emit} only puts a copy of the record, prepared with L{prepare},
+    in a bounded queue. A dedicated sender thread takes records from this
+    queue and passes them on to L{UDPLogHandler.emit}, that renders them to
+    events, and encodes and sends them out. The current context of the
+    logger (see L{UDPLogger.bind}) is queued along with the record, and
+    entered on the sender thread while emitting it.
+
+    If the queue is full, a record is dropped according to C{overflow} and
+    counted in C{dropped}.
+
+    @ivar queueSize: Maximum number of records in the queue.
+    @type queueSize: L{int}
+
+    @ivar overflow: What to do when the queue is full. With
+        C{OVERFLOW_DROP_NEW}, the newly logged record is dropped. With
+        C{OVERFLOW_DROP_OLD}, the oldest record in the queue is dropped in
+        favor of the new one.
+
+    @ivar dropped: Number of records dropped due to a full queue.
+    @type dropped: L{int}
+    """
+
+    def __init__(self, logger, category='python_logging',
+                       queueSize=DEFAULT_QUEUE_SIZE,
+                       overflow=OVERFLOW_DROP_NEW, dedupWindow=None):
+        """
+        @type logger: L{UDPLogger}.
+        """
+        if overflow not in (OVERFLOW_DROP_NEW, OVERFLOW_DROP_OLD):
+            raise ValueError("Unknown overflow policy %r" % (overflow,))
+
+        UDPLogHandler.__init__(self, logger, category, dedupWindow)
+
+        self.queueSize = queueSize
+        self.overflow = overflow
+        self.dropped = 0
+
+        # Popping from a deque is atomic, so the sender thread needs no lock.
+        # Checking for a full queue and appending are done under a lock, so
+        # that the deque never evicts a record uncounted.
+        self._queue = deque(maxlen=queueSize)
+        self._queueLock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+
+        self._thread = threading.Thread(target=self._run,
+                                        name='udplog-sender')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def prepare(self, record):
+        """
+        Prepare a record for queueing.
+
+        Like L{logging.handlers.QueueHandler.prepare}, this formats the
+        message and the exception of the record on the calling thread, so
+        that later changes to the arguments do not affect the message. The
+        arguments and the traceback are then removed from a copy of the
+        record, so that the queue does not keep them alive. A dictionary of
+        arguments is kept as a copy, as its items are added to the event, and
+        the exception type and value are kept for the C{'excType'} and
+        C{'excValue'} fields.
+
+        @return: The prepared copy of the record.
+        @rtype: L{logging.LogRecord}
+        """
+        record = copy.copy(record)
+        UDPLogHandler._format(self, record)
+
+        if isinstance(record.args, dict):
+            record.args = dict(record.args)
+        else:
+            record.args = None
+
+        if record.exc_info:
+            record.exc_info = record.exc_info[:2] + (None,)
+
+        return record
+
+
+    def _format(self, record):
+        """
+        Do not format records on the sender thread, see L{prepare}.
+        """
+
+
+    def emit(self, record):
+        """
+        Queue a record for emitting on the sender thread.
+        """
+        try:
+            record = self.prepare(record)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+            return
+
+        currentContext = getattr(self.logger, 'currentContext', None)
+        context = currentContext() if currentContext is not None else None
+
+        with self._queueLock:
+            full = len(self._queue) >= self.queueSize
+            if full:
+                self.dropped += 1
+            if not full or self.overflow == OVERFLOW_DROP_OLD:
+                self._queue.append((record, context))
+
+        if full:
+            metrics = getattr(self.logger, 'metrics', None)
+            if metrics is not None:
+                metrics.eventsDropped('queue')
+
+            if self.overflow == OVERFLOW_DROP_NEW:
+                return
+
+        if not self._wakeup.is_set():
+            self._wakeup.set()
+
+
+    def _run(self):
+        """
+        Emit queued records until the handler is closed.
+        """
+        while True:
+            # Check for stopping before draining, so that records queued
+            # before close was called are still emitted.
+            stopping = self._stopping
+            self._drain()
+
+            if stopping:
+                return
+
+            # Clear the flag before checking the queue again, so that a
+            # record queued in between still wakes us up.
+            self._wakeup.clear()
+            if not self._queue and not self._stopping:
+                self._wakeup.wait()
+
+
+    def _drain(self):
+        """
+        Emit all records currently in the queue.
+        """
+        while True:
+            try:
+                record, context = self._queue.popleft()
+            except IndexError:
+                return
+
+            if context is None:
+                UDPLogHandler.emit(self, record)
+            else:
+                with context:
+                    UDPLogHandler.emit(self, record)
+
+
+    def flush(self):
+        """
+        Emit all queued records on the calling thread.
+        """
+        self._drain()
+        UDPLogHandler.flush(self)
+
+
+    def close(self):
+        """
+        Stop the sender thread after emitting all queued records.
+        """
+        self._stopping = True
+        self._wakeup.set()
+        self._thread.join()
+        UDPLogHandler.flush(self)
+        UDPLogHandler.close(self)
+
+
+
+class ConfigurableQueueingUDPLogHandler(QueueingUDPLogHandler):
+    """
+    Configurable queueing UDPLog logging handler.
+
+    This is the L{QueueingUDPLogHandler} counterpart of
+    L{ConfigurableUDPLogHandler}, for use in logging configuration files.
+    """
+
+    def __init__(self, defaultFields=None, category='python_logging',
+                       host=DEFAULT_HOST, port=DEFAULT_PORT,
+                       includeHostname=True, batchSize=None,
+                       chunkSize=None, socketPath=None, compress=False,
+                       dedupWindow=None, metricsInterval=None,
+                       destinations=None, balance=BALANCE_HASH,
+                       sequenceNumbers=False, tracebackLimit=None,
+                       backoff=DEFAULT_BACKOFF, nonBlocking=False,
+                       sendBufferSize=None, queueSize=DEFAULT_QUEUE_SIZE,
+                       overflow=OVERFLOW_DROP_NEW):
+        """
+        Set up a QueueingUDPLogHandler with a UDPLogger.
+
+        The parameters are those of L{ConfigurableUDPLogHandler.__init__},
+        in the same order, so that they can be passed positionally from
+        logging configuration files, followed by:
+
+        @param queueSize: Maximum number of records in the queue.
+        @type queueSize: L{int}.
+
+        @param overflow: The overflow policy. See L{QueueingUDPLogHandler}.
+        """
+        logger = _makeLogger(defaultFields, host, port, includeHostname,
+                             batchSize, chunkSize, socketPath, compress,
+                             metricsInterval, destinations, balance,
+                             sequenceNumbers, tracebackLimit, backoff,
+                             nonBlocking, sendBufferSize)
+        QueueingUDPLogHandler.__init__(self, logger, category, queueSize,
+                                       overflow, dedupWindow)
 
 
 
 def main():
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind((DEFAULT_HOST, DEFAULT_PORT))
-    while True:
-        data, addr = sock.recvfrom(65535)
-        print data.rstrip()
+    """
+    Capture log events and print them.
+
+    See L{udplog.capture} for the options.
+    """
+    from udplog import capture
+    capture.main()
 
 
 
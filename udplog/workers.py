@@ -0,0 +1,399 @@
+# -*- test-case-name: udplog.test.test_workers -*-
+#
+# Copyright (c) Ralph Meijer.
+# See LICENSE for details.
+
+"""
+Multi-process UDPLog server.
+
+A single UDPLog server process handles all events on one core. With
+C{twistd udplog --workers=N}, the C{twistd} process instead runs a
+L{Supervisor} of N worker processes. Every worker binds the UDPLog and
+syslog UDP ports with C{SO_REUSEPORT}, so that the kernel spreads incoming
+datagrams across them, and runs its own dispatcher and backends. UNIX
+datagram sockets cannot be shared, so only the first worker listens on
+those.
+
+The supervisor passes the configuration to the workers on their standard
+input, restarts workers that exit, and periodically logs their combined
+statistics. Workers log to their standard error, which the supervisor
+relays to its own log. A worker exits when its supervisor goes away.
+"""
+
+from __future__ import division, absolute_import
+
+import os
+import socket
+import sys
+
+import simplejson
+
+from twisted.application import internet, service
+from twisted.internet import defer, protocol, stdio, task, udp
+from twisted.python import log
+
+class _ReusePort(udp.Port):
+    """
+    UDP port that allows other sockets to bind the same address.
+    """
+
+    def createInternetSocket(self):
+        skt = udp.Port.createInternetSocket(self)
+        skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        return skt
+
+
+
+class ReusePortUDPServer(internet.UDPServer):
+    """
+    UDP server that binds its port with C{SO_REUSEPORT}.
+
+    Multiple processes can run such a server on the same port, the kernel
+    spreading datagrams across them by the addresses of the senders.
+    """
+
+    def _getPort(self):
+        reactor = self.reactor
+        if reactor is None:
+            from twisted.internet import reactor
+
+        # Takes the same arguments as IReactorUDP.listenUDP.
+        def listen(port, protocol, interface='', maxPacketSize=8192):
+            p = _ReusePort(port, protocol, interface, maxPacketSize, reactor)
+            p.startListening()
+            return p
+
+        return listen(*self.args, **self.kwargs)
+
+
+
+def mergeStats(statsList):
+    """
+    Combine the statistics of multiple workers.
+
+    Numbers are added up, recursing into dictionaries. The loss rate is
+    computed again from the combined counts.
+
+    @param statsList: Statistics as returned by the C{stats} attribute of
+        the service from L{udplog.tap.makeServerService}.
+    @type statsList: L{list} of L{dict}
+
+    @rtype: L{dict}
+    """
+    def merge(target, source):
+        for key, value in source.iteritems():
+            if isinstance(value, dict):
+                merge(target.setdefault(key, {}), value)
+            elif isinstance(value, (int, long, float)):
+                target[key] = target.get(key, 0) + value
+
+    result = {}
+    for stats in statsList:
+        merge(result, stats)
+
+    loss = result.get('loss')
+    if loss is not None:
+        sent = loss.get('received', 0) + loss.get('lost', 0)
+        loss['lossRate'] = loss.get('lost', 0) / sent if sent else 0.0
+
+    return result
+
+
+
+def dumpConfig(config):
+    """
+    Serialize the configuration for a worker.
+
+    @type config: L{udplog.tap.Options}
+    @rtype: L{bytes}
+    """
+    return simplejson.dumps(dict(config), default=sorted)
+
+
+
+def loadConfig(data):
+    """
+    Unserialize the configuration from L{dumpConfig}.
+
+    @rtype: L{udplog.tap.Options}
+    """
+    from udplog import tap
+
+    def native(value):
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        else:
+            return value
+
+    config = tap.Options()
+    for key, value in simplejson.loads(data).iteritems():
+        if isinstance(config.get(key), set):
+            value = set(native(item) for item in value)
+        config[native(key)] = native(value)
+    return config
+
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    """
+    Process protocol for a worker, on the side of the supervisor.
+
+    The configuration is written to the worker's standard input, which is
+    then kept open for the worker to notice when the supervisor is gone.
+    Every line on the worker's standard output holds its statistics in JSON.
+    Lines on its standard error are logged.
+
+    @ivar index: The number of the worker.
+    @type index: L{int}
+
+    @ivar ended: Fires when the worker process has ended.
+    @type ended: L{defer.Deferred}
+    """
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.ended = defer.Deferred()
+        self._buffers = {1: b'', 2: b''}
+
+
+    def connectionMade(self):
+        self.transport.write(dumpConfig(self.supervisor.config) + b'\n')
+
+
+    def _lines(self, fd, data):
+        lines = (self._buffers[fd] + data).split(b'\n')
+        self._buffers[fd] = lines.pop()
+        return lines
+
+
+    def outReceived(self, data):
+        for line in self._lines(1, data):
+            try:
+                stats = simplejson.loads(line)
+            except ValueError:
+                log.err(None, "Malformed statistics from worker %d" %
+                              (self.index,))
+            else:
+                self.supervisor.statsReceived(self.index, stats)
+
+
+    def errReceived(self, data):
+        system = 'udplog-worker-%d' % (self.index,)
+        for line in self._lines(2, data):
+            log.msg(line, system=system)
+
+
+    def processEnded(self, reason):
+        self.supervisor.workerEnded(self.index, reason)
+        self.ended.callback(None)
+
+
+
+class Supervisor(service.Service):
+    """
+    Supervisor of UDPLog server worker processes.
+
+    @ivar config: The configuration to pass to the workers.
+    @type config: L{udplog.tap.Options}
+
+    @ivar count: The number of workers.
+    @type count: L{int}
+
+    @ivar statsInterval: Number of seconds between logging the combined
+        statistics of the workers, or C{None} to not log them.
+    @type statsInterval: L{float}
+
+    @ivar restartDelay: Number of seconds to wait before restarting a worker
+        that exited.
+    @type restartDelay: L{float}
+
+    @ivar restarts: Number of times a worker was restarted.
+    @type restarts: L{int}
+
+    @ivar workers: The process protocols of the running workers, by index.
+    @type workers: L{dict}
+    """
+
+    restartDelay = 1
+
+    def __init__(self, config, count, statsInterval=None, reactor=None,
+                       executable=sys.executable):
+        """
+        @param reactor: An object which provides
+            L{twisted.internet.interfaces.IReactorProcess} and
+            L{twisted.internet.interfaces.IReactorTime}.
+
+        @param executable: The Python interpreter to run the workers with.
+        """
+        self.config = config
+        self.count = count
+        self.statsInterval = statsInterval
+        self.executable = executable
+        self.restarts = 0
+        self.workers = {}
+
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+
+        self._stats = {}
+        self._statsCall = None
+
+
+    def startService(self):
+        service.Service.startService(self)
+
+        for index in xrange(self.count):
+            self.spawn(index)
+
+        if self.statsInterval:
+            self._statsCall = task.LoopingCall(self.logStats)
+            self._statsCall.clock = self._reactor
+            self._statsCall.start(self.statsInterval, now=False)
+
+
+    def stopService(self):
+        """
+        Stop all workers.
+
+        @return: A deferred that fires when all workers have ended.
+        """
+        service.Service.stopService(self)
+
+        if self._statsCall is not None:
+            self._statsCall.stop()
+            self._statsCall = None
+
+        ended = []
+        for worker in self.workers.values():
+            ended.append(worker.ended)
+            try:
+                worker.transport.signalProcess('TERM')
+            except Exception:
+                log.err(None, "Failed to stop worker %d" % (worker.index,))
+        return defer.gatherResults(ended)
+
+
+    def spawn(self, index):
+        """
+        Start a worker process.
+        """
+        worker = WorkerProtocol(self, index)
+        self.workers[index] = worker
+        self._reactor.spawnProcess(worker, self.executable,
+                                   [self.executable, '-m', 'udplog.workers',
+                                    str(index)],
+                                   env=os.environ)
+
+
+    def workerEnded(self, index, reason):
+        """
+        Called when a worker has ended, to restart it after C{restartDelay}.
+        """
+        self.workers.pop(index, None)
+        self._stats.pop(index, None)
+
+        if not self.running:
+            return
+
+        log.msg(format="Worker %(index)d ended (%(reason)s), restarting",
+                index=index, reason=reason.getErrorMessage())
+        self.restarts += 1
+        self._reactor.callLater(self.restartDelay, self._restart, index)
+
+
+    def _restart(self, index):
+        if self.running and index not in self.workers:
+            self.spawn(index)
+
+
+    def statsReceived(self, index, stats):
+        """
+        Called with the latest statistics of a worker.
+        """
+        self._stats[index] = stats
+
+
+    def stats(self):
+        """
+        Get the combined statistics of the running workers.
+
+        @return: The statistics of L{mergeStats}, with the number of running
+            C{workers} and the number of C{restarts}.
+        @rtype: L{dict}
+        """
+        result = mergeStats(self._stats.values())
+        result['workers'] = len(self.workers)
+        result['restarts'] = self.restarts
+        return result
+
+
+    def logStats(self):
+        """
+        Log the combined statistics of the workers.
+        """
+        log.msg(format="Worker statistics: %(stats)s",
+                stats=simplejson.dumps(self.stats(), sort_keys=True))
+
+
+
+class _SupervisorConnection(protocol.Protocol):
+    """
+    Standard I/O protocol of a worker, to report statistics to and notice
+    the loss of the supervisor.
+    """
+
+    def connectionLost(self, reason):
+        from twisted.internet import reactor
+        if reactor.running:
+            reactor.stop()
+
+
+
+def main(argv=None, stdin=sys.stdin):
+    """
+    Run a worker process.
+
+    The configuration is read from the first line on standard input.
+
+    @param argv: The index of the worker.
+    """
+    from twisted.internet import reactor
+    from udplog import tap
+
+    if argv is None:
+        argv = sys.argv[1:]
+    index = int(argv[0])
+    config = loadConfig(stdin.readline())
+
+    # The supervisor adds timestamps when relaying the log lines.
+    def emit(eventDict):
+        text = log.textFromEventDict(eventDict)
+        if text is not None:
+            sys.stderr.write(text.replace('\n', '\n\t') + '\n')
+            sys.stderr.flush()
+
+    log.startLoggingWithObserver(emit, setStdout=False)
+
+    s = tap.makeServerService(config, reusePort=True, primary=(index == 0))
+
+    connection = _SupervisorConnection()
+    stdio.StandardIO(connection)
+
+    def reportStats():
+        connection.transport.write(simplejson.dumps(s.stats()) + b'\n')
+
+    interval = config['worker-stats-interval']
+    if interval:
+        reporter = internet.TimerService(interval, reportStats)
+        reporter.setServiceParent(s)
+
+    s.startService()
+    reactor.addSystemEventTrigger('before', 'shutdown', s.stopService)
+    reactor.run()
+
+
+
+if __name__ == '__main__':
+    main()